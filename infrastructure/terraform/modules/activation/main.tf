@@ -18,6 +18,8 @@ locals {
   template_dir                                   = "${local.source_root_dir}/templates"
   pipeline_source_dir                            = "${local.source_root_dir}/python/activation"
   trigger_function_dir                           = "${local.source_root_dir}/python/function"
+  # The instance holding the coalescing window waits for the end of the window before launching the job.
+  trigger_function_timeout_seconds               = 60 + var.activation_coalescing_window_seconds
   configuration_folder                           = "configuration"
   audience_segmentation_query_template_file      = "audience_segmentation_query_template.sqlx"
   auto_audience_segmentation_query_template_file = "auto_audience_segmentation_query_template.sqlx"
@@ -930,6 +932,16 @@ module "function_bucket" {
       with_state     = "ANY"
       matches_prefix = module.project_services.project_id
     }
+  }, {
+    # The launch leases only need to outlive the redeliveries of the Pub/Sub activation messages.
+    action = {
+      type = "Delete"
+    }
+    condition = {
+      age            = 7
+      with_state     = "ANY"
+      matches_prefix = "activation_launches/"
+    }
   }]
 
   iam_members = [{
@@ -980,7 +992,7 @@ resource "google_cloudfunctions2_function" "activation_trigger_cf" {
   service_config {
     available_memory      = "256M"
     max_instance_count    = 3
-    timeout_seconds       = 60
+    timeout_seconds       = local.trigger_function_timeout_seconds
     ingress_settings      = "ALLOW_INTERNAL_ONLY"
     service_account_email = module.trigger_function_account.email
     environment_variables = {
@@ -991,6 +1003,13 @@ resource "google_cloudfunctions2_function" "activation_trigger_cf" {
       PIPELINE_TEMP_LOCATION        = "gs://${module.pipeline_bucket.name}/tmp/"
       LOG_DATA_SET                  = module.bigquery.bigquery_dataset.dataset_id
       PIPELINE_WORKER_EMAIL         = module.pipeline_service_account.email
+      # Activation messages received within the window are launched as a single multi-activation job.
+      ACTIVATION_COALESCING_WINDOW_SECONDS = var.activation_coalescing_window_seconds
+      ACTIVATION_COALESCING_LOCATION       = "gs://${module.function_bucket.name}/activation_coalescing"
+      # Redeliveries of an activation message already launched are acknowledged without launching another job.
+      ACTIVATION_LAUNCH_LEASE_LOCATION     = "gs://${module.function_bucket.name}/activation_launches"
+      # Launches still claimed after the function timeout were abandoned by a killed instance and are claimed again.
+      ACTIVATION_FUNCTION_TIMEOUT_SECONDS  = local.trigger_function_timeout_seconds
     }
     # Sets the environment variables from the secrets stored on Secret Manager
     secret_environment_variables {
@@ -86,3 +86,9 @@ variable "project_owner_email" {
   description = "Email address of the project owner."
   type        = string
 }
+
+variable "activation_coalescing_window_seconds" {
+  description = "Number of seconds the activation messages are buffered before launching a single Dataflow job for all of them. 0 launches a job per message."
+  type        = number
+  default     = 0
+}
@@ -0,0 +1,378 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Local benchmarks for the activation application.
+
+Usage:
+  python benchmark.py sender --payloads 2000 --events_per_user 4 --batch_size 100 --latency 0.005
+  python benchmark.py async_sender --payloads 2000 --max_concurrent_requests 100 --latency 0.05
+  python benchmark.py payload --rows 1000000
+  python benchmark.py pipeline --rows 20000 --batch_size 100 --latency 0.02 --error_rate 0.01 --throttle_rate 0.05
+  python benchmark.py read --project my-project --dataset activation --temp_location gs://my-bucket/tmp --rows 1000000
+"""
+import argparse
+import json
+import time
+import uuid
+
+from decimal import Decimal
+
+import apache_beam as beam
+from apache_beam.metrics.metric import MetricsFilter
+from apache_beam.options.pipeline_options import PipelineOptions
+from apache_beam.transforms.window import GlobalWindow
+from apache_beam.utils.timestamp import MIN_TIMESTAMP
+from apache_beam.utils.windowed_value import WindowedValue
+from google.cloud import bigquery
+
+from fake_collector import FakeCollector
+from main import AsyncCallMeasurementProtocolAPI, CallMeasurementProtocolAPI, CoalescePayloads, DecimalEncoder, SendToMeasurementProtocol, SplitCoalescedResponses, ToLogFormat, TransformToPayload, read_from_source, serialize_payload
+
+
+def synthetic_payloads(count, events_per_user):
+  """
+  Generates synthetic Measurement Protocol payloads.
+
+  Args:
+    count: The number of payloads to generate.
+    events_per_user: The number of consecutive payloads sharing the same user.
+
+  Returns:
+    A list of Measurement Protocol payloads with a single event each.
+  """
+  return [{
+    'client_id': f"client-{i // events_per_user}",
+    'timestamp_micros': 1677283200000000,
+    'non_personalized_ads': False,
+    'consent': {'ad_user_data': 'GRANTED', 'ad_personalization': 'GRANTED'},
+    'user_properties': {'p_p_decile': {'value': str(i // events_per_user % 10)}},
+    'events': [{'name': 'maj_benchmark', 'params': {'session_id': i}}]
+  } for i in range(count)]
+
+
+def synthetic_row(i, features=20):
+  """
+  Generates a synthetic row shaped like the output of the inference pipelines.
+
+  Args:
+    i: The index of the row.
+    features: The number of feature columns that are neither user properties nor event parameters.
+
+  Returns:
+    A row as read from BigQuery.
+  """
+  return {
+    'client_id': f"client-{i}",
+    'user_id': f"user-{i}" if i % 3 == 0 else None,
+    'inference_date': '2023-02-25 00:00:00.000000 UTC',
+    **{f"feature_{j}": j for j in range(features)},
+    'user_prop_p_p_decile': str(i % 10 + 1),
+    'user_prop_p_p_prob': Decimal('0.5'),
+    'user_prop_segment': 'high',
+    'event_param_prediction_prob': Decimal('0.123'),
+    'event_param_value': Decimal(i % 100),
+    'event_param_currency': 'USD'
+  }
+
+
+def synthetic_rows(count, features=20):
+  """
+  Generates synthetic rows shaped like the output of the inference pipelines.
+
+  Args:
+    count: The number of rows to generate.
+    features: The number of feature columns that are neither user properties nor event parameters.
+
+  Returns:
+    A list of rows as read from BigQuery.
+  """
+  return [synthetic_row(i, features) for i in range(count)]
+
+
+def run_sender(payloads, sender, batch_size, bundle_size=1000):
+  """
+  Sends the payloads through the sender DoFn the way the activation pipeline does.
+
+  Args:
+    payloads: The Measurement Protocol payloads to send.
+    sender: The sender DoFn.
+    batch_size: The maximum number of payloads coalesced together. A value of 1 disables coalescing.
+    bundle_size: The number of requests processed per bundle.
+
+  Returns:
+    The number of responses attributed to single events.
+  """
+  coalesce = CoalescePayloads()
+  split = SplitCoalescedResponses()
+
+  requests_to_send = []
+  for start in range(0, len(payloads), batch_size):
+    batch = payloads[start:start + batch_size]
+    requests_to_send.extend(coalesce.process(batch) if batch_size > 1 else batch)
+
+  def count_events(outputs):
+    count = 0
+    for output in outputs:
+      response = output.value if isinstance(output, WindowedValue) else output
+      count += sum(1 for _ in split.process(response))
+    return count
+
+  responses = 0
+  sender.setup()
+  for start in range(0, len(requests_to_send), bundle_size):
+    sender.start_bundle()
+    for request in requests_to_send[start:start + bundle_size]:
+      if isinstance(sender, AsyncCallMeasurementProtocolAPI):
+        outputs = sender.process(request, window=GlobalWindow(), timestamp=MIN_TIMESTAMP)
+      else:
+        outputs = sender.process(request)
+      responses += count_events(outputs)
+    responses += count_events(sender.finish_bundle() or [])
+  sender.teardown()
+  return responses
+
+
+def report(label, responses, collector, elapsed):
+  """
+  Prints the throughput of a benchmark run.
+
+  Args:
+    label: The label of the run.
+    responses: The number of responses attributed to single events.
+    collector: The fake collector the events were sent to.
+    elapsed: The wall time of the run, in seconds.
+  """
+  print(f"{label:<28} events={responses:<8} requests={collector.request_count:<8} "
+        f"elapsed={elapsed:.2f}s events/sec={responses / elapsed:.1f}")
+
+
+def benchmark_sender(args):
+  """
+  Compares the per-row sender with the coalescing sender against a local fake collector.
+
+  Args:
+    args: The command-line arguments.
+  """
+  payloads = synthetic_payloads(args.payloads, args.events_per_user)
+  for batch_size in (1, args.batch_size):
+    with FakeCollector(latency=args.latency) as collector:
+      sender = CallMeasurementProtocolAPI('G-BENCHMARK', 'secret', endpoint=collector.endpoint)
+      start = time.perf_counter()
+      responses = run_sender(payloads, sender, batch_size)
+      elapsed = time.perf_counter() - start
+    report(f"batch_size={batch_size}", responses, collector, elapsed)
+
+
+def benchmark_async_sender(args):
+  """
+  Compares the blocking sender with the asynchronous sender against a local fake collector.
+
+  Args:
+    args: The command-line arguments.
+  """
+  payloads = synthetic_payloads(args.payloads, 1)
+  with FakeCollector(latency=args.latency) as collector:
+    sender = CallMeasurementProtocolAPI('G-BENCHMARK', 'secret', endpoint=collector.endpoint)
+    start = time.perf_counter()
+    responses = run_sender(payloads, sender, 1)
+    report('blocking', responses, collector, time.perf_counter() - start)
+
+  with FakeCollector(latency=args.latency) as collector:
+    sender = AsyncCallMeasurementProtocolAPI('G-BENCHMARK', 'secret', endpoint=collector.endpoint,
+                                             max_concurrent_requests=args.max_concurrent_requests)
+    start = time.perf_counter()
+    responses = run_sender(payloads, sender, 1)
+    report(f"async concurrency={args.max_concurrent_requests}", responses, collector, time.perf_counter() - start)
+
+
+def benchmark_payload(args):
+  """
+  Times the row to payload transformation and the payload serialization on synthetic rows.
+
+  Args:
+    args: The command-line arguments.
+  """
+  rows = synthetic_rows(args.rows)
+  transform = TransformToPayload('maj_benchmark')
+
+  start = time.perf_counter()
+  payloads = [payload for row in rows for payload in transform.process(row)]
+  elapsed = time.perf_counter() - start
+  print(f"{'transform':<28} rows={args.rows:<8} elapsed={elapsed:.2f}s rows/sec={args.rows / elapsed:.1f}")
+
+  for label, serialize in (('serialize json', lambda payload: json.dumps(payload, cls=DecimalEncoder).encode()),
+                           ('serialize_payload', serialize_payload)):
+    start = time.perf_counter()
+    for payload in payloads:
+      serialize(payload)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} rows={args.rows:<8} elapsed={elapsed:.2f}s rows/sec={args.rows / elapsed:.1f}")
+
+
+def percentile(values, share):
+  """
+  Computes a percentile with the nearest-rank method.
+
+  Args:
+    values: The values.
+    share: The percentile, between 0 and 1.
+
+  Returns:
+    The percentile of the values, or 0 if there are no values.
+  """
+  if not values:
+    return 0.0
+  ordered = sorted(values)
+  return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+def benchmark_pipeline(args):
+  """
+  Runs the activation pipeline end to end on synthetic prediction rows against a local fake collector.
+
+  The source table is replaced by in-memory rows and the log table by a count of the routed responses,
+  every other step is the one of the activation pipeline.
+
+  Args:
+    args: The command-line arguments.
+  """
+  options = PipelineOptions(flags=[], runner=args.runner, direct_num_workers=args.direct_num_workers, direct_running_mode='multi_threading')
+
+  with FakeCollector(latency=args.latency, error_rate=args.error_rate, throttle_rate=args.throttle_rate, seed=0) as collector:
+    p = beam.Pipeline(options=options)
+    routed_responses = (p
+    | 'Create row indexes' >> beam.Create(range(args.rows))
+    | 'Generate synthetic rows' >> beam.Map(synthetic_row)
+    | 'Prepare Measurement Protocol API payload' >> beam.ParDo(TransformToPayload('maj_benchmark'))
+    | 'Send to Measurement Protocol API' >> SendToMeasurementProtocol('G-BENCHMARK', 'secret', batch_size=args.batch_size,
+        endpoint=collector.endpoint, use_async_http=args.use_async_http, max_concurrent_requests=args.max_concurrent_requests,
+        max_retries=args.max_send_retries, retry_backoff=args.retry_backoff_seconds)
+    | 'Transform log format' >> beam.ParDo(ToLogFormat('benchmark')).with_outputs(ToLogFormat.OK, ToLogFormat.FAILED, ToLogFormat.RETRYABLE, main='log')
+    )
+    for tag in (ToLogFormat.OK, ToLogFormat.FAILED, ToLogFormat.RETRYABLE):
+      _ = (routed_responses[tag]
+      | f"Count {tag}" >> beam.combiners.Count.Globally()
+      | f"Print {tag}" >> beam.Map(lambda count, tag: print(f"{tag + ' responses':<28} events={count}"), tag))
+    start = time.perf_counter()
+    result = p.run()
+    result.wait_until_finish()
+    elapsed = time.perf_counter() - start
+
+  counters = {counter.key.metric.name: counter.committed
+              for counter in result.metrics().query(MetricsFilter().with_namespace('activation'))['counters']}
+  print(f"{'pipeline':<28} rows={args.rows:<8} requests={collector.request_count:<8} elapsed={elapsed:.2f}s "
+        f"events/sec={collector.event_count / elapsed:.1f}")
+  print(f"{'collector latency':<28} p50={percentile(collector.latencies, 0.5) * 1000:.1f}ms "
+        f"p99={percentile(collector.latencies, 0.99) * 1000:.1f}ms status_codes={dict(sorted(collector.status_counts.items()))}")
+  print(f"{'retries':<28} " + ' '.join(f"{name}={counters.get(name, 0)}" for name in ('throttled_requests', 'retried_requests', 'retry_budget_exhausted')))
+
+
+def create_synthetic_predictions_table(client, table_id, rows):
+  """
+  Creates a synthetic predictions table shaped like the output of the inference pipelines.
+
+  Args:
+    client: The BigQuery client.
+    table_id: The fully qualified id of the table to create.
+    rows: The number of rows of the table.
+  """
+  client.query(f"""
+    CREATE OR REPLACE TABLE `{table_id}` AS
+    SELECT
+      CONCAT('client-', CAST(i AS STRING)) AS client_id,
+      IF(MOD(i, 3) = 0, CONCAT('user-', CAST(i AS STRING)), NULL) AS user_id,
+      TIMESTAMP '2023-02-25 00:00:00 UTC' AS inference_date,
+      CAST(MOD(i, 10) + 1 AS STRING) AS user_prop_p_p_decile,
+      CAST(RAND() AS NUMERIC) AS event_param_prediction_prob,
+      CAST(MOD(i, 100) AS NUMERIC) AS event_param_value
+    FROM UNNEST(GENERATE_ARRAY(1, {rows})) AS i
+  """).result()
+
+
+def benchmark_read(args):
+  """
+  Compares the BigQuery read methods of the activation pipeline on a synthetic predictions table.
+
+  Args:
+    args: The command-line arguments.
+  """
+  client = bigquery.Client(project=args.project)
+  table_id = f"{args.project}.{args.dataset}.activation_read_benchmark_{uuid.uuid4().hex[:8]}"
+  create_synthetic_predictions_table(client, table_id, args.rows)
+  query = f"SELECT * FROM `{table_id}`"
+  try:
+    for read_method, use_arrow_format in (('EXPORT', False), ('DIRECT_READ', False), ('DIRECT_READ', True)):
+      read_args = argparse.Namespace(project=args.project, read_method=read_method, use_arrow_format=use_arrow_format)
+      options = PipelineOptions(project=args.project, temp_location=args.temp_location, direct_num_workers=0)
+      start = time.perf_counter()
+      with beam.Pipeline(options=options) as p:
+        _ = (p
+        | 'Read from source table' >> read_from_source(read_args, query)
+        | 'Prepare Measurement Protocol API payload' >> beam.ParDo(TransformToPayload('maj_benchmark'))
+        | 'Count' >> beam.combiners.Count.Globally())
+      elapsed = time.perf_counter() - start
+      label = f"{read_method}{' (arrow)' if use_arrow_format else ''}"
+      print(f"{label:<28} rows={args.rows:<8} elapsed={elapsed:.2f}s rows/sec={args.rows / elapsed:.1f}")
+  finally:
+    client.delete_table(table_id, not_found_ok=True)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+  sender = subparsers.add_parser('sender', help='per-row vs coalesced Measurement Protocol sender')
+  sender.add_argument('--payloads', type=int, default=2000)
+  sender.add_argument('--events_per_user', type=int, default=4)
+  sender.add_argument('--batch_size', type=int, default=100)
+  sender.add_argument('--latency', type=float, default=0.005, help='collector latency in seconds')
+  sender.set_defaults(func=benchmark_sender)
+
+  async_sender = subparsers.add_parser('async_sender', help='blocking vs asynchronous Measurement Protocol sender')
+  async_sender.add_argument('--payloads', type=int, default=2000)
+  async_sender.add_argument('--max_concurrent_requests', type=int, default=100)
+  async_sender.add_argument('--latency', type=float, default=0.05, help='collector latency in seconds')
+  async_sender.set_defaults(func=benchmark_async_sender)
+
+  payload = subparsers.add_parser('payload', help='row to payload transformation and payload serialization')
+  payload.add_argument('--rows', type=int, default=1000000)
+  payload.set_defaults(func=benchmark_payload)
+
+  pipeline = subparsers.add_parser('pipeline', help='activation pipeline end to end against a local fake collector')
+  pipeline.add_argument('--rows', type=int, default=20000)
+  pipeline.add_argument('--runner', default='DirectRunner', help='DirectRunner or PrismRunner')
+  pipeline.add_argument('--direct_num_workers', type=int, default=4)
+  pipeline.add_argument('--batch_size', type=int, default=1)
+  pipeline.add_argument('--use_async_http', action='store_true')
+  pipeline.add_argument('--max_concurrent_requests', type=int, default=100)
+  pipeline.add_argument('--max_send_retries', type=int, default=3)
+  pipeline.add_argument('--retry_backoff_seconds', type=float, default=0.05)
+  pipeline.add_argument('--latency', type=float, default=0.005, help='collector latency in seconds')
+  pipeline.add_argument('--error_rate', type=float, default=0.0, help='share of requests answered with 500')
+  pipeline.add_argument('--throttle_rate', type=float, default=0.0, help='share of requests answered with 429')
+  pipeline.set_defaults(func=benchmark_pipeline)
+
+  read = subparsers.add_parser('read', help='JSON export vs Storage Read API source, on a synthetic table')
+  read.add_argument('--project', required=True)
+  read.add_argument('--dataset', required=True, help='dataset where the synthetic table is created')
+  read.add_argument('--temp_location', required=True, help='GCS path used by the JSON export')
+  read.add_argument('--rows', type=int, default=1000000)
+  read.set_defaults(func=benchmark_read)
+
+  args = parser.parse_args()
+  args.func(args)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,193 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import random
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Paths of the Measurement Protocol collector and of its validation server.
+COLLECT_PATH = '/mp/collect'
+DEBUG_COLLECT_PATH = '/debug/mp/collect'
+
+
+class _CollectorServer(ThreadingHTTPServer):
+  # The default backlog of 5 drops connections when many requests are opened concurrently.
+  request_queue_size = 1024
+
+
+class FakeCollector:
+  """
+  This class defines a local stand-in for the Google Analytics 4 Measurement Protocol collector.
+
+  The collector answers `/mp/collect` requests with `204 No Content` and `/debug/mp/collect` requests with
+  `200 OK` and an empty list of validation messages, like the real endpoints do. A share of the requests can be
+  answered with `429 Too Many Requests` or `500 Internal Server Error` instead, to exercise the retries of the sender.
+
+  The collector counts the connections, requests, events and status codes it sends back and records the time it
+  spends on every request, so that the activation sender can be load tested without sending events to Google Analytics 4.
+
+  The collector takes the following arguments:
+
+  - latency: The number of seconds the collector waits before answering each request.
+  - error_rate: The share of requests answered with `500 Internal Server Error`.
+  - throttle_rate: The share of requests answered with `429 Too Many Requests`.
+  - host: The host the collector listens on.
+  - port: The port the collector listens on. Use 0 to pick a free port.
+  - seed: The seed of the random generator picking the failed requests.
+  """
+
+  def __init__(self, latency=0.0, error_rate=0.0, throttle_rate=0.0, host='127.0.0.1', port=0, seed=None):
+    """
+    Initializes the collector.
+
+    Args:
+      latency: The number of seconds the collector waits before answering each request.
+      error_rate: The share of requests answered with `500 Internal Server Error`.
+      throttle_rate: The share of requests answered with `429 Too Many Requests`.
+      host: The host the collector listens on.
+      port: The port the collector listens on. Use 0 to pick a free port.
+      seed: The seed of the random generator picking the failed requests.
+    """
+    self.latency = latency
+    self.error_rate = error_rate
+    self.throttle_rate = throttle_rate
+    self.connection_count = 0
+    self.request_count = 0
+    self.event_count = 0
+    self.status_counts = {}
+    self.latencies = []
+    self._random = random.Random(seed)
+    self._lock = threading.Lock()
+    self._server = _CollectorServer((host, port), self._handler_class())
+    self._server.daemon_threads = True
+    self._thread = None
+
+
+  @property
+  def endpoint(self):
+    """
+    The endpoint host to use in place of the Measurement Protocol endpoint.
+    """
+    host, port = self._server.server_address[:2]
+    return f"http://{host}:{port}"
+
+
+  def start(self):
+    """
+    Starts serving requests on a background thread.
+
+    Returns:
+      The collector.
+    """
+    self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+    self._thread.start()
+    return self
+
+
+  def stop(self):
+    """
+    Stops serving requests.
+    """
+    self._server.shutdown()
+    self._server.server_close()
+
+
+  def __enter__(self):
+    return self.start()
+
+
+  def __exit__(self, *args):
+    self.stop()
+
+
+  def _record_connection(self):
+    """
+    Records a new client connection.
+    """
+    with self._lock:
+      self.connection_count += 1
+
+
+  def _pick_status(self, path):
+    """
+    Picks the status code of the response to a request.
+
+    Args:
+      path: The path of the request.
+
+    Returns:
+      The HTTP status code of the response.
+    """
+    if path not in (COLLECT_PATH, DEBUG_COLLECT_PATH):
+      return 404
+    with self._lock:
+      draw = self._random.random()
+    if draw < self.throttle_rate:
+      return 429
+    if draw < self.throttle_rate + self.error_rate:
+      return 500
+    return 200 if path == DEBUG_COLLECT_PATH else 204
+
+
+  def _record(self, body, status_code, latency):
+    """
+    Records a received request.
+
+    Args:
+      body: The raw body of the request.
+      status_code: The HTTP status code of the response.
+      latency: The number of seconds spent on the request.
+    """
+    try:
+      events = len(json.loads(body).get('events', []))
+    except ValueError:
+      events = 0
+    with self._lock:
+      self.request_count += 1
+      if status_code in (200, 204):
+        self.event_count += events
+      self.status_counts[status_code] = self.status_counts.get(status_code, 0) + 1
+      self.latencies.append(latency)
+
+
+  def _handler_class(self):
+    collector = self
+
+    class Handler(BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+
+      def setup(self):
+        super().setup()
+        collector._record_connection()
+
+      def do_POST(self):
+        start = time.perf_counter()
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if collector.latency:
+          time.sleep(collector.latency)
+        status_code = collector._pick_status(self.path.split('?', 1)[0])
+        content = b'{"validationMessages":[]}' if status_code == 200 else b''
+        self.send_response(status_code)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+        collector._record(body, status_code, time.perf_counter() - start)
+
+      def log_message(self, format, *args):
+        pass
+
+    return Handler
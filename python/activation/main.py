@@ -11,12 +11,26 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import argparse
+import asyncio
+import base64
+import collections
+import functools
+import hashlib
 import logging
+import os
+import random
 import re
+import tempfile
+import threading
+import time
 import traceback
 
 from apache_beam.io.gcp.internal.clients import bigquery
-from apache_beam.options.pipeline_options import GoogleCloudOptions
+from apache_beam.metrics import Metrics
+from apache_beam.options.pipeline_options import GoogleCloudOptions, ProfilingOptions, StandardOptions
+from apache_beam.utils.timestamp import Timestamp
+from apache_beam.utils.windowed_value import WindowedValue
 import apache_beam as beam
 
 import json
@@ -25,9 +39,100 @@ import uuid
 import datetime
 
 from decimal import Decimal
+from google.api_core import exceptions as google_exceptions
+from google.cloud import bigquery as google_bigquery
 from google.cloud import storage
 from jinja2 import Environment, BaseLoader
+import jinja2
+
+try:
+  # orjson is an optional, faster encoder for the Measurement Protocol payloads.
+  import orjson
+except ImportError:
+  orjson = None
+
+
+# Measurement Protocol endpoint host, overridable to target a local collector.
+MEASUREMENT_PROTOCOL_ENDPOINT = 'https://www.google-analytics.com'
+# Maximum number of events the Measurement Protocol accepts in a single request.
+MEASUREMENT_PROTOCOL_MAX_EVENTS_PER_REQUEST = 25
+# HTTP status codes of Measurement Protocol responses worth retrying.
+RETRYABLE_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+# Default maximum number of pooled keep-alive connections per worker thread of the synchronous HTTP engine.
+DEFAULT_HTTP_POOL_SIZE = 10
+# Status code reported for requests that never got a response (timeouts, connection errors).
+NO_RESPONSE_STATUS_CODE = 0
+# Status code reported for events routed to a GA4 property without a known API secret.
+UNKNOWN_PROPERTY_STATUS_CODE = -1
+# Table, in the log dataset, recording the events already sent to GA4.
+SENT_LEDGER_TABLE = 'activation_sent_ledger'
+# Activation types accepted in the queries of the sent ledger, which ReadFromBigQuery cannot pass as query parameters.
+ACTIVATION_TYPE_PATTERN = re.compile(r'[A-Za-z0-9_-]+')
+# Number of days of the sent ledger checked before sending. The Measurement Protocol only accepts events from the last 72 hours.
+SENT_LEDGER_LOOKBACK_DAYS = 7
+# Table, in the log dataset, recording the outcome of every event sent to GA4.
+ACTIVATION_LOG_TABLE = 'activation_log'
+# On-demand prices used to project the cost of a run in dry runs, in USD.
+BIGQUERY_ON_DEMAND_PRICE_PER_TIB = 6.25
+STORAGE_WRITE_API_PRICE_PER_GIB = 0.025
+# Approximate size of the columns of an activation log row other than the payload, in bytes.
+ACTIVATION_LOG_ROW_OVERHEAD_BYTES = 150
+# Folder, next to the activation type configuration file, holding the configurations cached in GCS.
+CONFIGURATION_CACHE_FOLDER = '.activation_cache'
+# Local folder holding the cached configurations.
+CONFIGURATION_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'activation_configuration_cache')
+# Compiled configurations of this process, keyed by the cache key of the configuration.
+_CONFIGURATION_CACHE = {}
+# Injected strings removed from the client_id values before sending.
+CLIENT_ID_SANITIZER = re.compile('|'.join(re.escape(injected) for injected in [
+  '<img onerror="_exploit_dom_xss(20007)',
+  '<img onerror="_exploit_dom_xss(20023)',
+  '<img onerror="_exploit_dom_xss(20013)',
+  '<img onerror="_exploit_dom_xss(20010)',
+  'q="><script>_exploit_dom_xss(40007)</script>',
+  'q="><script>_exploit_dom_xss(40013)</script>',
+]))
+# Schema of the activation log table.
+ACTIVATION_LOG_SCHEMA = {
+  'fields': [{
+    'name': 'id', 'type': 'STRING', 'mode': 'REQUIRED'
+    }, {
+    'name': 'activation_id', 'type': 'STRING', 'mode': 'REQUIRED'
+    }, {
+    'name': 'payload', 'type': 'STRING', 'mode': 'NULLABLE'
+    }, {
+    'name': 'latest_state', 'type': 'STRING', 'mode': 'REQUIRED'
+    }, {
+    'name': 'updated_at', 'type': 'TIMESTAMP', 'mode': 'REQUIRED'
+    }, {
+    'name': 'activation_run_key', 'type': 'STRING', 'mode': 'REQUIRED'
+  }]
+}
+ACTIVATION_LOG_CLUSTERING_FIELDS = ['activation_id']
+
+
+def str_to_bool(value):
+  """
+  Parses the value of a boolean command-line flag.
+
+  The Flex Template parameters are passed as strings, and bool('false') is True, so the values are parsed explicitly.
+
+  Args:
+    value: The value of the flag, true or false in any case.
 
+  Returns:
+    The boolean value of the flag.
+
+  Raises:
+    argparse.ArgumentTypeError: If the value is neither true nor false.
+  """
+  if isinstance(value, bool):
+    return value
+  if value.lower() == 'true':
+    return True
+  if value.lower() == 'false':
+    return False
+  raise argparse.ArgumentTypeError(f"Expected true or false, got {value}")
 
 class ActivationOptions(GoogleCloudOptions):
   """
@@ -47,7 +152,7 @@ class ActivationOptions(GoogleCloudOptions):
       parser: The argparse parser.
     
     The following arguments are defined:
-      source_table: The table specification for the source data in the format dataset.data_table.
+      source_table: The table specification for the source data in the format dataset.data_table. Required unless activation_subscription is set.
       ga4_measurement_id: The Measurement ID in Google Analytics 4.
       ga4_api_secret: The client secret for sending data to Google Analytics 4.
       log_db_dataset: The dataset where the log table will be created.
@@ -63,14 +168,45 @@ class ActivationOptions(GoogleCloudOptions):
         - purchase-propensity-15-7
         - churn-propensity-30-15
         - lead-score-propensity-5-1
+        Required unless activation_subscription is set.
       activation_type_configuration: The GCS path to the configuration file for all activation types.
+      send_batch_size: The maximum number of payloads grouped together before the payloads with an identical user envelope are coalesced into multi-event requests.
+      log_success_payloads: A boolean flag indicating whether to log the payloads of the events sent successfully. The payloads of the failed events are always logged.
+      deduplicate_payloads: A boolean flag indicating whether to merge the payloads of the same client_id and user_id before sending them.
+      use_async_http: A boolean flag indicating whether to send the events with the asynchronous HTTP engine.
+      max_concurrent_requests: The maximum number of requests in flight per worker thread when using the asynchronous HTTP engine.
+      http_pool_size: The maximum number of pooled keep-alive connections per worker thread. Defaults to 10, or to max_concurrent_requests with the asynchronous HTTP engine.
+      http_connect_timeout: The connect timeout of the requests sent to the Measurement Protocol API, in seconds.
+      http_read_timeout: The read timeout of the requests sent to the Measurement Protocol API, in seconds.
+      use_http2: A boolean flag indicating whether to send the events over HTTP/2.
+      max_requests_per_second: The maximum number of requests per second sent by each worker, 0 for no limit.
+      max_send_retries: The number of times a throttled, failed or timed out request is retried before being logged as failed.
+      retry_backoff_seconds: The base delay of the jittered exponential backoff between retries, in seconds.
+      use_sent_ledger: A boolean flag indicating whether to skip the events already sent by a previous run and record the sent events in the sent ledger.
+      prediction_snapshot: The identifier of the prediction snapshot used to derive the activation run key. Defaults to the last modification time of the source table.
+      read_method: The method used to read the source data from BigQuery, which can be one of the following values:
+        - EXPORT: exports the query result to GCS as JSON files and reads the files.
+        - DIRECT_READ: reads the query result with the BigQuery Storage Read API, without the export step.
+      use_arrow_format: A boolean flag indicating whether to read the source data in the Arrow format instead of the Avro format when using DIRECT_READ.
+      ga4_property_column: The column of the source data holding the Measurement ID of the Google Analytics 4 property each row is sent to.
+        The rows without a value are sent to the property of ga4_measurement_id, or of the activation type configuration when it defines one.
+      ga4_api_secrets: A JSON object mapping the Measurement IDs of additional Google Analytics 4 properties to their client secrets.
+      cache_configuration_in_gcs: A boolean flag indicating whether to cache the compiled activation type configuration in GCS, next to the configuration file.
+      activation_subscription: The Pub/Sub subscription to the activation topic. When set, the application runs as a long-running streaming job
+        that activates the source table of every activation message, and the source_table and activation_type arguments are not used.
+      dry_run_sample_fraction: The share of the users sent in a dry run. When set, the application reads and transforms all the source data,
+        sends the events of a sample of the users to the Measurement Protocol validation server, or to measurement_protocol_endpoint,
+        and reports the projected wall time, requests and cost of the full run instead of logging the events.
+      measurement_protocol_endpoint: The Measurement Protocol endpoint host, such as a local collector for dry runs.
+      activations: A JSON list of objects with the activation_type and source_table of several activations run by a single job,
+        such as the activations coalesced by the activation trigger function. Replaces the source_table and activation_type arguments.
     """
 
     parser.add_argument(
       '--source_table',
       type=str,
-      help='table specification for the source data. Format [dataset.data_table]',
-      required=True
+      help='table specification for the source data. Format [dataset.data_table]. Required unless activation_subscription is set',
+      default=None
     )
     parser.add_argument(
       '--ga4_measurement_id',
@@ -92,10 +228,11 @@ class ActivationOptions(GoogleCloudOptions):
     )
     parser.add_argument(
       '--use_api_validation',
-      type=bool,
+      type=str_to_bool,
       help='Use Measurement Protocol API validation for debugging instead of sending the events',
       default=False,
-      nargs='?'
+      nargs='?',
+      const=True
     )
     parser.add_argument(
       '--activation_type',
@@ -112,8 +249,9 @@ class ActivationOptions(GoogleCloudOptions):
         purchase-propensity-15-7
         churn-propensity-30-15
         lead-score-propensity-5-1
+      Required unless activation_subscription is set.
       ''',
-      required=True
+      default=None
     )
     parser.add_argument(
       '--activation_type_configuration',
@@ -121,378 +259,2625 @@ class ActivationOptions(GoogleCloudOptions):
       help='GCS path to the configuration file all activation types',
       required=True
     )
+    parser.add_argument(
+      '--send_batch_size',
+      type=int,
+      help='''
+      Maximum number of payloads grouped together before sending. Payloads in a group with an identical user
+      envelope (client_id, user_id, timestamp, consent and user properties) are coalesced into multi-event
+      Measurement Protocol requests, so it only reduces the requests of sources with several events per user
+      or with deduplicate_payloads. A value of 1 sends one request per payload.
+      ''',
+      default=1
+    )
+    parser.add_argument(
+      '--log_success_payloads',
+      type=str_to_bool,
+      help='''
+      Log the payloads of the events sent successfully in the activation log table. The payloads of the failed events
+      are always logged. Always enabled with use_api_validation
+      ''',
+      default=False,
+      nargs='?',
+      const=True
+    )
+    parser.add_argument(
+      '--deduplicate_payloads',
+      type=str_to_bool,
+      help='''
+      Merge the payloads of the same client_id and user_id before sending them. The latest inference date is kept
+      and the events of the payloads with compatible user properties are sent in a single request
+      ''',
+      default=False,
+      nargs='?',
+      const=True
+    )
+    parser.add_argument(
+      '--use_async_http',
+      type=str_to_bool,
+      help='''Send the events with the asynchronous HTTP engine, keeping many requests in flight per worker thread.
+      Its open connections are limited by http_pool_size. It does not support use_http2''',
+      default=False,
+      nargs='?',
+      const=True
+    )
+    parser.add_argument(
+      '--max_concurrent_requests',
+      type=int,
+      help='Maximum number of requests in flight per worker thread when using the asynchronous HTTP engine',
+      default=100
+    )
+    parser.add_argument(
+      '--http_pool_size',
+      type=int,
+      help='''Maximum number of pooled keep-alive connections per worker thread. Defaults to 10,
+      or to max_concurrent_requests with the asynchronous HTTP engine''',
+      default=None
+    )
+    parser.add_argument(
+      '--http_connect_timeout',
+      type=float,
+      help='Connect timeout of the requests sent to the Measurement Protocol API, in seconds',
+      default=20
+    )
+    parser.add_argument(
+      '--http_read_timeout',
+      type=float,
+      help='Read timeout of the requests sent to the Measurement Protocol API, in seconds',
+      default=20
+    )
+    parser.add_argument(
+      '--use_http2',
+      type=str_to_bool,
+      help='Send the events over HTTP/2 instead of HTTP/1.1. Rejected together with use_async_http, the asynchronous HTTP engine does not support it',
+      default=False,
+      nargs='?',
+      const=True
+    )
+    parser.add_argument(
+      '--max_requests_per_second',
+      type=float,
+      help='Maximum number of requests per second sent by each worker. The rate adapts down when GA4 throttles. 0 for no limit',
+      default=0
+    )
+    parser.add_argument(
+      '--max_send_retries',
+      type=int,
+      help='Number of times a throttled, failed or timed out request is retried before being logged as failed',
+      default=3
+    )
+    parser.add_argument(
+      '--retry_backoff_seconds',
+      type=float,
+      help='Base delay of the jittered exponential backoff between retries, in seconds',
+      default=1.0
+    )
+    parser.add_argument(
+      '--use_sent_ledger',
+      type=str_to_bool,
+      help='Skip the events already sent by a previous run of the same activation and record the sent events in the sent ledger table',
+      default=False,
+      nargs='?',
+      const=True
+    )
+    parser.add_argument(
+      '--prediction_snapshot',
+      type=str,
+      help='Identifier of the prediction snapshot used to derive the activation run key. Defaults to the last modification time of the source table',
+      default=None
+    )
+    parser.add_argument(
+      '--read_method',
+      type=str,
+      help='''
+      Method used to read the source data from BigQuery, currently supported values are:
+        EXPORT: export the query result to GCS as JSON files and read the files
+        DIRECT_READ: read the query result with the BigQuery Storage Read API
+      ''',
+      choices=[beam.io.ReadFromBigQuery.Method.EXPORT, beam.io.ReadFromBigQuery.Method.DIRECT_READ],
+      default=beam.io.ReadFromBigQuery.Method.EXPORT
+    )
+    parser.add_argument(
+      '--use_arrow_format',
+      type=str_to_bool,
+      help='Read the source data in the Arrow format instead of the Avro format. Only supported with the DIRECT_READ read method',
+      default=False,
+      nargs='?',
+      const=True
+    )
+    parser.add_argument(
+      '--ga4_property_column',
+      type=str,
+      help='''
+      Column of the source data holding the Measurement ID of the GA4 property each row is sent to.
+      Rows without a value are sent to the default GA4 property
+      ''',
+      default=None
+    )
+    parser.add_argument(
+      '--ga4_api_secrets',
+      type=str,
+      help='JSON object mapping the Measurement IDs of additional GA4 properties to their client secrets',
+      default=None
+    )
+    parser.add_argument(
+      '--cache_configuration_in_gcs',
+      type=str_to_bool,
+      help='Cache the compiled activation type configuration in GCS, next to the configuration file, so that the launches reusing an unchanged configuration skip reading and compiling the query templates',
+      default=False,
+      nargs='?',
+      const=True
+    )
+    parser.add_argument(
+      '--activation_subscription',
+      type=str,
+      help='''
+      Pub/Sub subscription to the activation topic, in the format projects/[project]/subscriptions/[subscription].
+      When set, runs a long-running streaming job activating the source table of every activation message
+      ''',
+      default=None
+    )
+    parser.add_argument(
+      '--dry_run_sample_fraction',
+      type=float,
+      help='''
+      Share of the users, between 0 and 1, sent in a dry run. When set, all the source data is read and transformed, the events
+      of a sample of the users are sent to the Measurement Protocol validation server and the cost of the full run is reported
+      ''',
+      default=None
+    )
+    parser.add_argument(
+      '--measurement_protocol_endpoint',
+      type=str,
+      help='Measurement Protocol endpoint host, such as a local collector for dry runs',
+      default=MEASUREMENT_PROTOCOL_ENDPOINT
+    )
+    parser.add_argument(
+      '--activations',
+      type=str,
+      help='''
+      JSON list of objects with the activation_type and source_table of several activations run by a single job.
+      Replaces source_table and activation_type
+      ''',
+      default=None
+    )
 
 
 
 
-def build_query(args, activation_type_configuration):
+def build_query(args, activation_type_configuration, source_table=None):
   """
   Builds the query to be used to retrieve data from the source table.
 
   Args:
     args: The command-line arguments.
     activation_type_configuration: The activation type configuration.
+    source_table: The source table. Defaults to the source_table argument.
 
   Returns:
     The query to be used to retrieve data from the source table.
   """
   return activation_type_configuration['source_query_template'].render(
-    source_table=args.source_table
+    source_table=source_table or args.source_table
   )
 
 
 
 
-def gcs_read_file(project_id, gcs_path):
+def read_from_source(args, query):
   """
-  Reads a file from Google Cloud Storage (GCS).
+  Builds the transform that reads the source data from BigQuery.
+
+  The EXPORT method exports the query result to GCS as JSON files and parses the files again.
+  The DIRECT_READ method streams the query result with the BigQuery Storage Read API in the Avro format, or in
+  the Arrow format if requested, which avoids the export job, the temporary GCS files and the JSON decoding.
 
   Args:
-    project_id: The ID of the Google Cloud project that contains the GCS bucket.
-    gcs_path: The path to the file in GCS, in the format "gs://bucket_name/object_name".
+    args: The command-line arguments.
+    query: The query that retrieves the data from the source table.
 
   Returns:
-    The contents of the file as a string.
+    A ReadFromBigQuery transform.
 
   Raises:
-    ValueError: If the GCS path is invalid.
-    IOError: If an error occurs while reading the file.
+    ValueError: If the Arrow format is requested with the EXPORT read method.
   """
-  # Validate the GCS path.
-  if not gcs_path.startswith("gs://"):
-    raise ValueError("Invalid GCS path: {}".format(gcs_path))
+  if args.read_method == beam.io.ReadFromBigQuery.Method.DIRECT_READ:
+    # The Storage Read API returns Arrow batches only when native datetime objects are requested.
+    return beam.io.ReadFromBigQuery(project=args.project,
+      query=query,
+      method=beam.io.ReadFromBigQuery.Method.DIRECT_READ,
+      use_native_datetime=bool(args.use_arrow_format),
+      use_standard_sql=True)
 
-  # Extract the bucket name and object name from the GCS path.
-  matches = re.match("gs://(.*?)/(.*)", gcs_path)
-  if not matches:
-    raise ValueError("Invalid GCS path: {}".format(gcs_path))
-  bucket_name, blob_name = matches.groups()
+  if args.use_arrow_format:
+    raise ValueError('The Arrow format is only supported with the DIRECT_READ read method')
+  return beam.io.ReadFromBigQuery(project=args.project,
+    query=query,
+    method=beam.io.ReadFromBigQuery.Method.EXPORT,
+    use_json_exports=True,
+    use_standard_sql=True)
 
-  # Create a storage client.
-  storage_client = storage.Client(project=project_id)
-  # Get a reference to the bucket and blob.
-  bucket = storage_client.bucket(bucket_name)
-  blob = bucket.blob(blob_name)
-  # Open the blob for reading.
-  with blob.open("r") as f:
-    return f.read()
 
 
 
+def get_prediction_snapshot(project_id, source_table):
+  """
+  Gets an identifier of the current snapshot of the prediction source table.
 
-class CallMeasurementProtocolAPI(beam.DoFn):
+  Args:
+    project_id: The ID of the Google Cloud project that contains the source table.
+    source_table: The table specification for the source data in the format dataset.data_table.
+
+  Returns:
+    The last modification time of the source table, in ISO format.
   """
-  This class defines a DoFn that sends events to the Google Analytics 4 Measurement Protocol API.
+  client = google_bigquery.Client(project=project_id)
+  return client.get_table(source_table).modified.isoformat()
 
-  The DoFn takes the following arguments:
 
-  - measurement_id: The Measurement ID of the Google Analytics 4 property.
-  - api_secret: The API secret for the Google Analytics 4 property.
-  - debug: A boolean flag indicating whether to use the Measurement Protocol API validation for debugging instead of sending the events.
 
-  The DoFn yields the following output:
 
-  - The event that was sent.
-  - The HTTP status code of the response.
-  - The content of the response.
+def activation_run_key(activation_type, source_table, prediction_snapshot):
   """
-  
+  Derives the key identifying an activation run.
 
-  def __init__(self, measurement_id, api_secret, debug=False):
-    """
-    Initializes the DoFn.
+  Re-running the same activation on the same prediction snapshot yields the same key.
 
-    Args:
-      measurement_id: The Measurement ID of the Google Analytics 4 property.
-      api_secret: The API secret for the Google Analytics 4 property.
-      debug: A boolean flag indicating whether to use the Measurement Protocol API validation for debugging instead of sending the events.
-    """
-    if debug:
-      debug_str = "debug/"
-    else:
-      debug_str = ''
-    self.event_post_url = f"https://www.google-analytics.com/{debug_str}mp/collect?measurement_id={measurement_id}&api_secret={api_secret}"
+  Args:
+    activation_type: The activation use case.
+    source_table: The table specification for the source data in the format dataset.data_table.
+    prediction_snapshot: The identifier of the prediction snapshot.
 
+  Returns:
+    The activation run key.
+  """
+  return hashlib.sha256(f"{activation_type}|{source_table}|{prediction_snapshot}".encode()).hexdigest()[:16]
 
-  def process(self, element):
-    """
-    Sends the event to the Measurement Protocol API.
 
-    Args:
-      element: The event to be sent.
 
-    Yields:
-      The event that was sent.
-      The HTTP status code of the response.
-      The content of the response.
-    """
-    response = requests.post(self.event_post_url, data=json.dumps(element),headers={'content-type': 'application/json'}, timeout=20)
-    yield element, response.status_code, response.content
 
+def ensure_sent_ledger_table(project_id, dataset_id):
+  """
+  Creates the sent ledger table if it does not exist yet.
 
+  The table is partitioned by day on inference_date and clustered by activation_type and client_id,
+  so that checking the events already sent only scans the recent partitions of a single activation type.
 
+  Args:
+    project_id: The ID of the Google Cloud project that contains the log dataset.
+    dataset_id: The ID of the log dataset.
 
-class ToLogFormat(beam.DoFn):
+  Returns:
+    The fully qualified ID of the sent ledger table.
   """
-  This class defines a DoFn that transforms the output of the Measurement Protocol API call into a format suitable for logging.
+  table_id = f"{project_id}.{dataset_id}.{SENT_LEDGER_TABLE}"
+  table = google_bigquery.Table(table_id, schema=[
+    google_bigquery.SchemaField('client_id', 'STRING', mode='REQUIRED'),
+    google_bigquery.SchemaField('activation_type', 'STRING', mode='REQUIRED'),
+    google_bigquery.SchemaField('inference_date', 'TIMESTAMP', mode='REQUIRED'),
+    google_bigquery.SchemaField('activation_run_key', 'STRING', mode='REQUIRED'),
+    google_bigquery.SchemaField('sent_at', 'TIMESTAMP', mode='REQUIRED'),
+  ])
+  table.time_partitioning = google_bigquery.TimePartitioning(
+    type_=google_bigquery.TimePartitioningType.DAY, field='inference_date')
+  table.clustering_fields = ['activation_type', 'client_id']
+  google_bigquery.Client(project=project_id).create_table(table, exists_ok=True)
+  return table_id
 
-  The DoFn takes the following arguments:
 
-  - element: A tuple containing the event that was sent and the HTTP status code of the response.
 
-  The DoFn yields the following output:
 
-  - A dictionary containing the following fields:
-    - id: A unique identifier for the log entry.
-    - activation_id: The ID of the activation event.
-    - payload: The JSON payload of the event that was sent.
-    - latest_state: The latest state of the event, which can be either "SEND_OK" or "SEND_FAIL".
-    - updated_at: The timestamp when the log entry was created.
+def find_sent_ledger_table(project_id, dataset_id):
   """
+  Looks the sent ledger table up without creating it.
 
-  def process(self, element):
-    """
-    Transforms the output of the Measurement Protocol API call into a format suitable for logging.
+  Args:
+    project_id: The ID of the Google Cloud project that contains the log dataset.
+    dataset_id: The ID of the log dataset.
 
-    Args:
-      element: A tuple containing the event that was sent and the HTTP status code of the response.
+  Returns:
+    The fully qualified ID of the sent ledger table, or None if the table does not exist yet.
+  """
+  table_id = f"{project_id}.{dataset_id}.{SENT_LEDGER_TABLE}"
+  try:
+    google_bigquery.Client(project=project_id).get_table(table_id)
+  except google_exceptions.NotFound:
+    return None
+  return table_id
 
-    Yields:
-      A dictionary containing the following fields:
-        - id: A unique identifier for the log entry.
-        - activation_id: The ID of the activation event.
-        - payload: The JSON payload of the event that was sent.
-        - latest_state: The latest state of the event, which can be either "SEND_OK" or "SEND_FAIL".
-        - updated_at: The timestamp when the log entry was created.
-    """
-    time_cast = datetime.datetime.now(tz=datetime.timezone.utc)
 
-    if element[1] == requests.status_codes.codes.NO_CONTENT:
-      state_msg = 'SEND_OK'
-    else:
-      state_msg = 'SEND_FAIL'
 
-    result = {}
-    try:
-      result = {
-        'id': str(uuid.uuid4()),
-        'activation_id': element[0]['events'][0]['name'],
-        'payload': json.dumps(element[0]),
-        'latest_state': f"{state_msg} {element[1]}",
-        'updated_at': str(time_cast)
-      }
-    except KeyError as e:
-      logging.error(element)
-      result = {
-        'id': str(uuid.uuid4()),
-        'activation_id': "",
-        'payload': json.dumps(element[0]),
-        'latest_state': f"{state_msg} {element[1]}",
-        'updated_at': str(time_cast)
-      }
-      logging.error(traceback.format_exc())
-    yield result
 
+def ensure_activation_log_table(project_id, dataset_id):
+  """
+  Creates the activation log table if it does not exist yet.
+
+  All the activation runs append to this single table, partitioned by day on updated_at and clustered by activation_id,
+  instead of creating a success and a failure log table per run.
 
+  Tables created before the payload column became optional or before the clustering was added are updated in place.
 
+  Args:
+    project_id: The ID of the Google Cloud project that contains the log dataset.
+    dataset_id: The ID of the log dataset.
 
-class DecimalEncoder(json.JSONEncoder):
+  Returns:
+    The fully qualified ID of the activation log table.
   """
-  This class defines a custom JSON encoder that handles Decimal objects correctly.
+  table_id = f"{project_id}.{dataset_id}.{ACTIVATION_LOG_TABLE}"
+  schema = [
+    google_bigquery.SchemaField(field['name'], field['type'], mode=field['mode']) for field in ACTIVATION_LOG_SCHEMA['fields']
+  ]
+  table = google_bigquery.Table(table_id, schema=schema)
+  table.time_partitioning = google_bigquery.TimePartitioning(
+    type_=google_bigquery.TimePartitioningType.DAY, field='updated_at')
+  table.clustering_fields = ACTIVATION_LOG_CLUSTERING_FIELDS
+  client = google_bigquery.Client(project=project_id)
+  table = client.create_table(table, exists_ok=True)
 
-  The DecimalEncoder class inherits from the `json.JSONEncoder` class and overrides the `default` method to handle Decimal objects. 
-  The `default` method is called for objects that are not of a basic type (string, number, boolean, None, list, tuple, dictionary). 
-  The DecimalEncoder class checks if the object is a Decimal object and, if so, returns its value as a float. 
-  Otherwise, it calls the parent class's `default` method to handle the object.
+  # Relaxing a REQUIRED column to NULLABLE and changing the clustering are allowed on existing tables.
+  modes = {field.name: field.mode for field in table.schema}
+  if table.clustering_fields != ACTIVATION_LOG_CLUSTERING_FIELDS or any(modes.get(field.name) != field.mode for field in schema):
+    table.schema = schema
+    table.clustering_fields = ACTIVATION_LOG_CLUSTERING_FIELDS
+    client.update_table(table, ['schema', 'clustering_fields'])
+  return table_id
 
-  The DecimalEncoder class is used to ensure that Decimal objects are encoded as floats when they are converted to JSON. 
-  This is important because Decimal objects cannot be directly encoded as JSON strings.
-  """
 
-  def default(self, obj):
-    """
-    Handles the encoding of Decimal objects.
 
-    Args:
-      obj: The object to be encoded.
 
-    Returns:
-      The JSON representation of the object.
-    """
-    if isinstance(obj, Decimal):
-      return float(obj)
-    return json.JSONEncoder.default(self, obj)
+def exclude_already_sent(query, ledger_table_id, activation_type, include_superseded=False):
+  """
+  Wraps the source query to exclude the events already recorded in the sent ledger.
 
+  The ledger records the client_id values sanitized by TransformToPayload, so the client_id of the source is sanitized
+  with the same pattern before joining. ReadFromBigQuery does not take query parameters, so the activation type is
+  checked against ACTIVATION_TYPE_PATTERN before it is written in the query.
 
+  Args:
+    query: The query retrieving the data from the source table.
+    ledger_table_id: The fully qualified ID of the sent ledger table.
+    activation_type: The activation use case.
+    include_superseded: A boolean flag indicating whether to also exclude the events older than an event already sent to
+      the same client_id, which the payload deduplication merges into the latest event instead of recording them.
 
+  Returns:
+    The query retrieving only the events not sent yet.
 
-class TransformToPayload(beam.DoFn):
+  Raises:
+    ValueError: If the activation type holds other characters than letters, digits, underscores and hyphens.
+  """
+  if not ACTIVATION_TYPE_PATTERN.fullmatch(activation_type):
+    raise ValueError(f"Invalid activation type {activation_type!r}, only letters, digits, underscores and hyphens are allowed")
+  inference_date_condition = '>=' if include_superseded else '='
+  return f"""
+    SELECT source.* FROM ({query}) AS source
+    LEFT JOIN (
+      SELECT client_id, inference_date FROM `{ledger_table_id}`
+      WHERE activation_type = '{activation_type}'
+      AND inference_date >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL {SENT_LEDGER_LOOKBACK_DAYS} DAY)
+    ) AS ledger
+    ON ledger.client_id = REGEXP_REPLACE(source.client_id, r'{CLIENT_ID_SANITIZER.pattern}', '')
+    AND ledger.inference_date {inference_date_condition} source.inference_date
+    WHERE ledger.client_id IS NULL
   """
-  This class defines a DoFn that transforms the output of the inference pipeline into a format suitable for sending to the Google Analytics 4 Measurement Protocol API.
 
-  The DoFn takes the following arguments:
 
-  - event_name: The name of the event to be sent to Google Analytics 4.
 
-  The DoFn yields the following output:
 
-  - A dictionary containing the Measurement Protocol payload.
+def parse_gcs_path(gcs_path):
+  """
+  Splits a Google Cloud Storage (GCS) path into its bucket name and object name.
 
-  The DoFn performs the following steps:
-  1. Removes bad shaping strings in the `client_id` field.
-  2. Converts the rendered template string into a JSON object.
-  4. Handles any JSON decoding errors.
+  Args:
+    gcs_path: The path to the file in GCS, in the format "gs://bucket_name/object_name".
 
-  The DoFn is used to ensure that the Measurement Protocol payload is formatted correctly before being sent to Google Analytics 4.
+  Returns:
+    A tuple containing the bucket name and the object name.
+
+  Raises:
+    ValueError: If the GCS path is invalid.
   """
-  def __init__(self, event_name):
-    """
-    Initializes the DoFn.
+  # Validate the GCS path.
+  if not gcs_path.startswith("gs://"):
+    raise ValueError("Invalid GCS path: {}".format(gcs_path))
 
-    Args:
-      event_name: The name of the event to be sent to Google Analytics 4.
-    """
-    self.date_format = "%Y-%m-%d"
-    self.date_time_format = "%Y-%m-%d %H:%M:%S.%f %Z"
-    self.event_name = event_name
-    self.consent_obj = {
-      'ad_user_data':'GRANTED',
-      'ad_personalization':'GRANTED'
-    }
-    self.user_property_prefix = 'user_prop_'
-    self.event_parameter_prefix = 'event_param_'
+  # Extract the bucket name and object name from the GCS path.
+  matches = re.match("gs://(.*?)/(.*)", gcs_path)
+  if not matches:
+    raise ValueError("Invalid GCS path: {}".format(gcs_path))
+  return matches.groups()
 
 
-  def process(self, element):
-    """
-    Transforms the output of the inference pipeline into a format suitable for sending to the Google Analytics 4 Measurement Protocol API.
 
-    Args:
-      element: A dictionary containing the output of the inference pipeline.
 
-    Yields:
-      A dictionary containing the Measurement Protocol payload.
-    """
+def gcs_content_hashes(project_id, gcs_paths):
+  """
+  Fetches the content hashes of Google Cloud Storage (GCS) files without downloading them.
+
+  The folders of the files are listed instead of fetching every file, so that the configuration file
+  and the query templates stored next to it are fingerprinted with a single request.
+
+  Args:
+    project_id: The ID of the Google Cloud project that contains the GCS buckets.
+    gcs_paths: The paths to the files in GCS.
+
+  Returns:
+    A dictionary mapping the path of every file of the listed folders to the hex digest of its content hash.
+  """
+  storage_client = storage.Client(project=project_id)
+  folders = set()
+  for gcs_path in gcs_paths:
+    bucket_name, blob_name = parse_gcs_path(gcs_path)
+    folders.add((bucket_name, blob_name.rpartition('/')[0]))
+
+  hashes = {}
+  for bucket_name, folder in folders:
+    for blob in storage_client.list_blobs(bucket_name, prefix=f"{folder}/" if folder else None, delimiter='/'):
+      # Composite objects have no MD5 hash, only a CRC32C checksum.
+      content_hash = blob.md5_hash or blob.crc32c
+      if content_hash:
+        hashes[f"gs://{bucket_name}/{blob.name}"] = base64.b64decode(content_hash).hex()
+  return hashes
+
+
+
+
+def build_compiled_configuration(project_id, configuration_path, hashes, activation_type=None):
+  """
+  Reads the activation type configuration and its query templates from GCS and compiles the templates.
+
+  Args:
+    project_id: The ID of the Google Cloud project that contains the GCS bucket.
+    configuration_path: The GCS path to the configuration file for all activation types.
+    hashes: The content hashes of the files already listed, by path.
+    activation_type: The activation type whose query template is compiled. Defaults to all the activation types.
+
+  Returns:
+    A cache entry containing the parsed configuration and, for every query template compiled, its content hash,
+    its source and the Python code compiled from it by Jinja.
+  """
+  environment = Environment(loader=BaseLoader)
+  configuration = json.loads(gcs_read_file(project_id, configuration_path))
+
+  activation_configs = [configuration[activation_type]] if activation_type else configuration.values()
+  template_paths = sorted({activation_config['source_query_template'] for activation_config in activation_configs})
+  missing_paths = [template_path for template_path in template_paths if template_path not in hashes]
+  if missing_paths:
+    hashes = dict(hashes, **gcs_content_hashes(project_id, missing_paths))
+
+  templates = {}
+  for template_path in template_paths:
+    source = gcs_read_file(project_id, template_path).replace('\n', ' ')
+    templates[template_path] = {
+      'hash': hashes.get(template_path),
+      'source': source,
+      'code': environment.compile(source, raw=True)
+    }
+  return {'configuration': configuration, 'templates': templates}
+
+
+
+
+def load_compiled_configuration(project_id, configuration_path, use_gcs_cache=False, activation_type=None):
+  """
+  Loads the activation type configuration with its query templates compiled, from the first cache holding it.
+
+  The cache entries are keyed by the content hash of the configuration file, the activation type and the Jinja
+  version which compiled the templates, and checked against the content hashes of the query templates, so an
+  unchanged configuration is neither read again nor compiled again. The entries are looked up in memory, then
+  in a local folder and then, optionally, in GCS next to the configuration file.
+
+  Args:
+    project_id: The ID of the Google Cloud project that contains the GCS bucket.
+    configuration_path: The GCS path to the configuration file for all activation types.
+    use_gcs_cache: A boolean flag indicating whether to cache the compiled configuration in GCS.
+    activation_type: The activation type whose query template is compiled. Defaults to all the activation types.
+
+  Returns:
+    A tuple containing the cache entry of the configuration and the compiled Jinja templates, by path.
+
+  Raises:
+    IOError: If the configuration file does not exist.
+  """
+  hashes = gcs_content_hashes(project_id, [configuration_path])
+  configuration_hash = hashes.get(configuration_path)
+  if configuration_hash is None:
+    raise IOError(f"Activation type configuration not found: {configuration_path}")
+  cache_key = hashlib.sha256(json.dumps([configuration_hash, activation_type, jinja2.__version__]).encode()).hexdigest()
+  local_path = os.path.join(CONFIGURATION_CACHE_DIR, f"{cache_key}.json")
+  bucket_name, blob_name = parse_gcs_path(configuration_path)
+  cache_blob = storage.Client(project=project_id).bucket(bucket_name).blob(
+    f"{blob_name.rpartition('/')[0]}/{CONFIGURATION_CACHE_FOLDER}/{cache_key}.json".lstrip('/'))
+
+  def is_valid(entry):
+    missing_paths = [template_path for template_path in entry['templates'] if template_path not in hashes]
+    if missing_paths:
+      hashes.update(gcs_content_hashes(project_id, missing_paths))
+    return all(hashes.get(template_path) == template['hash'] for template_path, template in entry['templates'].items())
+
+  cached = _CONFIGURATION_CACHE.get(cache_key)
+  if cached is not None and is_valid(cached[0]):
+    return cached
+
+  entry = None
+  if os.path.exists(local_path):
+    with open(local_path) as f:
+      entry = json.load(f)
+  if entry is None or not is_valid(entry):
+    entry = None
+    if use_gcs_cache:
+      # A single download request, a missing entry is compiled below.
+      try:
+        entry = json.loads(cache_blob.download_as_text())
+      except google_exceptions.NotFound:
+        pass
+    if entry is None or not is_valid(entry):
+      logging.info(f"Compiling activation type configuration {configuration_path}")
+      entry = build_compiled_configuration(project_id, configuration_path, hashes, activation_type)
+      if use_gcs_cache:
+        cache_blob.upload_from_string(json.dumps(entry), content_type='application/json')
+
+    # Store the entry locally, written to a temporary file first so that concurrent launches never read a partial entry.
+    os.makedirs(CONFIGURATION_CACHE_DIR, exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', dir=CONFIGURATION_CACHE_DIR, delete=False) as f:
+      json.dump(entry, f)
+    os.replace(f.name, local_path)
+
+  # Load the compiled code, which skips parsing the templates again.
+  environment = Environment(loader=BaseLoader)
+  templates = {
+    template_path: environment.template_class.from_code(environment, compile(template['code'], template_path, 'exec'), environment.make_globals(None))
+    for template_path, template in entry['templates'].items()
+  }
+  _CONFIGURATION_CACHE[cache_key] = (entry, templates)
+  return entry, templates
+
+
+
+
+def gcs_read_file(project_id, gcs_path):
+  """
+  Reads a file from Google Cloud Storage (GCS).
+
+  Args:
+    project_id: The ID of the Google Cloud project that contains the GCS bucket.
+    gcs_path: The path to the file in GCS, in the format "gs://bucket_name/object_name".
+
+  Returns:
+    The contents of the file as a string.
+
+  Raises:
+    ValueError: If the GCS path is invalid.
+    IOError: If an error occurs while reading the file.
+  """
+  bucket_name, blob_name = parse_gcs_path(gcs_path)
+
+  # Create a storage client.
+  storage_client = storage.Client(project=project_id)
+  # Get a reference to the bucket and blob.
+  bucket = storage_client.bucket(bucket_name)
+  blob = bucket.blob(blob_name)
+  # Open the blob for reading.
+  with blob.open("r") as f:
+    return f.read()
+
+
+
+
+class TokenBucketRateLimiter:
+  """
+  This class defines an adaptive token bucket rate limiter shared by the threads of a worker.
+
+  The rate limiter takes the following arguments:
+
+  - rate: The maximum number of requests per second.
+
+  Every request reserves a token and waits until the bucket refills if no token is left.
+  The rate is halved every time the Measurement Protocol throttles a request, down to 1/16th
+  of the maximum rate, and grows back additively on every successful request.
+  """
+
+  _registry = {}
+  _registry_lock = threading.Lock()
+
+  def __init__(self, rate):
+    """
+    Initializes the rate limiter.
+
+    Args:
+      rate: The maximum number of requests per second.
+    """
+    self.max_rate = rate
+    self.rate = rate
+    self.capacity = max(1.0, rate)
+    self.tokens = self.capacity
+    self.updated_at = time.monotonic()
+    self._lock = threading.Lock()
+
+
+  @classmethod
+  def shared(cls, key, rate):
+    """
+    Returns the rate limiter shared by all the threads of the worker for a key.
+
+    Args:
+      key: The key identifying the rate limiter, such as the Measurement ID.
+      rate: The maximum number of requests per second.
+
+    Returns:
+      The shared rate limiter.
+    """
+    with cls._registry_lock:
+      if key not in cls._registry:
+        cls._registry[key] = cls(rate)
+      return cls._registry[key]
+
+
+  def reserve(self):
+    """
+    Reserves a token.
+
+    Returns:
+      The number of seconds to wait before sending the request.
+    """
+    with self._lock:
+      now = time.monotonic()
+      self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+      self.updated_at = now
+      self.tokens -= 1
+      if self.tokens >= 0:
+        return 0.0
+      return -self.tokens / self.rate
+
+
+  def throttle(self):
+    """
+    Decreases the rate after the Measurement Protocol throttled a request.
+    """
+    with self._lock:
+      self.rate = max(self.max_rate / 16, self.rate / 2)
+
+
+  def recover(self):
+    """
+    Increases the rate back towards the maximum after a successful request.
+    """
+    with self._lock:
+      self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+
+
+
+
+class CallMeasurementProtocolAPI(beam.DoFn):
+  """
+  This class defines a DoFn that sends events to the Google Analytics 4 Measurement Protocol API.
+
+  The DoFn takes the following arguments:
+
+  - measurement_id: The Measurement ID of the Google Analytics 4 property.
+  - api_secret: The API secret for the Google Analytics 4 property.
+  - debug: A boolean flag indicating whether to use the Measurement Protocol API validation for debugging instead of sending the events.
+  - endpoint: The Measurement Protocol endpoint host.
+  - pool_size: The maximum number of pooled keep-alive connections.
+  - connect_timeout: The connect timeout of the requests, in seconds.
+  - read_timeout: The read timeout of the requests, in seconds.
+  - use_http2: A boolean flag indicating whether to send the events over HTTP/2.
+  - max_requests_per_second: The maximum number of requests per second sent by the worker, 0 for no limit.
+  - max_retries: The number of times a throttled, failed or timed out request is retried.
+  - retry_backoff: The base delay of the jittered exponential backoff between retries, in seconds.
+
+  The DoFn creates one persistent HTTP session in `setup()`, so that the connections to the Measurement Protocol
+  endpoint are kept alive and reused across events, and closes it in `teardown()`.
+
+  Requests answered with a retryable status code, or without a response, are retried with a jittered exponential
+  backoff. Only the requests still failing once the retry budget is used up are yielded with their last status code.
+
+  The DoFn reports the request latency, the request size, the serialization time and one `status_<code>` counter
+  per status code received, retries included, in the `activation` metrics namespace.
+
+  The DoFn yields the following output:
+
+  - The event that was sent.
+  - The HTTP status code of the response.
+  - The content of the response.
+  - The serialized event, so that the log reuses it instead of serializing the event again.
+  """
+  
+
+  def __init__(self, measurement_id, api_secret, debug=False, endpoint=MEASUREMENT_PROTOCOL_ENDPOINT,
+               pool_size=DEFAULT_HTTP_POOL_SIZE, connect_timeout=20, read_timeout=20, use_http2=False,
+               max_requests_per_second=0, max_retries=3, retry_backoff=1.0):
+    """
+    Initializes the DoFn.
+
+    Args:
+      measurement_id: The Measurement ID of the Google Analytics 4 property.
+      api_secret: The API secret for the Google Analytics 4 property.
+      debug: A boolean flag indicating whether to use the Measurement Protocol API validation for debugging instead of sending the events.
+      endpoint: The Measurement Protocol endpoint host.
+      pool_size: The maximum number of pooled keep-alive connections.
+      connect_timeout: The connect timeout of the requests, in seconds.
+      read_timeout: The read timeout of the requests, in seconds.
+      use_http2: A boolean flag indicating whether to send the events over HTTP/2.
+      max_requests_per_second: The maximum number of requests per second sent by the worker, 0 for no limit.
+      max_retries: The number of times a throttled, failed or timed out request is retried.
+      retry_backoff: The base delay of the jittered exponential backoff between retries, in seconds.
+    """
+    self.measurement_id = measurement_id
+    if debug:
+      debug_str = "debug/"
+    else:
+      debug_str = ''
+    self.event_post_url = f"{endpoint}/{debug_str}mp/collect?measurement_id={measurement_id}&api_secret={api_secret}"
+    self.pool_size = pool_size
+    self.connect_timeout = connect_timeout
+    self.read_timeout = read_timeout
+    self.use_http2 = use_http2
+    self.max_requests_per_second = max_requests_per_second
+    self.max_retries = max_retries
+    self.retry_backoff = retry_backoff
+    self.throttled_requests = Metrics.counter('activation', 'throttled_requests')
+    self.retried_requests = Metrics.counter('activation', 'retried_requests')
+    self.retry_budget_exhausted = Metrics.counter('activation', 'retry_budget_exhausted')
+    self.rate_limiter_wait_ms = Metrics.distribution('activation', 'rate_limiter_wait_ms')
+    self.rate_limit = Metrics.gauge('activation', 'rate_limit')
+    self.request_latency_ms = Metrics.distribution('activation', 'request_latency_ms')
+    self.request_bytes = Metrics.distribution('activation', 'request_bytes')
+    self.serialization_time_us = Metrics.distribution('activation', 'serialization_time_us')
+
+
+  def setup(self):
+    """
+    Creates the persistent HTTP session and attaches the shared rate limiter.
+    """
+    self._status_counters = {}
+    if self.use_http2:
+      # httpx is only required when HTTP/2 is enabled.
+      import httpx
+
+      self._session = httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+        timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout))
+      self._transport_errors = (httpx.TransportError,)
+    else:
+      adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+      self._session = requests.Session()
+      self._session.mount('https://', adapter)
+      self._session.mount('http://', adapter)
+      self._transport_errors = (requests.exceptions.RequestException,)
+    self._rate_limiter = None
+    if self.max_requests_per_second > 0:
+      self._rate_limiter = TokenBucketRateLimiter.shared(self.measurement_id, self.max_requests_per_second)
+
+
+  def rate_limit_delay(self):
+    """
+    Reserves a token from the shared rate limiter.
+
+    Returns:
+      The number of seconds to wait before sending the request.
+    """
+    if self._rate_limiter is None:
+      return 0.0
+    delay = self._rate_limiter.reserve()
+    self.rate_limiter_wait_ms.update(int(delay * 1000))
+    self.rate_limit.set(int(self._rate_limiter.rate))
+    return delay
+
+
+  def serialize(self, element):
+    """
+    Serializes an event and records its size and serialization time.
+
+    Args:
+      element: The event to be sent.
+
+    Returns:
+      The JSON bytes of the event.
+    """
+    started = time.perf_counter()
+    body = serialize_payload(element)
+    self.serialization_time_us.update(int((time.perf_counter() - started) * 1000000))
+    self.request_bytes.update(len(body))
+    return body
+
+
+  def status_counter(self, status_code):
+    """
+    Returns the counter of the responses with a status code.
+
+    Args:
+      status_code: The HTTP status code of the response, or NO_RESPONSE_STATUS_CODE.
+
+    Returns:
+      The Beam counter.
+    """
+    counter = self._status_counters.get(status_code)
+    if counter is None:
+      counter = self._status_counters[status_code] = Metrics.counter('activation', f"status_{status_code}")
+    return counter
+
+
+  def record_response(self, status_code, started):
+    """
+    Records the latency and the status code of a request.
+
+    Args:
+      status_code: The HTTP status code of the response, or NO_RESPONSE_STATUS_CODE.
+      started: The performance counter value when the request was sent.
+    """
+    self.request_latency_ms.update(int((time.perf_counter() - started) * 1000))
+    self.status_counter(status_code).inc()
+
+
+  def retry_delay(self, status_code, attempt):
+    """
+    Decides whether a request is retried and records the throttling metrics.
+
+    Args:
+      status_code: The HTTP status code of the response, or NO_RESPONSE_STATUS_CODE.
+      attempt: The number of retries already made for the request.
+
+    Returns:
+      The number of seconds to wait before retrying the request, or None if the request must not be retried.
+    """
+    if status_code == requests.status_codes.codes.TOO_MANY_REQUESTS:
+      self.throttled_requests.inc()
+      if self._rate_limiter is not None:
+        self._rate_limiter.throttle()
+    elif self._rate_limiter is not None and status_code not in RETRYABLE_STATUS_CODES and status_code != NO_RESPONSE_STATUS_CODE:
+      self._rate_limiter.recover()
+
+    if status_code not in RETRYABLE_STATUS_CODES and status_code != NO_RESPONSE_STATUS_CODE:
+      return None
+    if attempt >= self.max_retries:
+      self.retry_budget_exhausted.inc()
+      return None
+    self.retried_requests.inc()
+    return random.uniform(0, self.retry_backoff * 2 ** attempt)
+
+
+  def teardown(self):
+    """
+    Closes the persistent HTTP session.
+    """
+    self._session.close()
+
+
+  def post(self, body):
+    """
+    Posts a request body to the Measurement Protocol API over the persistent HTTP session.
+
+    Args:
+      body: The serialized payload to be sent.
+
+    Returns:
+      The HTTP response.
+    """
+    if self.use_http2:
+      return self._session.post(self.event_post_url, content=body, headers={'content-type': 'application/json'})
+    return self._session.post(self.event_post_url, data=body, headers={'content-type': 'application/json'},
+                              timeout=(self.connect_timeout, self.read_timeout))
+
+
+  def process(self, element):
+    """
+    Sends the event to the Measurement Protocol API.
+
+    Args:
+      element: The event to be sent.
+
+    Yields:
+      The event that was sent.
+      The HTTP status code of the response.
+      The content of the response.
+      The serialized event, reused by the log.
+    """
+    body = self.serialize(element)
+    status_code, content = self.send(body)
+    yield element, status_code, content, body
+
+
+  def send(self, body):
+    """
+    Sends a request body with rate limiting and retries.
+
+    Args:
+      body: The serialized payload to be sent.
+
+    Returns:
+      The HTTP status code and the content of the last response.
+    """
+    attempt = 0
+    while True:
+      time.sleep(self.rate_limit_delay())
+      started = time.perf_counter()
+      try:
+        response = self.post(body)
+        status_code, content = response.status_code, response.content
+      except self._transport_errors as e:
+        status_code, content = NO_RESPONSE_STATUS_CODE, str(e).encode()
+      self.record_response(status_code, started)
+
+      delay = self.retry_delay(status_code, attempt)
+      if delay is None:
+        return status_code, content
+      time.sleep(delay)
+      attempt += 1
+
+
+
+
+class _DeferredMetric:
+  """
+  Records the updates of a Beam metric made outside of the bundle thread.
+
+  Beam metrics are scoped to the thread processing the bundle, so the updates made on another thread
+  are queued and applied later from the bundle thread.
+  """
+
+  def __init__(self, metric, updates):
+    """
+    Initializes the deferred metric.
+
+    Args:
+      metric: The Beam counter or distribution.
+      updates: The queue of pending metric updates.
+    """
+    self._metric = metric
+    self._updates = updates
+
+
+  def inc(self, n=1):
+    self._updates.append((self._metric.inc, n))
+
+
+  def update(self, value):
+    self._updates.append((self._metric.update, value))
+
+
+  def set(self, value):
+    self._updates.append((self._metric.set, value))
+
+
+
+
+class AsyncCallMeasurementProtocolAPI(CallMeasurementProtocolAPI):
+  """
+  This class defines a DoFn that sends events to the Google Analytics 4 Measurement Protocol API asynchronously.
+
+  The DoFn takes the same arguments as CallMeasurementProtocolAPI and the following one:
+
+  - max_concurrent_requests: The maximum number of requests in flight per DoFn instance.
+
+  The pool_size argument limits the connections opened by the session, HTTP/2 is not supported.
+
+  An aiohttp session runs on an event loop owned by the DoFn. It is created in `setup()`,
+  requests are submitted to it in `process()` and the bundle is drained in `finish_bundle()`,
+  so each worker thread keeps up to `max_concurrent_requests` requests in flight instead of
+  waiting on the network for every event.
+
+  The DoFn yields the same output as CallMeasurementProtocolAPI.
+  """
+
+  def __init__(self, measurement_id, api_secret, debug=False, endpoint=MEASUREMENT_PROTOCOL_ENDPOINT,
+               connect_timeout=20, read_timeout=20, max_requests_per_second=0, max_retries=3, retry_backoff=1.0,
+               max_concurrent_requests=100, pool_size=None):
+    """
+    Initializes the DoFn.
+
+    Args:
+      measurement_id: The Measurement ID of the Google Analytics 4 property.
+      api_secret: The API secret for the Google Analytics 4 property.
+      debug: A boolean flag indicating whether to use the Measurement Protocol API validation for debugging instead of sending the events.
+      endpoint: The Measurement Protocol endpoint host.
+      connect_timeout: The connect timeout of the requests, in seconds.
+      read_timeout: The read timeout of the requests, in seconds.
+      max_requests_per_second: The maximum number of requests per second sent by the worker, 0 for no limit.
+      max_retries: The number of times a throttled, failed or timed out request is retried.
+      retry_backoff: The base delay of the jittered exponential backoff between retries, in seconds.
+      max_concurrent_requests: The maximum number of requests in flight per DoFn instance.
+      pool_size: The maximum number of connections opened by the DoFn instance. Defaults to max_concurrent_requests.
+    """
+    super().__init__(measurement_id, api_secret, debug=debug, endpoint=endpoint, pool_size=pool_size or max_concurrent_requests,
+                     connect_timeout=connect_timeout, read_timeout=read_timeout,
+                     max_requests_per_second=max_requests_per_second, max_retries=max_retries, retry_backoff=retry_backoff)
+    self.max_concurrent_requests = max_concurrent_requests
+
+
+  def setup(self):
+    """
+    Starts the event loop, creates the HTTP session and attaches the shared rate limiter.
+    """
+    self._loop = asyncio.new_event_loop()
+    self._loop_thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+    self._loop_thread.start()
+    self._session = asyncio.run_coroutine_threadsafe(self._create_session(), self._loop).result()
+    # The retries and the rate limiting happen on the event loop thread, so their metrics are applied from the bundle thread.
+    self._metric_updates = collections.deque()
+    self._status_counters = {}
+    for name in ('throttled_requests', 'retried_requests', 'retry_budget_exhausted', 'rate_limiter_wait_ms', 'rate_limit',
+                 'request_latency_ms', 'request_bytes', 'serialization_time_us'):
+      setattr(self, name, _DeferredMetric(getattr(self, name), self._metric_updates))
+    self._rate_limiter = None
+    if self.max_requests_per_second > 0:
+      self._rate_limiter = TokenBucketRateLimiter.shared(self.measurement_id, self.max_requests_per_second)
+
+
+  async def _create_session(self):
+    """
+    Creates the HTTP session and the concurrency limit on the event loop.
+
+    Returns:
+      The aiohttp client session.
+    """
+    # aiohttp is only required when the asynchronous HTTP engine is enabled.
+    import aiohttp
+
+    self._semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+    self._transport_errors = (aiohttp.ClientError, asyncio.TimeoutError)
+    return aiohttp.ClientSession(
+      connector=aiohttp.TCPConnector(limit=self.pool_size),
+      timeout=aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout))
+
+
+  def status_counter(self, status_code):
+    """
+    Returns the counter of the responses with a status code, applied from the bundle thread.
+
+    Args:
+      status_code: The HTTP status code of the response, or NO_RESPONSE_STATUS_CODE.
+
+    Returns:
+      The deferred Beam counter.
+    """
+    return _DeferredMetric(super().status_counter(status_code), self._metric_updates)
+
+
+  async def _post(self, element):
+    """
+    Sends the event to the Measurement Protocol API with rate limiting and retries.
+
+    Args:
+      element: The event to be sent.
+
+    Returns:
+      The event that was sent, the HTTP status code, the content of the last response and the serialized event.
+    """
+    body = self.serialize(element)
+    attempt = 0
+    while True:
+      await asyncio.sleep(self.rate_limit_delay())
+      try:
+        async with self._semaphore:
+          started = time.perf_counter()
+          async with self._session.post(self.event_post_url, data=body, headers={'content-type': 'application/json'}) as response:
+            status_code, content = response.status, await response.read()
+      except self._transport_errors as e:
+        status_code, content = NO_RESPONSE_STATUS_CODE, str(e).encode()
+      self.record_response(status_code, started)
+
+      delay = self.retry_delay(status_code, attempt)
+      if delay is None:
+        return element, status_code, content, body
+      await asyncio.sleep(delay)
+      attempt += 1
+
+
+  def start_bundle(self):
+    """
+    Resets the requests in flight.
+    """
+    self._pending = []
+
+
+  def process(self, element, window=beam.DoFn.WindowParam, timestamp=beam.DoFn.TimestampParam):
+    """
+    Submits the event to the Measurement Protocol API and yields the responses that already completed.
+
+    Args:
+      element: The event to be sent.
+
+    Yields:
+      The event that was sent.
+      The HTTP status code of the response.
+      The content of the response.
+      The serialized event, reused by the log.
+    """
+    future = asyncio.run_coroutine_threadsafe(self._post(element), self._loop)
+    self._pending.append((future, window, timestamp))
+
+    # Wait for the oldest request once twice the concurrency limit is queued, to bound memory.
+    if len(self._pending) >= 2 * self.max_concurrent_requests:
+      self._pending[0][0].result()
+
+    still_pending = []
+    for pending in self._pending:
+      if pending[0].done():
+        yield self._to_windowed_value(*pending)
+      else:
+        still_pending.append(pending)
+    self._pending = still_pending
+    self._apply_metric_updates()
+
+
+  def finish_bundle(self):
+    """
+    Waits for all the requests of the bundle to complete.
+
+    Yields:
+      The windowed responses of the requests still in flight.
+    """
+    for pending in self._pending:
+      yield self._to_windowed_value(*pending)
+    self._pending = []
+    self._apply_metric_updates()
+
+
+  def _apply_metric_updates(self):
+    """
+    Applies the metric updates made on the event loop thread.
+    """
+    while self._metric_updates:
+      update, value = self._metric_updates.popleft()
+      update(value)
+
+
+  def teardown(self):
+    """
+    Closes the HTTP session and stops the event loop.
+    """
+    asyncio.run_coroutine_threadsafe(self._session.close(), self._loop).result()
+    self._loop.call_soon_threadsafe(self._loop.stop)
+    self._loop_thread.join()
+    self._loop.close()
+
+
+  def _to_windowed_value(self, future, window, timestamp):
+    """
+    Wraps the result of a request into the window of the element that was sent.
+
+    Args:
+      future: The future of the request.
+      window: The window of the element that was sent.
+      timestamp: The timestamp of the element that was sent.
+
+    Returns:
+      The windowed response.
+    """
+    return WindowedValue(future.result(), timestamp, [window])
+
+
+
+
+def payload_envelope_key(payload):
+  """
+  Computes the key identifying the user envelope of a Measurement Protocol payload.
+
+  Two payloads with the same envelope key only differ in their events and can be sent as a single multi-event request.
+
+  Args:
+    payload: The Measurement Protocol payload.
+
+  Returns:
+    A string representation of every payload field except the events.
+  """
+  return json.dumps({k: v for k, v in payload.items() if k != 'events'}, sort_keys=True, cls=DecimalEncoder)
+
+
+
+
+class CoalescePayloads(beam.DoFn):
+  """
+  This class defines a DoFn that coalesces a batch of Measurement Protocol payloads into multi-event requests.
+
+  The DoFn takes the following arguments:
+
+  - max_events_per_request: The maximum number of events sent in a single request.
+
+  The DoFn yields the following output:
+
+  - A Measurement Protocol payload holding the events of all the payloads in the batch that share the same user envelope.
+
+  The Measurement Protocol does not accept several users in a single request, so only the payloads of the same user
+  (same client_id, user_id, timestamp, consent and user properties) are merged together.
+  """
+
+  def __init__(self, max_events_per_request=MEASUREMENT_PROTOCOL_MAX_EVENTS_PER_REQUEST):
+    """
+    Initializes the DoFn.
+
+    Args:
+      max_events_per_request: The maximum number of events sent in a single request.
+    """
+    self.max_events_per_request = max_events_per_request
+
+
+  def process(self, batch):
+    """
+    Coalesces a batch of payloads into multi-event requests.
+
+    Args:
+      batch: A list of Measurement Protocol payloads.
+
+    Yields:
+      The coalesced Measurement Protocol payloads.
+    """
+    pending_requests = {}
+    for payload in batch:
+      key = payload_envelope_key(payload)
+      request = pending_requests.get(key)
+      if request is not None and len(request['events']) + len(payload['events']) > self.max_events_per_request:
+        yield request
+        request = None
+      if request is None:
+        pending_requests[key] = dict(payload, events=list(payload['events']))
+      else:
+        request['events'].extend(payload['events'])
+
+    for request in pending_requests.values():
+      yield request
+
+
+
+
+def deduplication_key(payload):
+  """
+  Computes the key identifying the user of a Measurement Protocol payload.
+
+  Args:
+    payload: The Measurement Protocol payload.
+
+  Returns:
+    A tuple containing the client_id and the user_id of the payload.
+  """
+  return payload['client_id'], payload.get('user_id')
+
+
+
+
+class MergeDuplicatePayloads(beam.DoFn):
+  """
+  This class defines a DoFn that merges the Measurement Protocol payloads of the same user into as few payloads as possible.
+
+  The DoFn takes the following arguments:
+
+  - max_events_per_request: The maximum number of events sent in a single request.
+
+  The DoFn yields the following output:
+
+  - The Measurement Protocol payloads of the user, each holding the latest timestamp, the user properties and the distinct
+    events of the payloads it merges, split into requests of at most max_events_per_request events.
+
+  The source queries join the predictions with the latest events of the users, so the same user can come back several times.
+  The payloads are merged starting from the one with the latest timestamp. A payload setting a user property to another value
+  than the payloads already merged is merged with the next payload it agrees with, or sent separately, and identical events
+  are only sent once per payload, also when the events are split into several requests.
+
+  The DoFn reports the number of payloads merged into another payload in the `deduplicated_payloads` metric, and the number
+  of payloads sent separately because of conflicting user properties in the `conflicting_payloads` metric.
+  """
+
+  def __init__(self, max_events_per_request=MEASUREMENT_PROTOCOL_MAX_EVENTS_PER_REQUEST):
+    """
+    Initializes the DoFn.
+
+    Args:
+      max_events_per_request: The maximum number of events sent in a single request.
+    """
+    self.max_events_per_request = max_events_per_request
+    self.deduplicated_payloads = Metrics.counter('activation', 'deduplicated_payloads')
+    self.conflicting_payloads = Metrics.counter('activation', 'conflicting_payloads')
+
+
+  def process(self, element):
+    """
+    Merges the payloads of a user.
+
+    Args:
+      element: A tuple containing the deduplication key and the payloads of the user.
+
+    Yields:
+      The merged Measurement Protocol payloads.
+    """
+    payloads = sorted(element[1], key=lambda payload: payload['timestamp_micros'], reverse=True)
+    merged_payloads = []
+    for payload in payloads:
+      user_properties = payload['user_properties']
+      merged = next((
+        merged for merged in merged_payloads
+        if all(merged['user_properties'].get(name, value) == value for name, value in user_properties.items())
+      ), None)
+      if merged is None:
+        if merged_payloads:
+          self.conflicting_payloads.inc()
+        merged = dict(payload, user_properties=dict(user_properties), events=[])
+        merged_payloads.append(merged)
+      else:
+        self.deduplicated_payloads.inc()
+        merged['user_properties'].update(user_properties)
+      for event in payload['events']:
+        if event not in merged['events']:
+          merged['events'].append(event)
+
+    for merged in merged_payloads:
+      for start in range(0, max(len(merged['events']), 1), self.max_events_per_request):
+        yield dict(merged, user_properties=dict(merged['user_properties']), events=merged['events'][start:start + self.max_events_per_request])
+
+
+class SplitCoalescedResponses(beam.DoFn):
+  """
+  This class defines a DoFn that splits the response of a multi-event request into one response per event.
+
+  The DoFn takes the following arguments:
+
+  - element: A tuple containing the coalesced event that was sent, the HTTP status code and the content of the response.
+
+  The DoFn yields the following output:
+
+  - A tuple containing the single-event payload, the HTTP status code, the content of the response and no serialized event,
+    so that every event keeps its own success or failure attribution in the log tables.
+  """
+
+  def process(self, element):
+    """
+    Splits the response of a multi-event request.
+
+    Args:
+      element: A tuple containing the event that was sent, the HTTP status code, the content of the response and the serialized event.
+
+    Yields:
+      A tuple containing the single-event payload, the HTTP status code, the content of the response and the serialized event,
+      which is only kept for single-event requests.
+    """
+    payload, status_code, content = element[0], element[1], element[2]
+    if len(payload['events']) <= 1:
+      yield element
+      return
+    for event in payload['events']:
+      yield dict(payload, events=[event]), status_code, content, None
+
+
+
+
+class SendToMeasurementProtocol(beam.PTransform):
+  """
+  This class defines a PTransform that sends Measurement Protocol payloads to Google Analytics 4.
+
+  The PTransform takes the following arguments:
+
+  - measurement_id: The Measurement ID of the Google Analytics 4 property.
+  - api_secret: The API secret for the Google Analytics 4 property.
+  - debug: A boolean flag indicating whether to use the Measurement Protocol API validation for debugging instead of sending the events.
+  - batch_size: The maximum number of payloads grouped together before being coalesced into multi-event requests.
+  - endpoint: The Measurement Protocol endpoint host.
+  - use_async_http: A boolean flag indicating whether to send the events with the asynchronous HTTP engine.
+  - max_concurrent_requests: The maximum number of requests in flight per worker thread when using the asynchronous HTTP engine.
+  - pool_size: The maximum number of pooled keep-alive connections per worker thread. Defaults to 10, or to max_concurrent_requests with the asynchronous HTTP engine.
+  - connect_timeout: The connect timeout of the requests, in seconds.
+  - read_timeout: The read timeout of the requests, in seconds.
+  - use_http2: A boolean flag indicating whether to send the events over HTTP/2.
+  - max_requests_per_second: The maximum number of requests per second sent by each worker, 0 for no limit.
+  - max_retries: The number of times a throttled, failed or timed out request is retried.
+  - retry_backoff: The base delay of the jittered exponential backoff between retries, in seconds.
+  - deduplicate: A boolean flag indicating whether to merge the payloads of the same client_id and user_id before sending them.
+
+  The PTransform outputs one tuple per event containing the payload that was sent, the HTTP status code and the content of the response.
+  """
+
+  def __init__(self, measurement_id, api_secret, debug=False, batch_size=1, endpoint=MEASUREMENT_PROTOCOL_ENDPOINT,
+               use_async_http=False, max_concurrent_requests=100, pool_size=None, connect_timeout=20, read_timeout=20,
+               use_http2=False, max_requests_per_second=0, max_retries=3, retry_backoff=1.0, deduplicate=False):
+    """
+    Initializes the PTransform.
+
+    Args:
+      measurement_id: The Measurement ID of the Google Analytics 4 property.
+      api_secret: The API secret for the Google Analytics 4 property.
+      debug: A boolean flag indicating whether to use the Measurement Protocol API validation for debugging instead of sending the events.
+      batch_size: The maximum number of payloads grouped together before being coalesced into multi-event requests.
+      endpoint: The Measurement Protocol endpoint host.
+      use_async_http: A boolean flag indicating whether to send the events with the asynchronous HTTP engine.
+      max_concurrent_requests: The maximum number of requests in flight per worker thread when using the asynchronous HTTP engine.
+      pool_size: The maximum number of pooled keep-alive connections per worker thread. Defaults to 10, or to max_concurrent_requests with the asynchronous HTTP engine.
+      connect_timeout: The connect timeout of the requests, in seconds.
+      read_timeout: The read timeout of the requests, in seconds.
+      use_http2: A boolean flag indicating whether to send the events over HTTP/2.
+      max_requests_per_second: The maximum number of requests per second sent by each worker, 0 for no limit.
+      max_retries: The number of times a throttled, failed or timed out request is retried.
+      retry_backoff: The base delay of the jittered exponential backoff between retries, in seconds.
+      deduplicate: A boolean flag indicating whether to merge the payloads of the same client_id and user_id before sending them.
+
+    Raises:
+      ValueError: If use_http2 is set together with use_async_http, the asynchronous HTTP engine does not support HTTP/2.
+    """
+    super().__init__()
+    if use_async_http and use_http2:
+      raise ValueError('use_http2 is not supported with use_async_http, the asynchronous HTTP engine only sends HTTP/1.1 requests')
+    self.measurement_id = measurement_id
+    self.api_secret = api_secret
+    self.debug = debug
+    self.batch_size = batch_size
+    self.endpoint = endpoint
+    self.use_async_http = use_async_http
+    self.max_concurrent_requests = max_concurrent_requests
+    self.pool_size = pool_size
+    self.connect_timeout = connect_timeout
+    self.read_timeout = read_timeout
+    self.use_http2 = use_http2
+    self.max_requests_per_second = max_requests_per_second
+    self.max_retries = max_retries
+    self.retry_backoff = retry_backoff
+    self.deduplicate = deduplicate
+
+
+  def expand(self, payloads):
+    """
+    Sends the payloads to the Measurement Protocol API.
+
+    Args:
+      payloads: A PCollection of Measurement Protocol payloads.
+
+    Returns:
+      A PCollection of tuples containing the event that was sent, the HTTP status code and the content of the response.
+    """
+    if self.deduplicate:
+      payloads = (payloads
+      | 'Key payloads by user' >> beam.WithKeys(deduplication_key)
+      | 'Group payloads by user' >> beam.GroupByKey()
+      | 'Merge duplicate payloads' >> beam.ParDo(MergeDuplicatePayloads())
+      )
+
+    if self.batch_size > 1:
+      payloads = (payloads
+      | 'Batch payloads' >> beam.BatchElements(min_batch_size=1, max_batch_size=self.batch_size)
+      | 'Coalesce payloads into multi-event requests' >> beam.ParDo(CoalescePayloads())
+      )
+
+    if self.use_async_http:
+      sender = AsyncCallMeasurementProtocolAPI(self.measurement_id, self.api_secret, debug=self.debug, endpoint=self.endpoint,
+                                               connect_timeout=self.connect_timeout, read_timeout=self.read_timeout,
+                                               max_requests_per_second=self.max_requests_per_second,
+                                               max_retries=self.max_retries, retry_backoff=self.retry_backoff,
+                                               max_concurrent_requests=self.max_concurrent_requests, pool_size=self.pool_size)
+    else:
+      sender = CallMeasurementProtocolAPI(self.measurement_id, self.api_secret, debug=self.debug, endpoint=self.endpoint,
+                                          pool_size=self.pool_size or DEFAULT_HTTP_POOL_SIZE, connect_timeout=self.connect_timeout,
+                                          read_timeout=self.read_timeout, use_http2=self.use_http2,
+                                          max_requests_per_second=self.max_requests_per_second,
+                                          max_retries=self.max_retries, retry_backoff=self.retry_backoff)
+
+    responses = (payloads
+    | 'POST event to Measurement Protocol API' >> beam.ParDo(sender)
+    )
+
+    if self.batch_size > 1 or self.deduplicate:
+      responses = (responses
+      | 'Split multi-event responses' >> beam.ParDo(SplitCoalescedResponses())
+      )
+    return responses
+
+
+
+
+class ToLogFormat(beam.DoFn):
+  """
+  This class defines a DoFn that transforms the output of the Measurement Protocol API call into a format suitable for logging,
+  and routes the output by outcome in a single pass.
+
+  The DoFn takes the following arguments:
+
+  - run_key: The activation run key.
+  - log_success_payloads: A boolean flag indicating whether to log the payloads of the events sent successfully.
+
+  The DoFn yields the following outputs:
+
+  - The main output, a dictionary containing the following fields:
+    - id: A unique identifier for the log entry.
+    - activation_id: The ID of the activation event.
+    - payload: The compact JSON payload of the event that was sent. Only kept for the failed events unless log_success_payloads is set.
+    - latest_state: The latest state of the event, which can be either "SEND_OK" or "SEND_FAIL".
+    - updated_at: The timestamp when the log entry was created.
+    - activation_run_key: The activation run key.
+  - The `ok` output, the Measurement Protocol API calls that were successful.
+  - The `retryable` output, the Measurement Protocol API calls that were throttled, failed on the server side or timed out.
+  - The `failed` output, the Measurement Protocol API calls that were rejected.
+
+  The DoFn counts the events of every outcome in the `events_ok`, `events_retryable` and `events_failed` metrics
+  and reports the size of the logged payloads.
+  """
+  OK = 'ok'
+  FAILED = 'failed'
+  RETRYABLE = 'retryable'
+
+  def __init__(self, run_key, log_success_payloads=True):
+    """
+    Initializes the DoFn.
+
+    Args:
+      run_key: The activation run key.
+      log_success_payloads: A boolean flag indicating whether to log the payloads of the events sent successfully.
+    """
+    self.run_key = run_key
+    self.log_success_payloads = log_success_payloads
+    self.outcome_counters = {tag: Metrics.counter('activation', f"events_{tag}") for tag in (self.OK, self.FAILED, self.RETRYABLE)}
+    self.log_payload_bytes = Metrics.distribution('activation', 'log_payload_bytes')
+
+
+  def process(self, element):
+    """
+    Transforms the output of the Measurement Protocol API call into a format suitable for logging.
+
+    Args:
+      element: A tuple containing the event that was sent, the HTTP status code of the response and, optionally, the serialized event.
+
+    Yields:
+      A dictionary containing the log entry, on the main output.
+      The Measurement Protocol API call, on the output matching its outcome.
+    """
+    if element[1] == requests.status_codes.codes.NO_CONTENT:
+      state_msg = 'SEND_OK'
+      tag = self.OK
+    else:
+      state_msg = 'SEND_FAIL'
+      tag = self.RETRYABLE if element[1] in RETRYABLE_STATUS_CODES or element[1] == NO_RESPONSE_STATUS_CODE else self.FAILED
+
+    try:
+      activation_id = element[0]['events'][0]['name']
+    except KeyError as e:
+      logging.error(element)
+      activation_id = ""
+      logging.error(traceback.format_exc())
+
+    self.outcome_counters[tag].inc()
+    payload = None
+    if tag != self.OK or self.log_success_payloads:
+      # Reuse the request body instead of serializing the event again.
+      payload = element[3] if len(element) > 3 and element[3] is not None else serialize_payload(element[0])
+      self.log_payload_bytes.update(len(payload))
+
+    yield {
+      'id': str(uuid.uuid4()),
+      'activation_id': activation_id,
+      'payload': payload.decode() if payload is not None else None,
+      'latest_state': f"{state_msg} {element[1]}",
+      # The Storage Write API expects Beam timestamps for TIMESTAMP columns.
+      'updated_at': Timestamp.now(),
+      'activation_run_key': self.run_key
+    }
+    yield beam.pvalue.TaggedOutput(tag, element)
+
+
+
+
+class ToSentLedgerFormat(beam.DoFn):
+  """
+  This class defines a DoFn that transforms a successful Measurement Protocol API call into a sent ledger row.
+
+  The DoFn takes the following arguments:
+
+  - activation_type: The activation use case.
+  - run_key: The activation run key.
+
+  The DoFn yields the following output:
+
+  - A dictionary containing the client_id, activation_type, inference_date, activation_run_key and sent_at fields.
+  """
+
+  def __init__(self, activation_type, run_key):
+    """
+    Initializes the DoFn.
+
+    Args:
+      activation_type: The activation use case.
+      run_key: The activation run key.
+    """
+    self.activation_type = activation_type
+    self.run_key = run_key
+
+
+  def process(self, element):
+    """
+    Transforms a successful Measurement Protocol API call into a sent ledger row.
+
+    Args:
+      element: A tuple containing the event that was sent and the HTTP status code of the response.
+
+    Yields:
+      A dictionary containing the sent ledger row.
+    """
+    inference_date = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc) + datetime.timedelta(microseconds=element[0]['timestamp_micros'])
+    yield {
+      'client_id': element[0]['client_id'],
+      'activation_type': self.activation_type,
+      'inference_date': str(inference_date),
+      'activation_run_key': self.run_key,
+      'sent_at': str(datetime.datetime.now(tz=datetime.timezone.utc))
+    }
+
+
+
+
+class DecimalEncoder(json.JSONEncoder):
+  """
+  This class defines a custom JSON encoder that handles Decimal objects correctly.
+
+  The DecimalEncoder class inherits from the `json.JSONEncoder` class and overrides the `default` method to handle Decimal objects. 
+  The `default` method is called for objects that are not of a basic type (string, number, boolean, None, list, tuple, dictionary). 
+  The DecimalEncoder class checks if the object is a Decimal object and, if so, returns its value as a float. 
+  Otherwise, it calls the parent class's `default` method to handle the object.
+
+  The DecimalEncoder class is used to ensure that Decimal objects are encoded as floats when they are converted to JSON. 
+  This is important because Decimal objects cannot be directly encoded as JSON strings.
+
+  The BigQuery Storage Read API returns TIMESTAMP and DATE columns, and DATETIME columns in the Arrow format, as
+  datetime objects, which are encoded as ISO 8601 strings.
+  """
+
+  def default(self, obj):
+    """
+    Handles the encoding of Decimal objects.
+
+    Args:
+      obj: The object to be encoded.
+
+    Returns:
+      The JSON representation of the object.
+    """
+    if isinstance(obj, Decimal):
+      return float(obj)
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+      return obj.isoformat()
+    return json.JSONEncoder.default(self, obj)
+
+
+
+
+_DECIMAL_ENCODER = DecimalEncoder()
+
+
+def serialize_payload(payload):
+  """
+  Serializes a Measurement Protocol payload to JSON bytes.
+
+  Uses orjson when it is installed, which is several times faster than the standard library encoder,
+  and falls back to the DecimalEncoder otherwise. Both encode Decimal objects as floats and write compact JSON
+  without whitespace, so that the log table stores the exact request body.
+
+  Args:
+    payload: The Measurement Protocol payload.
+
+  Returns:
+    The JSON bytes of the payload.
+  """
+  if orjson is not None:
+    return orjson.dumps(payload, default=_DECIMAL_ENCODER.default)
+  return json.dumps(payload, cls=DecimalEncoder, separators=(',', ':')).encode()
+
+
+
+
+@functools.lru_cache(maxsize=4096)
+def date_to_micro(date_str, date_time_format, date_format):
+  """
+  Converts a date string to a microsecond timestamp.
+
+  The inference_date values repeat heavily within an activation run, so the conversions are memoized by raw value.
+
+  Args:
+    date_str: The date string to be converted, or a datetime or date object.
+    date_time_format: The format of the date strings with a time part.
+    date_format: The format of the date strings without a time part.
+
+  Returns:
+    The microsecond timestamp.
+  """
+  if isinstance(date_str, datetime.datetime):
+    date_time = date_str.astimezone(datetime.timezone.utc).replace(tzinfo=None) if date_str.tzinfo else date_str
+  elif isinstance(date_str, datetime.date):
+    date_time = datetime.datetime.combine(date_str, datetime.time())
+  elif ' ' in date_str:
+    date_time = datetime.datetime.strptime(date_str, date_time_format)
+  else:
+    date_time = datetime.datetime.strptime(date_str, date_format)
+  # Integer arithmetic keeps the exact microseconds, which the sent ledger compares against the source timestamps.
+  return (date_time - datetime.datetime(1970, 1, 1)) // datetime.timedelta(microseconds=1)
+
+
+
+
+class TransformToPayload(beam.DoFn):
+  """
+  This class defines a DoFn that transforms the output of the inference pipeline into a format suitable for sending to the Google Analytics 4 Measurement Protocol API.
+
+  The DoFn takes the following arguments:
+
+  - event_name: The name of the event to be sent to Google Analytics 4.
+
+  The DoFn yields the following output:
+
+  - A dictionary containing the Measurement Protocol payload.
+
+  The DoFn performs the following steps:
+  1. Removes bad shaping strings in the `client_id` field.
+  2. Converts the rendered template string into a JSON object.
+  4. Handles any JSON decoding errors.
+
+  The DoFn is used to ensure that the Measurement Protocol payload is formatted correctly before being sent to Google Analytics 4.
+
+  The DoFn counts the rows it receives in the `rows_in` metric and reports the time spent building every payload.
+  """
+  def __init__(self, event_name):
+    """
+    Initializes the DoFn.
+
+    Args:
+      event_name: The name of the event to be sent to Google Analytics 4.
+    """
+    self.date_format = "%Y-%m-%d"
+    self.date_time_format = "%Y-%m-%d %H:%M:%S.%f %Z"
+    self.event_name = event_name
+    self.consent_obj = {
+      'ad_user_data':'GRANTED',
+      'ad_personalization':'GRANTED'
+    }
+    self.user_property_prefix = 'user_prop_'
+    self.event_parameter_prefix = 'event_param_'
+    # Payload plans, keyed by the columns of the rows.
+    self._plans = {}
+    self.rows_in = Metrics.counter('activation', 'rows_in')
+    self.transform_time_us = Metrics.distribution('activation', 'transform_time_us')
+
+
+  def process(self, element):
+    """
+    Transforms the output of the inference pipeline into a format suitable for sending to the Google Analytics 4 Measurement Protocol API.
+
+    Args:
+      element: A dictionary containing the output of the inference pipeline.
+
+    Yields:
+      A dictionary containing the Measurement Protocol payload.
+    """
+    self.rows_in.inc()
+    started = time.perf_counter()
+
     # Removing bad shaping strings in client_id
-    _client_id = element['client_id'].replace(r'<img onerror="_exploit_dom_xss(20007)', '')
-    _client_id = element['client_id'].replace(r'<img onerror="_exploit_dom_xss(20023)', '')
-    _client_id = element['client_id'].replace(r'<img onerror="_exploit_dom_xss(20013)', '')
-    _client_id = element['client_id'].replace(r'<img onerror="_exploit_dom_xss(20010)', '')
-    _client_id = element['client_id'].replace(r'q="><script>_exploit_dom_xss(40007)</script>', '')
-    _client_id = element['client_id'].replace(r'q="><script>_exploit_dom_xss(40013)</script>', '')
+    _client_id = CLIENT_ID_SANITIZER.sub('', element['client_id'])
+
+    result = {}
+    result['client_id'] = _client_id
+    if element['user_id']:
+      result['user_id'] = element['user_id']
+    result['timestamp_micros'] = self.date_to_micro(element["inference_date"])
+    result['non_personalized_ads'] = False
+    result['consent'] = self.consent_obj
+    user_property_columns, event_parameter_columns = self.payload_plan(element)
+    result['user_properties'] = self.extract_user_properties(element, user_property_columns)
+    result['events'] = [self.extract_event(element, event_parameter_columns)]
+
+    self.transform_time_us.update(int((time.perf_counter() - started) * 1000000))
+    yield result
+    
+
+  def date_to_micro(self, date_str):
+    """
+    Converts a date string to a microsecond timestamp.
+
+    Args:
+      date_str: The date string to be converted. The BigQuery Storage Read API returns datetime or date objects instead.
+
+    Returns:
+      The microsecond timestamp.
+    """
+    return date_to_micro(date_str, self.date_time_format, self.date_format)
+
+
+  def payload_plan(self, element):
+    """
+    Works out which columns of the element hold user properties and event parameters.
+
+    All the rows read from the same query share the same columns, so the plan is computed once
+    per schema instead of scanning every column name of every row.
+
+    Args:
+      element: The element to be processed.
+
+    Returns:
+      A tuple containing the list of (column, user property name) pairs and the list of (column, event parameter name) pairs.
+    """
+    columns = tuple(element)
+    plan = self._plans.get(columns)
+    if plan is None:
+      plan = (
+        [(k, k[len(self.user_property_prefix):]) for k in columns if k.startswith(self.user_property_prefix)],
+        [(k, k[len(self.event_parameter_prefix):]) for k in columns if k.startswith(self.event_parameter_prefix)]
+      )
+      self._plans[columns] = plan
+    return plan
+
+
+  def extract_user_properties(self, element, user_property_columns=None):
+    """
+    Generates a dictionary containing the user properties of the element.
+
+    Args:
+      element: The element to be processed.
+      user_property_columns: The (column, user property name) pairs of the element's schema. Defaults to the payload plan of the element.
+
+    Returns:
+      A dictionary containing the user properties of the element.
+    """
+    if user_property_columns is None:
+      user_property_columns = self.payload_plan(element)[0]
+    user_properties = {}
+    for column, name in user_property_columns:
+      v = element[column]
+      if v:
+        user_properties[name] = {'value': str(v)}
+    return user_properties
+
+  def extract_event(self, element, event_parameter_columns=None):
+    """
+    Generates a dictionary containing the event parameters from the element.
+
+    Args:
+      element: The element to be processed.
+      event_parameter_columns: The (column, event parameter name) pairs of the element's schema. Defaults to the payload plan of the element.
+
+    Returns:
+      A dictionary containing the event parameters from the element.
+    """
+    if event_parameter_columns is None:
+      event_parameter_columns = self.payload_plan(element)[1]
+    event = {
+      'name': self.event_name,
+      'params': {}
+    }
+    for column, name in event_parameter_columns:
+      v = element[column]
+      if v:
+        event['params'][name] = v
+    return event
+
+
+
+
+def send_success(element):
+  """
+  Checks if the Measurement Protocol API call was successful.
+
+  Args:
+    element: A tuple containing the event that was sent and the HTTP status code of the response.
+
+  Returns:
+    True if the Measurement Protocol API call was successful, False otherwise.
+  """
+  return element[1] == requests.status_codes.codes.NO_CONTENT
+
+
+
+
+def load_activation_type_configuration(args, activation_type=None):
+  """
+  Loads the activation type configuration from Google Cloud Storage (GCS).
+
+  Args:
+    args: The command-line arguments.
+    activation_type: The activation use case. Defaults to the activation_type argument.
+
+  Returns:
+    A dictionary containing the activation type configuration.
+
+  Raises:
+    ValueError: If the GCS path is invalid.
+    IOError: If an error occurs while reading the file.
+  """
+  # Load the configuration file and its compiled query templates, from the cache if the files did not change.
+  activation_type = activation_type or args.activation_type
+  entry, templates = load_compiled_configuration(args.project, args.activation_type_configuration, args.cache_configuration_in_gcs, activation_type)
+
+  # Get the activation type configuration.
+  activation_config = entry['configuration'][activation_type]
+
+  # Create the activation type configuration dictionary.
+  configuration = {
+    'activation_event_name': activation_config['activation_event_name'],
+    'source_query_template': templates[activation_config['source_query_template']],
+    'ga4_measurement_id': activation_config.get('ga4_measurement_id')
+  }
+
+  return configuration
+
+
+
+
+def load_activation_types_query_templates(args):
+  """
+  Loads the source query templates of all the activation types from Google Cloud Storage (GCS).
+
+  Args:
+    args: The command-line arguments.
+
+  Returns:
+    A dictionary mapping each activation type to a dictionary containing its activation event name and
+    the text of its source query template.
+  """
+  entry, _ = load_compiled_configuration(args.project, args.activation_type_configuration, args.cache_configuration_in_gcs)
+
+  return {
+    activation_type: {
+      'activation_event_name': activation_config['activation_event_name'],
+      'source_query_template': entry['templates'][activation_config['source_query_template']]['source']
+    }
+    for activation_type, activation_config in entry['configuration'].items()
+  }
+
+
+
+
+class QuerySourceTable(beam.DoFn):
+  """
+  This class defines a DoFn that runs the source query of an activation message and yields the rows to activate.
+
+  The DoFn takes the following arguments:
+
+  - project_id: The ID of the Google Cloud project that runs the queries.
+  - query_templates: A dictionary mapping each activation type to the text of its source query template.
+
+  The DoFn yields the following output:
+
+  - A tuple containing the activation type and a row of the query result.
+
+  Messages that cannot be parsed, or that name an unknown activation type, are logged and dropped instead of
+  being retried forever by the streaming job.
+  """
+
+  def __init__(self, project_id, query_templates):
+    """
+    Initializes the DoFn.
+
+    Args:
+      project_id: The ID of the Google Cloud project that runs the queries.
+      query_templates: A dictionary mapping each activation type to the text of its source query template.
+    """
+    self.project_id = project_id
+    self.query_templates = query_templates
+    self.ignored_messages = Metrics.counter('activation', 'ignored_messages')
+
+
+  def setup(self):
+    """
+    Creates the BigQuery client and compiles the query templates.
+    """
+    self._client = google_bigquery.Client(project=self.project_id)
+    self._templates = {activation_type: Environment(loader=BaseLoader).from_string(template)
+                       for activation_type, template in self.query_templates.items()}
 
-    result = {}
-    result['client_id'] = _client_id
-    if element['user_id']:
-      result['user_id'] = element['user_id']
-    result['timestamp_micros'] = self.date_to_micro(element["inference_date"])
-    result['non_personalized_ads'] = False
-    result['consent'] = self.consent_obj
-    result['user_properties'] = self.extract_user_properties(element)
-    result['events'] = [self.extract_event(element)]
 
-    yield result
-    
+  def teardown(self):
+    """
+    Closes the BigQuery client.
+    """
+    self._client.close()
 
-  def date_to_micro(self, date_str):
+
+  def process(self, message):
     """
-    Converts a date string to a microsecond timestamp.
+    Runs the source query of an activation message.
 
     Args:
-      date_str: The date string to be converted.
+      message: The data of the Pub/Sub message, a JSON object containing the activation_type and source_table fields.
 
-    Returns:
-      The microsecond timestamp.
+    Yields:
+      A tuple containing the activation type and a row of the query result.
     """
-    try:  # try if date_str with date time format
-      return int(datetime.datetime.strptime(date_str, self.date_time_format).timestamp() * 1E6)
+    try:
+      message_obj = json.loads(message)
+      activation_type = message_obj['activation_type']
+      source_table = message_obj['source_table']
+      template = self._templates[activation_type]
+    except (ValueError, KeyError, TypeError) as e:
+      logging.error(f"Ignoring activation message {message!r}: {e!r}")
+      self.ignored_messages.inc()
+      return
+
+    query = template.render(source_table=source_table)
+    logging.info(f"Activating {source_table} for {activation_type}")
+    for row in self._client.query(query).result():
+      yield activation_type, dict(row.items())
+
+
+
+
+def log_responses(measurement_api_responses, log_table_spec, run_key, streaming=False, log_success_payloads=False):
+  """
+  Routes the Measurement Protocol API responses by outcome and stores their log entries in the log table.
+
+  Batch pipelines write to the log table in the committed mode of the BigQuery Storage Write API, which commits the rows
+  of every stream at once when the stream is finalized. Streaming pipelines write in the at-least-once mode.
+
+  Args:
+    measurement_api_responses: The PCollection of Measurement Protocol API responses.
+    log_table_spec: The BigQuery table reference of the log table.
+    run_key: The activation run key.
+    streaming: A boolean flag indicating whether the pipeline is a streaming pipeline.
+    log_success_payloads: A boolean flag indicating whether to log the payloads of the events sent successfully.
+
+  Returns:
+    The routed responses, with the `ok`, `failed` and `retryable` outputs of ToLogFormat.
+  """
+  # Format the log entries and route the responses by outcome in a single pass
+  routed_responses = route_responses(measurement_api_responses, run_key, log_success_payloads)
+
+  # Store the log entries of all the responses in the log table
+  write_log(routed_responses.log, log_table_spec, streaming)
+  return routed_responses
+
+
+
+
+def route_responses(measurement_api_responses, run_key, log_success_payloads=False, label='Transform log format'):
+  """
+  Formats the log entries of the Measurement Protocol API responses and routes the responses by outcome.
+
+  Args:
+    measurement_api_responses: The PCollection of Measurement Protocol API responses.
+    run_key: The activation run key.
+    log_success_payloads: A boolean flag indicating whether to log the payloads of the events sent successfully.
+    label: The label of the formatting step.
+
+  Returns:
+    The routed responses, with the log entries on the `log` output and the `ok`, `failed` and `retryable` outputs of ToLogFormat.
+  """
+  return ( measurement_api_responses
+  | label >> beam.ParDo(ToLogFormat(run_key, log_success_payloads)).with_outputs(ToLogFormat.OK, ToLogFormat.FAILED, ToLogFormat.RETRYABLE, main='log')
+  )
+
+
+
+
+def write_log(log_entries, log_table_spec, streaming=False):
+  """
+  Stores log entries in the log table.
+
+  Args:
+    log_entries: The PCollection of log entries.
+    log_table_spec: The BigQuery table reference of the log table.
+    streaming: A boolean flag indicating whether the pipeline is a streaming pipeline.
+  """
+  _ = ( log_entries
+  | 'Store to log BQ table' >> beam.io.WriteToBigQuery(
+    log_table_spec,
+    schema=ACTIVATION_LOG_SCHEMA,
+    method=beam.io.WriteToBigQuery.Method.STORAGE_WRITE_API,
+    # Streaming writes commit continuously instead of on a triggering frequency.
+    use_at_least_once=streaming,
+    write_disposition=beam.io.BigQueryDisposition.WRITE_APPEND,
+    create_disposition=beam.io.BigQueryDisposition.CREATE_NEVER)
+  )
+
+
+
+
+def send_to_measurement_protocol(payloads, activation_options, measurement_id=None, api_secret=None, label='Send to Measurement Protocol API'):
+  """
+  Sends the Measurement Protocol payloads with the sender configured by the command-line arguments.
+
+  Args:
+    payloads: The PCollection of Measurement Protocol payloads.
+    activation_options: The command-line arguments.
+    measurement_id: The Measurement ID of the Google Analytics 4 property. Defaults to ga4_measurement_id.
+    api_secret: The API secret of the Google Analytics 4 property. Defaults to ga4_api_secret.
+    label: The label of the sending step.
+
+  Returns:
+    The PCollection of Measurement Protocol API responses.
+  """
+  return (payloads
+  | label >> SendToMeasurementProtocol(measurement_id or activation_options.ga4_measurement_id, api_secret or activation_options.ga4_api_secret, debug=activation_options.use_api_validation, batch_size=activation_options.send_batch_size,
+      endpoint=activation_options.measurement_protocol_endpoint,
+      use_async_http=activation_options.use_async_http, max_concurrent_requests=activation_options.max_concurrent_requests,
+      pool_size=activation_options.http_pool_size, connect_timeout=activation_options.http_connect_timeout,
+      read_timeout=activation_options.http_read_timeout, use_http2=activation_options.use_http2,
+      max_requests_per_second=activation_options.max_requests_per_second, max_retries=activation_options.max_send_retries,
+      retry_backoff=activation_options.retry_backoff_seconds, deduplicate=activation_options.deduplicate_payloads)
+  )
 
-    except Exception as e:
-      return int(datetime.datetime.strptime(date_str, self.date_format).timestamp() * 1E6)
 
 
-  def extract_user_properties(self, element):
+
+def ga4_properties(activation_options, activation_type_configuration):
+  """
+  Lists the Google Analytics 4 properties an activation run can send events to.
+
+  Args:
+    activation_options: The command-line arguments.
+    activation_type_configuration: The activation type configuration.
+
+  Returns:
+    A dictionary mapping the Measurement ID of every property to its API secret, starting with the default property.
+
+  Raises:
+    ValueError: If ga4_api_secrets is not a JSON object, or does not hold the API secret of the property named by
+      the activation type configuration.
+  """
+  default_measurement_id = activation_type_configuration.get('ga4_measurement_id') or activation_options.ga4_measurement_id
+  api_secrets = json.loads(activation_options.ga4_api_secrets) if activation_options.ga4_api_secrets else {}
+  if not isinstance(api_secrets, dict):
+    raise ValueError('ga4_api_secrets must be a JSON object mapping Measurement IDs to client secrets')
+
+  # The ga4_api_secret of the job is only the secret of the ga4_measurement_id of the job.
+  if default_measurement_id not in api_secrets and default_measurement_id != activation_options.ga4_measurement_id:
+    raise ValueError(f'ga4_api_secrets must hold the API secret of the Measurement ID {default_measurement_id} of the activation type configuration')
+
+  properties = {default_measurement_id: api_secrets.get(default_measurement_id, activation_options.ga4_api_secret)}
+  properties.update(api_secrets)
+  return properties
+
+
+
+
+def property_partition(row, num_partitions, property_column, partition_indexes):
+  """
+  Picks the partition of the Google Analytics 4 property a row is sent to.
+
+  Args:
+    row: A row of the source data.
+    num_partitions: The number of partitions, one per property and a last one for the unknown properties.
+    property_column: The column of the row holding the Measurement ID of the property.
+    partition_indexes: A dictionary mapping the Measurement ID of every known property to its partition.
+
+  Returns:
+    The index of the partition of the row. The rows without a property go to the first, default, property.
+  """
+  measurement_id = row.get(property_column) if property_column else None
+  if not measurement_id:
+    return 0
+  return partition_indexes.get(measurement_id, num_partitions - 1)
+
+
+
+
+def send_to_properties(rows, activation_options, properties, event_name):
+  """
+  Fans the source rows out to the Google Analytics 4 properties they belong to and sends their events.
+
+  Every property gets its own payload preparation, batching and sender, with its own rate limiter,
+  so that each property is sent to up to its own quota instead of the quota of the slowest one.
+
+  Args:
+    rows: The PCollection of source rows.
+    activation_options: The command-line arguments.
+    properties: A dictionary mapping the Measurement ID of every property to its API secret, starting with the default property.
+    event_name: The name of the event to be sent to Google Analytics 4.
+
+  Returns:
+    The PCollection of Measurement Protocol API responses of all the properties.
+  """
+  measurement_ids = list(properties)
+  partitions = (rows
+  | 'Split by GA4 property' >> beam.Partition(property_partition, len(measurement_ids) + 1,
+      activation_options.ga4_property_column, {measurement_id: i for i, measurement_id in enumerate(measurement_ids)})
+  )
+
+  responses = [
+    send_to_measurement_protocol(
+      partitions[i]
+      | f"Prepare {measurement_id} Measurement Protocol API payload" >> beam.ParDo(TransformToPayload(event_name)),
+      activation_options, measurement_id=measurement_id, api_secret=properties[measurement_id],
+      label=f"Send to {measurement_id} Measurement Protocol API")
+    for i, measurement_id in enumerate(measurement_ids)]
+
+  # The events of the properties without API secret cannot be sent, they are logged as failed.
+  responses.append(partitions[len(measurement_ids)]
+  | 'Prepare unknown GA4 property payload' >> beam.ParDo(TransformToPayload(event_name))
+  | 'Fail unknown GA4 property' >> beam.Map(lambda payload: (payload, UNKNOWN_PROPERTY_STATUS_CODE, b'Unknown GA4 property', None))
+  )
+
+  return responses | 'Merge GA4 property responses' >> beam.Flatten()
+
+
+
+
+def enable_bundle_profiling(pipeline_options):
+  """
+  Stores the per-bundle CPU profiles of the workers under the temp location.
+
+  The Beam SDK harness profiles a sample of the bundles with cProfile when `--profile_cpu` is set and uploads
+  one pstats file per profiled bundle to the profile location. The profile location defaults to a `profiles`
+  folder of the temp location, so that the profiles can be collected without another bucket.
+
+  Args:
+    pipeline_options: The pipeline options.
+  """
+  profiling_options = pipeline_options.view_as(ProfilingOptions)
+  if not profiling_options.profile_cpu or profiling_options.profile_location:
+    return
+  temp_location = pipeline_options.view_as(GoogleCloudOptions).temp_location
+  if not temp_location:
+    logging.warning('profile_cpu is set without profile_location or temp_location, no profiles are stored')
+    return
+  profiling_options.profile_location = f"{temp_location.rstrip('/')}/profiles"
+  logging.info(f"Storing the CPU profiles of {profiling_options.profile_sample_rate:.0%} of the bundles in {profiling_options.profile_location}")
+
+
+
+
+class SampleUsers(beam.DoFn):
+  """
+  This class defines a DoFn that keeps the rows of a deterministic sample of the users.
+
+  The DoFn takes the following arguments:
+
+  - fraction: The share of the users kept, between 0 and 1.
+
+  The DoFn yields the following output:
+
+  - The rows whose client_id falls in the sample. All the rows of a user are kept or dropped together,
+    so that the sample sends the same requests per user as the full run.
+
+  The DoFn counts the rows it receives in the `dry_run_rows` metric and the rows it keeps in the `dry_run_sampled_rows` metric.
+  """
+
+  def __init__(self, fraction):
     """
-    Generates a dictionary containing the user properties of the element.
+    Initializes the DoFn.
 
     Args:
-      element: The element to be processed.
-
-    Returns:
-      A dictionary containing the user properties of the element.
+      fraction: The share of the users kept, between 0 and 1.
     """
-    user_properties = {}
-    for k, v in element.items():
-      if k.startswith(self.user_property_prefix) and v:
-        user_properties[k[len(self.user_property_prefix):]] = {'value': str(v)}
-    return user_properties
+    self.threshold = int(fraction * 2 ** 64)
+    self.rows = Metrics.counter('activation', 'dry_run_rows')
+    self.sampled_rows = Metrics.counter('activation', 'dry_run_sampled_rows')
 
-  def extract_event(self, element):
+
+  def process(self, row):
     """
-    Generates a dictionary containing the event parameters from the element.
+    Keeps the row if its user falls in the sample.
 
     Args:
-      element: The element to be processed.
+      row: A row of the source data.
 
-    Returns:
-      A dictionary containing the event parameters from the element.
+    Yields:
+      The row, if its user falls in the sample.
     """
-    event = {
-      'name': self.event_name,
-      'params': {}
-    }
-    for k, v in element.items():
-      if k.startswith(self.event_parameter_prefix) and v:
-        event['params'][k[len(self.event_parameter_prefix):]] = v
-    return event
+    self.rows.inc()
+    digest = hashlib.md5(str(row['client_id']).encode()).digest()
+    if int.from_bytes(digest[:8], 'big') < self.threshold:
+      self.sampled_rows.inc()
+      yield row
 
 
 
 
-def send_success(element):
+def estimate_query_bytes(project_id, query):
   """
-  Checks if the Measurement Protocol API call was successful.
+  Estimates the number of bytes a query processes with a BigQuery dry run.
 
   Args:
-    element: A tuple containing the event that was sent and the HTTP status code of the response.
+    project_id: The ID of the Google Cloud project running the query.
+    query: The query.
 
   Returns:
-    True if the Measurement Protocol API call was successful, False otherwise.
+    The number of bytes processed by the query.
   """
-  return element[1] == requests.status_codes.codes.NO_CONTENT
+  job_config = google_bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+  return google_bigquery.Client(project=project_id).query(query, job_config=job_config).total_bytes_processed
 
 
 
 
-def load_activation_type_configuration(args):
+def dry_run_report(metrics, activation_options, elapsed_seconds, query_bytes):
   """
-  Loads the activation type configuration from Google Cloud Storage (GCS).
+  Projects the wall time, the requests and the cost of a full activation run from the metrics of a dry run.
+
+  The send time is measured on the sample and scaled to all the users, per worker thread: a run on several workers
+  sends proportionally faster, as long as GA4 does not throttle it.
 
   Args:
-    args: The command-line arguments.
+    metrics: The metrics query result of the dry run, in the `activation` namespace.
+    activation_options: The command-line arguments.
+    elapsed_seconds: The wall time of the dry run, in seconds.
+    query_bytes: The number of bytes processed by the source query.
 
   Returns:
-    A dictionary containing the activation type configuration.
+    A dictionary containing the measured and projected figures of the run.
+  """
+  counters = collections.Counter()
+  for counter in metrics['counters']:
+    counters[counter.key.metric.name] += counter.committed or 0
+  distributions = {}
+  for distribution in metrics['distributions']:
+    if distribution.committed is not None:
+      distributions[distribution.key.metric.name] = distribution.committed
+
+  def distribution_sum(name):
+    return distributions[name].sum if name in distributions else 0
+
+  fraction = activation_options.dry_run_sample_fraction
+  sampled_requests = sum(value for name, value in counters.items() if name.startswith('status_'))
+  sampled_events = counters['events_ok'] + counters['events_retryable'] + counters['events_failed']
+  concurrency = activation_options.max_concurrent_requests if activation_options.use_async_http else 1
+  sampled_send_seconds = distribution_sum('request_latency_ms') / 1000 / concurrency
+
+  projected_requests = sampled_requests / fraction
+  projected_send_seconds = sampled_send_seconds / fraction
+  if activation_options.max_requests_per_second:
+    projected_send_seconds = max(projected_send_seconds, projected_requests / activation_options.max_requests_per_second)
+  # The validation server answers 200 instead of 204, so the payloads logged in the dry run are not representative.
+  logged_payload_bytes = distribution_sum('request_bytes') if activation_options.log_success_payloads else 0
+  projected_log_bytes = (logged_payload_bytes + sampled_events * ACTIVATION_LOG_ROW_OVERHEAD_BYTES) / fraction
+
+  return {
+    'sample_fraction': fraction,
+    'rows': counters['dry_run_rows'],
+    'sampled_rows': counters['dry_run_sampled_rows'],
+    'sampled_requests': sampled_requests,
+    'sampled_events': sampled_events,
+    'dry_run_seconds': round(elapsed_seconds, 1),
+    'projected_events': round(sampled_events / fraction),
+    'projected_requests': round(projected_requests),
+    'projected_throttled_requests': round(counters['throttled_requests'] / fraction),
+    'projected_wall_seconds': round(elapsed_seconds + projected_send_seconds - sampled_send_seconds, 1),
+    'projected_query_cost_usd': round(query_bytes / 2 ** 40 * BIGQUERY_ON_DEMAND_PRICE_PER_TIB, 4),
+    'projected_log_cost_usd': round(projected_log_bytes / 2 ** 30 * STORAGE_WRITE_API_PRICE_PER_GIB, 4),
+  }
+
+
+
+
+def run_dry_run(pipeline_options, activation_options, activation_type, query, properties, event_name):
+  """
+  Runs the read and transform path of the activation on all the source data and sends the events of a sample of the users,
+  without logging the events or recording them in the sent ledger.
+
+  The sample is sent to the Measurement Protocol validation server, unless measurement_protocol_endpoint points to another collector.
+
+  Args:
+    pipeline_options: The pipeline options.
+    activation_options: The command-line arguments.
+    activation_type: The activation use case, which names the stored report.
+    query: The query retrieving the data from the source table.
+    properties: A dictionary mapping the Measurement ID of every property to its API secret, starting with the default property.
+    event_name: The name of the event to be sent to Google Analytics 4.
+
+  Returns:
+    The dry run report.
 
   Raises:
-    ValueError: If the GCS path is invalid.
-    IOError: If an error occurs while reading the file.
+    ValueError: If the sample fraction is not between 0 and 1.
   """
-  # Read the configuration file from GCS.
-  config_str = gcs_read_file(args.project, args.activation_type_configuration)
-  # Parse the JSON configuration file.
-  grand_config = json.loads(config_str)
+  if not 0 < activation_options.dry_run_sample_fraction <= 1:
+    raise ValueError('dry_run_sample_fraction must be greater than 0 and lower than or equal to 1')
+  activation_options.use_api_validation = (activation_options.use_api_validation
+                                          or activation_options.measurement_protocol_endpoint == MEASUREMENT_PROTOCOL_ENDPOINT)
+  query_bytes = estimate_query_bytes(activation_options.project, query)
+
+  p = beam.Pipeline(options=pipeline_options)
+  rows = (p
+  | 'Read from source table' >> read_from_source(activation_options, query)
+  | 'Sample users' >> beam.ParDo(SampleUsers(activation_options.dry_run_sample_fraction))
+  )
+  measurement_api_responses = send_to_properties(rows, activation_options, properties, event_name)
+  _ = (measurement_api_responses
+  | 'Transform log format' >> beam.ParDo(ToLogFormat('dry-run', activation_options.log_success_payloads)).with_outputs(
+      ToLogFormat.OK, ToLogFormat.FAILED, ToLogFormat.RETRYABLE, main='log')
+  )
 
-  # Get the activation type configuration.
-  activation_config = grand_config[args.activation_type]
+  started = time.monotonic()
+  result = p.run()
+  result.wait_until_finish()
+  report = dry_run_report(result.metrics().query(beam.metrics.MetricsFilter().with_namespace('activation')),
+                          activation_options, time.monotonic() - started, query_bytes)
+  logging.info(f"Dry run report: {json.dumps(report)}")
 
-  # Create the activation type configuration dictionary.
-  configuration = {
-    'activation_event_name': activation_config['activation_event_name'],
-    'source_query_template': Environment(loader=BaseLoader).from_string(gcs_read_file(args.project, activation_config['source_query_template']).replace('\n', ' '))
+  temp_location = pipeline_options.view_as(GoogleCloudOptions).temp_location
+  if temp_location:
+    report_path = f"{temp_location.rstrip('/')}/dry_run/{activation_type}-{int(time.time())}.json"
+    with beam.io.filesystems.FileSystems.create(report_path) as report_file:
+      report_file.write(json.dumps(report, indent=2).encode())
+    logging.info(f"Dry run report stored in {report_path}")
+  return report
+
+
+
+
+def parse_activations(activation_options):
+  """
+  Lists the activations run by the job.
+
+  Args:
+    activation_options: The command-line arguments.
+
+  Returns:
+    A list of (activation_type, source_table) tuples, without duplicates.
+
+  Raises:
+    ValueError: If neither the activations nor the source_table and activation_type arguments are set, or if the activations are invalid.
+  """
+  if not activation_options.activations:
+    if not activation_options.source_table or not activation_options.activation_type:
+      raise ValueError('source_table and activation_type are required unless activations or activation_subscription is set')
+    return [(activation_options.activation_type, activation_options.source_table)]
+
+  activations = json.loads(activation_options.activations)
+  if not isinstance(activations, list) or not activations:
+    raise ValueError('activations must be a non-empty JSON list')
+  try:
+    return list(dict.fromkeys((activation['activation_type'], activation['source_table']) for activation in activations))
+  except (KeyError, TypeError) as e:
+    raise ValueError('Every activation must have an activation_type and a source_table') from e
+
+
+
+
+def prepare_activation(activation_options, activation_type, source_table):
+  """
+  Prepares the query, the run key and the GA4 properties of an activation.
+
+  Args:
+    activation_options: The command-line arguments.
+    activation_type: The activation use case.
+    source_table: The table specification for the source data.
+
+  Returns:
+    A dictionary containing the activation_type, source_table, query, run_key, properties and event_name of the activation.
+  """
+  # Load the activation type configuration.
+  logging.info(f"Loading activation type configuration of {activation_type} from {activation_options.activation_type_configuration}")
+  activation_type_configuration = load_activation_type_configuration(activation_options, activation_type)
+
+  # Build the query to be used to retrieve data from the source table.
+  logging.info(f"Building query to retrieve data from {source_table}")
+  query = build_query(activation_options, activation_type_configuration, source_table)
+
+  # Derive the activation run key, identical for re-runs of the same activation on the same predictions.
+  prediction_snapshot = activation_options.prediction_snapshot or get_prediction_snapshot(activation_options.project, source_table)
+  run_key = activation_run_key(activation_type, source_table, prediction_snapshot)
+  logging.info(f"Activation run key {run_key} for prediction snapshot {prediction_snapshot}")
+
+  # Only send the events that are not in the sent ledger yet.
+  # A dry run sends nothing, so it only reads the ledger of the previous runs, without creating it.
+  if activation_options.use_sent_ledger:
+    if activation_options.dry_run_sample_fraction:
+      ledger_table_id = find_sent_ledger_table(activation_options.project, activation_options.log_db_dataset)
+    else:
+      ledger_table_id = ensure_sent_ledger_table(activation_options.project, activation_options.log_db_dataset)
+    if ledger_table_id:
+      query = exclude_already_sent(query, ledger_table_id, activation_type, include_superseded=activation_options.deduplicate_payloads)
+  logging.info(query)
+
+  # List the GA4 properties the events are sent to.
+  properties = ga4_properties(activation_options, activation_type_configuration)
+  logging.info(f"Sending events to the GA4 properties {list(properties)}")
+
+  return {
+    'activation_type': activation_type,
+    'source_table': source_table,
+    'query': query,
+    'run_key': run_key,
+    'properties': properties,
+    'event_name': activation_type_configuration['activation_event_name'],
   }
 
-  return configuration
+
+
+
+class Activate(beam.PTransform):
+  """
+  This class defines a PTransform that reads the source data of an activation and sends its events to Google Analytics 4.
+
+  The PTransform takes the following arguments:
+
+  - activation_options: The command-line arguments.
+  - activation: The prepared activation, as returned by prepare_activation.
+
+  The PTransform outputs the Measurement Protocol API responses of the activation. Several activations can be
+  applied to the same pipeline, each one reading its own source table.
+  """
+
+  def __init__(self, activation_options, activation):
+    """
+    Initializes the PTransform.
+
+    Args:
+      activation_options: The command-line arguments.
+      activation: The prepared activation, as returned by prepare_activation.
+    """
+    super().__init__()
+    self.activation_options = activation_options
+    self.activation = activation
+
+
+  def expand(self, pbegin):
+    """
+    Reads the source data and sends its events.
+
+    Args:
+      pbegin: The beginning of the pipeline.
+
+    Returns:
+      A PCollection of Measurement Protocol API responses.
+    """
+    properties = self.activation['properties']
+    rows = (pbegin
+    | 'Read from source table' >> read_from_source(self.activation_options, self.activation['query'])
+    )
+
+    if len(properties) == 1 and not self.activation_options.ga4_property_column:
+      payloads = (rows
+      | 'Prepare Measurement Protocol API payload' >> beam.ParDo(TransformToPayload(self.activation['event_name']))
+      )
+      return send_to_measurement_protocol(payloads, self.activation_options, *next(iter(properties.items())))
+    return send_to_properties(rows, self.activation_options, properties, self.activation['event_name'])
+
+
+
+
+def run_streaming(pipeline_options, activation_options):
+  """
+  Runs the activation application as a long-running streaming job driven by the activation topic.
+
+  Every activation message runs the source query of its activation type on already running workers,
+  instead of launching a new Dataflow job per message.
+
+  Args:
+    pipeline_options: The pipeline options.
+    activation_options: The activation options.
+
+  Raises:
+    ValueError: If the sent ledger, the GA4 property fan-out, the payload deduplication or a dry run is enabled, which are not supported in streaming mode.
+  """
+  if activation_options.use_sent_ledger:
+    raise ValueError('The sent ledger is not supported with activation_subscription')
+  if activation_options.ga4_property_column or activation_options.ga4_api_secrets:
+    raise ValueError('The GA4 property fan-out is not supported with activation_subscription')
+  if activation_options.deduplicate_payloads:
+    raise ValueError('The payload deduplication is not supported with activation_subscription')
+  if activation_options.dry_run_sample_fraction:
+    raise ValueError('Dry runs are not supported with activation_subscription')
+  pipeline_options.view_as(StandardOptions).streaming = True
+
+  # Load the configuration of all the activation types, any of them can be received.
+  logging.info(f"Loading activation types configuration from {activation_options.activation_type_configuration}")
+  activation_types_configuration = load_activation_types_query_templates(activation_options)
+  activation_types = sorted(activation_types_configuration)
+
+  # The streaming job is a single long-running activation run.
+  run_key = activation_run_key('streaming', activation_options.activation_subscription, datetime.datetime.now(tz=datetime.timezone.utc).isoformat())
+  logging.info(f"Activation run key {run_key} for subscription {activation_options.activation_subscription}")
+
+  ensure_activation_log_table(activation_options.project, activation_options.log_db_dataset)
+  log_table_spec = bigquery.TableReference(
+    projectId=activation_options.project,
+    datasetId=activation_options.log_db_dataset,
+    tableId=ACTIVATION_LOG_TABLE)
+
+  with beam.Pipeline(options=pipeline_options) as p:
+    # Run the source query of every activation message.
+    source_rows = (p
+    | 'Read activation messages' >> beam.io.ReadFromPubSub(subscription=activation_options.activation_subscription)
+    | 'Query source table' >> beam.ParDo(QuerySourceTable(activation_options.project,
+        {activation_type: configuration['source_query_template'] for activation_type, configuration in activation_types_configuration.items()}))
+    | 'Split by activation type' >> beam.Partition(lambda element, num_partitions: activation_types.index(element[0]), len(activation_types))
+    )
+
+    # Prepare the payloads with the activation event of each activation type.
+    payloads = ([
+      source_rows[i]
+      | f"Get {activation_type} rows" >> beam.Values()
+      | f"Prepare {activation_type} Measurement Protocol API payload" >> beam.ParDo(TransformToPayload(activation_types_configuration[activation_type]['activation_event_name']))
+      for i, activation_type in enumerate(activation_types)]
+    | 'Merge payloads' >> beam.Flatten()
+    )
+
+    measurement_api_responses = send_to_measurement_protocol(payloads, activation_options)
+    log_responses(measurement_api_responses, log_table_spec, run_key, streaming=True,
+                  log_success_payloads=activation_options.log_success_payloads or activation_options.use_api_validation)
 
 
 
@@ -511,86 +2896,73 @@ def run(argv=None):
 
   # Get the activation options.
   activation_options = pipeline_options.view_as(ActivationOptions)
-  # Load the activation type configuration.
-  logging.info(f"Loading activation type configuration from {activation_options}")
-  activation_type_configuration = load_activation_type_configuration(activation_options)
-
-  # Build the query to be used to retrieve data from the source table.
-  logging.info(f"Building query to retrieve data from {activation_type_configuration}")
-  load_from_source_query = build_query(activation_options, activation_type_configuration)
-  logging.info(load_from_source_query)
-
-  # Create a unique table suffix for the log tables.
-  table_suffix =f"{datetime.datetime.today().strftime('%Y_%m_%d')}_{str(uuid.uuid4())[:8]}"
-  # Create the log table names.
-  log_table_names = [f'activation_log_{table_suffix}', f'activation_retry_{table_suffix}']
-  # Create the log table schema.
-  table_schema = {
-    'fields': [{
-      'name': 'id', 'type': 'STRING', 'mode': 'REQUIRED'
-      }, {
-      'name': 'activation_id', 'type': 'STRING', 'mode': 'REQUIRED'
-      }, {
-      'name': 'payload', 'type': 'STRING', 'mode': 'REQUIRED'
-      }, {
-      'name': 'latest_state', 'type': 'STRING', 'mode': 'REQUIRED'
-      }, {
-      'name': 'updated_at', 'type': 'TIMESTAMP', 'mode': 'REQUIRED'
-    }]
-  }
-
-  # Create the BigQuery table references for the log tables.
-  success_log_table_spec = bigquery.TableReference(
+  enable_bundle_profiling(pipeline_options)
+  if activation_options.activation_subscription:
+    run_streaming(pipeline_options, activation_options)
+    return
+
+  # List the activations run by the job, a single one unless several activations were coalesced.
+  activations = parse_activations(activation_options)
+
+  # Prepare the query, the run key and the GA4 properties of every activation.
+  prepared_activations = [prepare_activation(activation_options, activation_type, source_table) for activation_type, source_table in activations]
+
+  # Project the cost of the run from a sample of the users instead of sending all the events.
+  if activation_options.dry_run_sample_fraction:
+    if len(prepared_activations) > 1:
+      raise ValueError('Dry runs are not supported with several activations')
+    activation = prepared_activations[0]
+    run_dry_run(pipeline_options, activation_options, activation['activation_type'], activation['query'], activation['properties'], activation['event_name'])
+    return
+
+  # Create the activation log table, shared by all the activation runs.
+  ensure_activation_log_table(activation_options.project, activation_options.log_db_dataset)
+
+  # Create the BigQuery table reference for the log table.
+  log_table_spec = bigquery.TableReference(
     projectId=activation_options.project,
     datasetId=activation_options.log_db_dataset,
-    tableId=log_table_names[0])
+    tableId=ACTIVATION_LOG_TABLE)
 
-  failure_log_table_spec = bigquery.TableReference(
+  # Create the BigQuery table reference for the sent ledger table.
+  sent_ledger_table_spec = bigquery.TableReference(
     projectId=activation_options.project,
     datasetId=activation_options.log_db_dataset,
-    tableId=log_table_names[1])
+    tableId=SENT_LEDGER_TABLE)
 
   # Create the pipeline.
   with beam.Pipeline(options=pipeline_options) as p:
-    # Read the data from the source table.
-    measurement_api_responses = (p
-    | beam.io.gcp.bigquery.ReadFromBigQuery(project=activation_options.project,
-        query=load_from_source_query,
-        use_json_exports=True,
-        use_standard_sql=True)
-    | 'Prepare Measurement Protocol API payload' >> beam.ParDo(TransformToPayload(activation_type_configuration['activation_event_name']))
-    | 'POST event to Measurement Protocol API' >> beam.ParDo(CallMeasurementProtocolAPI(activation_options.ga4_measurement_id, activation_options.ga4_api_secret, debug=activation_options.use_api_validation))
-    )
-
-    # Filter the successful responses
-    success_responses = ( measurement_api_responses
-    | 'Get the successful responses' >> beam.Filter(lambda element: element[1] == requests.status_codes.codes.NO_CONTENT)
-    )
-
-    # Filter the failed responses
-    failed_responses = ( measurement_api_responses
-    | 'Get the failed responses' >> beam.Filter(lambda element: element[1] != requests.status_codes.codes.NO_CONTENT)
-    )
-
-    # Store the successful responses in the log tables
-    _ = ( success_responses
-    | 'Transform log format' >> beam.ParDo(ToLogFormat())
-    | 'Store to log BQ table' >> beam.io.WriteToBigQuery(
-      success_log_table_spec,
-      schema=table_schema,
-      write_disposition=beam.io.BigQueryDisposition.WRITE_APPEND,
-      create_disposition=beam.io.BigQueryDisposition.CREATE_IF_NEEDED)
-    )
-
-    # Store the failed responses in the log tables
-    _ = ( failed_responses
-    | 'Transform failure log format' >> beam.ParDo(ToLogFormat())
-    | 'Store to failure log BQ table' >> beam.io.WriteToBigQuery(
-      failure_log_table_spec,
-      schema=table_schema,
-      write_disposition=beam.io.BigQueryDisposition.WRITE_APPEND,
-      create_disposition=beam.io.BigQueryDisposition.CREATE_IF_NEEDED)
-    )
+    log_entries = []
+    sent_ledger_rows = []
+    for activation in prepared_activations:
+      name = f"{activation['activation_type']} from {activation['source_table']}" if len(prepared_activations) > 1 else activation['activation_type']
+
+      # Read the data from the source table and send it to GA4.
+      measurement_api_responses = p | f"Activate {name}" >> Activate(activation_options, activation)
+
+      # Route the responses by outcome and format their log entries
+      routed_responses = route_responses(measurement_api_responses, activation['run_key'],
+                                         log_success_payloads=activation_options.log_success_payloads or activation_options.use_api_validation,
+                                         label=f"Transform {name} log format")
+      log_entries.append(routed_responses.log)
+
+      # Record the successful responses in the sent ledger
+      if activation_options.use_sent_ledger:
+        sent_ledger_rows.append(routed_responses[ToLogFormat.OK]
+        | f"Transform {name} sent ledger format" >> beam.ParDo(ToSentLedgerFormat(activation['activation_type'], activation['run_key']))
+        )
+
+    # Store the log entries of all the activations in the log table
+    write_log(log_entries | 'Merge log entries' >> beam.Flatten(), log_table_spec)
+
+    if sent_ledger_rows:
+      _ = ( sent_ledger_rows
+      | 'Merge sent ledger rows' >> beam.Flatten()
+      | 'Store to sent ledger BQ table' >> beam.io.WriteToBigQuery(
+        sent_ledger_table_spec,
+        write_disposition=beam.io.BigQueryDisposition.WRITE_APPEND,
+        create_disposition=beam.io.BigQueryDisposition.CREATE_NEVER)
+      )
 
 
 
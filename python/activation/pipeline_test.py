@@ -14,13 +14,26 @@
 
 import unittest
 import apache_beam as beam
+import requests
 from unittest.mock import MagicMock, patch
+from apache_beam.metrics.metric import MetricsFilter
+from apache_beam.options.pipeline_options import PipelineOptions, ProfilingOptions
 from apache_beam.testing.test_pipeline import TestPipeline
 from apache_beam.testing.util import assert_that, equal_to
 
 
-from main import TransformToPayload, build_query, gcs_read_file
+from main import TransformToPayload, CoalescePayloads, SplitCoalescedResponses, CallMeasurementProtocolAPI, AsyncCallMeasurementProtocolAPI, TokenBucketRateLimiter, ToLogFormat, ToSentLedgerFormat, activation_run_key, date_to_micro, exclude_already_sent, find_sent_ledger_table, prepare_activation, CLIENT_ID_SANITIZER, read_from_source, QuerySourceTable, load_activation_types_query_templates, load_compiled_configuration, build_query, gcs_read_file, ga4_properties, property_partition, send_to_properties, enable_bundle_profiling, MergeDuplicatePayloads, SendToMeasurementProtocol, ensure_activation_log_table, SampleUsers, run_dry_run, parse_activations, Activate, UNKNOWN_PROPERTY_STATUS_CODE, ActivationOptions
+from fake_collector import FakeCollector
+import base64
+import datetime
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import time
 from decimal import Decimal
+from google.api_core import exceptions as google_exceptions
 from jinja2 import Environment, BaseLoader
 
 class data:
@@ -95,6 +108,560 @@ class CountTest(unittest.TestCase):
       'SELECT * FROM test_dataset.test_table'
     )
 
+  def test_coalesce_payloads(self):
+    INPUT = [[
+      {'client_id': 'a', 'user_properties': {}, 'events': [{'name': 'e', 'params': {'n': 1}}]},
+      {'client_id': 'b', 'user_properties': {}, 'events': [{'name': 'e', 'params': {'n': 2}}]},
+      {'client_id': 'a', 'user_properties': {}, 'events': [{'name': 'e', 'params': {'n': 3}}]},
+      {'client_id': 'a', 'user_properties': {}, 'events': [{'name': 'e', 'params': {'n': 4}}]},
+    ]]
+
+    with TestPipeline() as p:
+      output = p | beam.Create(INPUT) | beam.ParDo(CoalescePayloads(max_events_per_request=2))
+
+      assert_that(
+        output,
+        equal_to([
+          {'client_id': 'a', 'user_properties': {}, 'events': [{'name': 'e', 'params': {'n': 1}}, {'name': 'e', 'params': {'n': 3}}]},
+          {'client_id': 'a', 'user_properties': {}, 'events': [{'name': 'e', 'params': {'n': 4}}]},
+          {'client_id': 'b', 'user_properties': {}, 'events': [{'name': 'e', 'params': {'n': 2}}]},
+        ])
+      )
+
+  def test_split_coalesced_responses(self):
+    INPUT = [
+      ({'client_id': 'a', 'events': [{'name': 'e1'}, {'name': 'e2'}]}, 204, b'', b'{"client_id":"a","events":[{"name":"e1"},{"name":"e2"}]}'),
+      ({'client_id': 'b', 'events': [{'name': 'e1'}]}, 400, b'error', b'{"client_id":"b","events":[{"name":"e1"}]}'),
+    ]
+
+    with TestPipeline() as p:
+      output = p | beam.Create(INPUT) | beam.ParDo(SplitCoalescedResponses())
+
+      assert_that(
+        output,
+        equal_to([
+          ({'client_id': 'a', 'events': [{'name': 'e1'}]}, 204, b'', None),
+          ({'client_id': 'a', 'events': [{'name': 'e2'}]}, 204, b'', None),
+          ({'client_id': 'b', 'events': [{'name': 'e1'}]}, 400, b'error', b'{"client_id":"b","events":[{"name":"e1"}]}'),
+        ])
+      )
+
+  def test_call_measurement_protocol_api_reuses_connections(self):
+    INPUT = [{'client_id': f"client-{i}", 'events': [{'name': 'e'}]} for i in range(20)]
+
+    with FakeCollector() as collector:
+      sender = CallMeasurementProtocolAPI('G-TEST', 'secret', endpoint=collector.endpoint, pool_size=1)
+      sender.setup()
+      statuses = [status for element in INPUT for _, status, _, _ in sender.process(element)]
+      sender.teardown()
+
+    self.assertEqual(statuses, [204] * 20)
+    self.assertEqual(collector.request_count, 20)
+    self.assertEqual(collector.connection_count, 1)
+
+  def test_call_measurement_protocol_api_retries_retryable_status(self):
+    sender = CallMeasurementProtocolAPI('G-TEST', 'secret', max_retries=2, retry_backoff=0)
+    sender.setup()
+    sender.post = MagicMock(side_effect=[
+      MagicMock(status_code=429, content=b'throttled'),
+      MagicMock(status_code=503, content=b'unavailable'),
+      MagicMock(status_code=204, content=b''),
+    ])
+
+    self.assertEqual(list(sender.process({'client_id': 'a'})), [({'client_id': 'a'}, 204, b'', b'{"client_id":"a"}')])
+    self.assertEqual(sender.post.call_count, 3)
+
+  def test_call_measurement_protocol_api_stops_after_retry_budget(self):
+    sender = CallMeasurementProtocolAPI('G-TEST', 'secret', max_retries=1, retry_backoff=0)
+    sender.setup()
+    sender.post = MagicMock(return_value=MagicMock(status_code=500, content=b'error'))
+
+    self.assertEqual(list(sender.process({'client_id': 'a'})), [({'client_id': 'a'}, 500, b'error', b'{"client_id":"a"}')])
+    self.assertEqual(sender.post.call_count, 2)
+
+  def test_call_measurement_protocol_api_does_not_retry_client_errors(self):
+    sender = CallMeasurementProtocolAPI('G-TEST', 'secret', max_retries=3, retry_backoff=0)
+    sender.setup()
+    sender.post = MagicMock(return_value=MagicMock(status_code=400, content=b'bad request'))
+
+    self.assertEqual(list(sender.process({'client_id': 'a'})), [({'client_id': 'a'}, 400, b'bad request', b'{"client_id":"a"}')])
+    self.assertEqual(sender.post.call_count, 1)
+
+  def test_token_bucket_rate_limiter(self):
+    limiter = TokenBucketRateLimiter(rate=2)
+
+    self.assertEqual(limiter.reserve(), 0.0)
+    self.assertEqual(limiter.reserve(), 0.0)
+    self.assertAlmostEqual(limiter.reserve(), 0.5, places=2)
+
+    limiter.throttle()
+    self.assertEqual(limiter.rate, 1)
+    limiter.recover()
+    self.assertAlmostEqual(limiter.rate, 1.02)
+
+  def test_async_call_measurement_protocol_api(self):
+    INPUT = [{'client_id': f"client-{i}", 'events': [{'name': 'e'}]} for i in range(20)]
+
+    with FakeCollector() as collector:
+      with TestPipeline() as p:
+        output = (p
+        | beam.Create(INPUT)
+        | beam.ParDo(AsyncCallMeasurementProtocolAPI('G-TEST', 'secret', endpoint=collector.endpoint, max_concurrent_requests=4))
+        | beam.Map(lambda element: (element[0]['client_id'], element[1]))
+        )
+
+        assert_that(output, equal_to([(f"client-{i}", 204) for i in range(20)]))
+
+      self.assertEqual(collector.request_count, 20)
+
+  def test_async_call_measurement_protocol_api_honours_the_pool_size(self):
+    for sender, limit in [(AsyncCallMeasurementProtocolAPI('G-TEST', 'secret', max_concurrent_requests=4), 4),
+                          (AsyncCallMeasurementProtocolAPI('G-TEST', 'secret', max_concurrent_requests=4, pool_size=2), 2)]:
+      sender.setup()
+      try:
+        self.assertEqual(sender._session.connector.limit, limit)
+      finally:
+        sender.teardown()
+
+  def test_send_to_measurement_protocol_rejects_http2_with_async_http(self):
+    with self.assertRaises(ValueError):
+      SendToMeasurementProtocol('G-TEST', 'secret', use_async_http=True, use_http2=True)
+
+  def test_async_call_measurement_protocol_api_reports_retries(self):
+    INPUT = [{'client_id': f"client-{i}", 'events': [{'name': 'e'}]} for i in range(5)]
+
+    with FakeCollector(throttle_rate=1.0) as collector:
+      p = TestPipeline()
+      _ = (p
+      | beam.Create(INPUT)
+      | beam.ParDo(AsyncCallMeasurementProtocolAPI('G-TEST', 'secret', endpoint=collector.endpoint, max_retries=1, retry_backoff=0))
+      )
+      result = p.run()
+      result.wait_until_finish()
+
+    counters = {counter.key.metric.name: counter.committed for counter in result.metrics().query(MetricsFilter().with_namespace('activation'))['counters']}
+    self.assertEqual(counters['throttled_requests'], 10)
+    self.assertEqual(counters['retried_requests'], 5)
+    self.assertEqual(counters['retry_budget_exhausted'], 5)
+
+  def test_activation_metrics(self):
+    INPUT = [{'client_id': f"client-{i}", 'user_id': None, 'inference_date': '2024-01-01'} for i in range(5)]
+
+    with FakeCollector(error_rate=1.0) as collector:
+      p = TestPipeline()
+      _ = (p
+      | beam.Create(INPUT)
+      | beam.ParDo(TransformToPayload('event'))
+      | beam.ParDo(AsyncCallMeasurementProtocolAPI('G-TEST', 'secret', endpoint=collector.endpoint, max_retries=1, retry_backoff=0))
+      | beam.ParDo(ToLogFormat('run-key')).with_outputs(ToLogFormat.OK, ToLogFormat.FAILED, ToLogFormat.RETRYABLE, main='log')
+      )
+      result = p.run()
+      result.wait_until_finish()
+
+    metrics = result.metrics().query(MetricsFilter().with_namespace('activation'))
+    counters = {counter.key.metric.name: counter.committed for counter in metrics['counters']}
+    distributions = {distribution.key.metric.name: distribution.committed for distribution in metrics['distributions']}
+    self.assertEqual(counters['rows_in'], 5)
+    self.assertEqual(counters['status_500'], 10)
+    self.assertEqual(counters['events_retryable'], 5)
+    self.assertEqual(distributions['request_latency_ms'].count, 10)
+    self.assertEqual(distributions['request_bytes'].count, 5)
+    self.assertEqual(distributions['serialization_time_us'].count, 5)
+    self.assertEqual(distributions['transform_time_us'].count, 5)
+    self.assertEqual(distributions['log_payload_bytes'].sum, distributions['request_bytes'].sum)
+
+  def test_enable_bundle_profiling(self):
+    options = PipelineOptions(['--profile_cpu', '--temp_location', 'gs://bucket/temp/'])
+    enable_bundle_profiling(options)
+    self.assertEqual(options.view_as(ProfilingOptions).profile_location, 'gs://bucket/temp/profiles')
+
+    options = PipelineOptions(['--temp_location', 'gs://bucket/temp'])
+    enable_bundle_profiling(options)
+    self.assertIsNone(options.view_as(ProfilingOptions).profile_location)
+
+  def test_boolean_options_parse_true_and_false(self):
+    required = ['--activation_type', 'cltv-180-30', '--activation_type_configuration', 'gs://bucket/config.json',
+      '--source_table', 'dataset.table', '--ga4_measurement_id', 'G-TEST', '--ga4_api_secret', 'secret', '--log_db_dataset', 'activation']
+
+    options = PipelineOptions(required + ['--use_sent_ledger', 'false', '--deduplicate_payloads', 'True', '--use_http2']).view_as(ActivationOptions)
+
+    self.assertIs(options.use_sent_ledger, False)
+    self.assertIs(options.deduplicate_payloads, True)
+    self.assertIs(options.use_http2, True)
+    self.assertIs(options.use_async_http, False)
+    with self.assertRaises(SystemExit):
+      PipelineOptions(required + ['--use_sent_ledger', 'no']).view_as(ActivationOptions)
+
+  def test_fake_collector_paths_and_injected_errors(self):
+    with FakeCollector() as collector:
+      self.assertEqual(requests.post(f"{collector.endpoint}/mp/collect", data='{"events":[{}]}').status_code, 204)
+      debug_response = requests.post(f"{collector.endpoint}/debug/mp/collect", data='{"events":[{}]}')
+      self.assertEqual(debug_response.status_code, 200)
+      self.assertEqual(debug_response.json(), {'validationMessages': []})
+      self.assertEqual(requests.post(f"{collector.endpoint}/other").status_code, 404)
+
+    with FakeCollector(throttle_rate=0.5, error_rate=0.5, seed=0) as collector:
+      statuses = {requests.post(f"{collector.endpoint}/mp/collect", data='{}').status_code for _ in range(20)}
+
+    self.assertEqual(statuses, {429, 500})
+    self.assertEqual(collector.event_count, 0)
+    self.assertEqual(len(collector.latencies), 20)
+
+  def test_activation_run_key(self):
+    run_key = activation_run_key('purchase-propensity-30-15', 'dataset.predictions', '2024-05-04T02:04:06+00:00')
+
+    self.assertEqual(run_key, activation_run_key('purchase-propensity-30-15', 'dataset.predictions', '2024-05-04T02:04:06+00:00'))
+    self.assertNotEqual(run_key, activation_run_key('purchase-propensity-30-15', 'dataset.predictions', '2024-05-05T02:04:06+00:00'))
+    self.assertEqual(len(run_key), 16)
+
+  def test_date_to_micro_is_utc(self):
+    date_time_format, date_format = '%Y-%m-%d %H:%M:%S.%f %Z', '%Y-%m-%d'
+
+    for tz in ['UTC', 'America/New_York', 'Asia/Kolkata']:
+      with patch.dict(os.environ, {'TZ': tz}):
+        time.tzset()
+        date_to_micro.cache_clear()
+        self.assertEqual(date_to_micro('2024-05-04 02:04:06.123456 UTC', date_time_format, date_format), 1714788246123456)
+        self.assertEqual(date_to_micro('2024-05-04', date_time_format, date_format), 1714780800000000)
+        self.assertEqual(date_to_micro(datetime.datetime(2024, 5, 4, 2, 4, 6, 123456), date_time_format, date_format), 1714788246123456)
+        self.assertEqual(date_to_micro(
+          datetime.datetime(2024, 5, 4, 4, 4, 6, 123456, tzinfo=datetime.timezone(datetime.timedelta(hours=2))), date_time_format, date_format),
+          1714788246123456)
+        self.assertEqual(date_to_micro(datetime.date(2024, 5, 4), date_time_format, date_format), 1714780800000000)
+    time.tzset()
+    date_to_micro.cache_clear()
+
+  def test_exclude_already_sent(self):
+    query = exclude_already_sent('SELECT * FROM test_dataset.test_table', 'project.activation.activation_sent_ledger', 'cltv-180-30')
+
+    self.assertIn('FROM (SELECT * FROM test_dataset.test_table) AS source', query)
+    self.assertIn('FROM `project.activation.activation_sent_ledger`', query)
+    self.assertIn("WHERE activation_type = 'cltv-180-30'", query)
+    self.assertIn('WHERE ledger.client_id IS NULL', query)
+    self.assertIn('ledger.inference_date = source.inference_date', query)
+    self.assertIn(f"ledger.client_id = REGEXP_REPLACE(source.client_id, r'{CLIENT_ID_SANITIZER.pattern}', '')", query)
+    self.assertNotIn("'", CLIENT_ID_SANITIZER.pattern)
+
+    query = exclude_already_sent('SELECT * FROM test_dataset.test_table', 'project.activation.activation_sent_ledger', 'cltv-180-30', include_superseded=True)
+    self.assertIn('ledger.inference_date >= source.inference_date', query)
+
+    with self.assertRaises(ValueError):
+      exclude_already_sent('SELECT * FROM test_dataset.test_table', 'project.activation.activation_sent_ledger', "cltv' OR '1' = '1")
+
+  @patch('main.ga4_properties', return_value={'G-TEST': 'secret'})
+  @patch('main.build_query', return_value='SELECT * FROM test_dataset.test_table')
+  @patch('main.load_activation_type_configuration', return_value={'activation_event_name': 'e'})
+  @patch('main.ensure_sent_ledger_table', return_value='project.activation.activation_sent_ledger')
+  @patch('main.find_sent_ledger_table', return_value=None)
+  def test_prepare_activation_dry_run_does_not_create_the_sent_ledger(self, find_sent_ledger_table, ensure_sent_ledger_table, *_):
+    options = data(activation_type_configuration='gs://bucket/config.json', prediction_snapshot='2024-05-04T02:04:06+00:00',
+      use_sent_ledger=True, deduplicate_payloads=False, project='project', log_db_dataset='activation', dry_run_sample_fraction=0.1)
+
+    activation = prepare_activation(options, 'cltv-180-30', 'test_dataset.test_table')
+
+    ensure_sent_ledger_table.assert_not_called()
+    self.assertEqual(activation['query'], 'SELECT * FROM test_dataset.test_table')
+
+    find_sent_ledger_table.return_value = 'project.activation.activation_sent_ledger'
+    activation = prepare_activation(options, 'cltv-180-30', 'test_dataset.test_table')
+
+    ensure_sent_ledger_table.assert_not_called()
+    self.assertIn('FROM `project.activation.activation_sent_ledger`', activation['query'])
+
+    options.dry_run_sample_fraction = None
+    prepare_activation(options, 'cltv-180-30', 'test_dataset.test_table')
+
+    ensure_sent_ledger_table.assert_called_once_with('project', 'activation')
+
+  def test_merge_duplicate_payloads(self):
+    def payload(timestamp, user_properties, events):
+      return {'client_id': 'a', 'timestamp_micros': timestamp, 'user_properties': user_properties, 'events': events}
+
+    payloads = [
+      payload(1, {'decile': {'value': '2'}}, [{'name': 'e', 'params': {'p': 1}}]),
+      payload(3, {'decile': {'value': '1'}}, [{'name': 'e', 'params': {'p': 3}}]),
+      payload(2, {'decile': {'value': '1'}, 'segment': {'value': 'x'}}, [{'name': 'e', 'params': {'p': 2}}]),
+      payload(3, {'decile': {'value': '1'}}, [{'name': 'e', 'params': {'p': 3}}]),
+    ]
+
+    merged = list(MergeDuplicatePayloads().process((('a', None), payloads)))
+
+    self.assertEqual(merged, [
+      payload(3, {'decile': {'value': '1'}, 'segment': {'value': 'x'}}, [{'name': 'e', 'params': {'p': 3}}, {'name': 'e', 'params': {'p': 2}}]),
+      payload(1, {'decile': {'value': '2'}}, [{'name': 'e', 'params': {'p': 1}}]),
+    ])
+
+  def test_merge_duplicate_payloads_splits_full_requests(self):
+    payloads = [{'client_id': 'a', 'timestamp_micros': i, 'user_properties': {}, 'events': [{'name': 'e', 'params': {'p': i}}]} for i in range(5)]
+
+    merged = list(MergeDuplicatePayloads(max_events_per_request=2).process((('a', None), payloads)))
+
+    self.assertEqual([len(payload['events']) for payload in merged], [2, 2, 1])
+    self.assertEqual({payload['timestamp_micros'] for payload in merged}, {4})
+
+  def test_merge_duplicate_payloads_deduplicates_events_across_full_requests(self):
+    payloads = [{'client_id': 'a', 'timestamp_micros': i, 'user_properties': {}, 'events': [{'name': 'e', 'params': {'p': i % 3}}]} for i in range(6)]
+
+    merged = list(MergeDuplicatePayloads(max_events_per_request=2).process((('a', None), payloads)))
+
+    self.assertEqual([payload['events'] for payload in merged], [
+      [{'name': 'e', 'params': {'p': 2}}, {'name': 'e', 'params': {'p': 1}}],
+      [{'name': 'e', 'params': {'p': 0}}],
+    ])
+
+  def test_send_to_measurement_protocol_deduplicates_payloads(self):
+    INPUT = [{'client_id': client_id, 'timestamp_micros': 1, 'user_properties': {'decile': {'value': decile}}, 'events': [{'name': 'e'}]}
+      for client_id, decile in [('a', '1'), ('a', '1'), ('a', '1'), ('a', '2'), ('b', '1')]]
+
+    with FakeCollector() as collector:
+      p = TestPipeline()
+      _ = (p
+      | beam.Create(INPUT)
+      | SendToMeasurementProtocol('G-TEST', 'secret', endpoint=collector.endpoint, deduplicate=True)
+      )
+      result = p.run()
+      result.wait_until_finish()
+
+    counters = {counter.key.metric.name: counter.committed for counter in result.metrics().query(MetricsFilter().with_namespace('activation'))['counters']}
+    self.assertEqual(counters['deduplicated_payloads'], 2)
+    self.assertEqual(counters['conflicting_payloads'], 1)
+    self.assertEqual(collector.request_count, 3)
+
+  def test_to_log_format_routes_by_outcome(self):
+    INPUT = [
+      ({'client_id': 'client-a', 'events': [{'name': 'e'}]}, 204, b''),
+      ({'client_id': 'client-b', 'events': [{'name': 'e'}]}, 400, b''),
+      ({'client_id': 'client-c', 'events': [{'name': 'e'}]}, 429, b''),
+      ({'client_id': 'client-d', 'events': [{'name': 'e'}]}, 0, b''),
+    ]
+
+    with TestPipeline() as p:
+      outputs = (p
+      | beam.Create(INPUT)
+      | beam.ParDo(ToLogFormat('run-key')).with_outputs(ToLogFormat.OK, ToLogFormat.FAILED, ToLogFormat.RETRYABLE, main='log'))
+
+      assert_that(outputs.log | 'States' >> beam.Map(lambda row: (row['activation_id'], row['latest_state'], row['activation_run_key'])),
+        equal_to([('e', 'SEND_OK 204', 'run-key'), ('e', 'SEND_FAIL 400', 'run-key'), ('e', 'SEND_FAIL 429', 'run-key'), ('e', 'SEND_FAIL 0', 'run-key')]), label='log')
+      assert_that(outputs[ToLogFormat.OK] | 'Ok' >> beam.Map(lambda element: element[0]['client_id']), equal_to(['client-a']), label='ok')
+      assert_that(outputs[ToLogFormat.FAILED] | 'Failed' >> beam.Map(lambda element: element[0]['client_id']), equal_to(['client-b']), label='failed')
+      assert_that(outputs[ToLogFormat.RETRYABLE] | 'Retryable' >> beam.Map(lambda element: element[0]['client_id']), equal_to(['client-c', 'client-d']), label='retryable')
+
+  def test_transform_to_payload_sanitizes_client_id(self):
+    transform = TransformToPayload('test_activation_name')
+    element = {
+      'client_id': '<img onerror="_exploit_dom_xss(20007)123.456q="><script>_exploit_dom_xss(40013)</script>',
+      'user_id': None,
+      'inference_date': '2023-02-25 00:00:00.000000 UTC',
+    }
+
+    payload = next(transform.process(element))
+
+    self.assertEqual(payload['client_id'], '123.456')
+    self.assertEqual(payload['timestamp_micros'], 1677283200000000)
+
+  def test_transform_to_payload_plan(self):
+    transform = TransformToPayload('test_activation_name')
+    element = {
+      'client_id': 'client-a',
+      'user_id': None,
+      'inference_date': '2023-02-25',
+      'feature': 1,
+      'user_prop_p_p_decile': 3,
+      'user_prop_empty': None,
+      'event_param_prediction_prob': Decimal('0.5'),
+    }
+
+    payload = next(transform.process(element))
+
+    self.assertEqual(payload['user_properties'], {'p_p_decile': {'value': '3'}})
+    self.assertEqual(payload['events'], [{'name': 'test_activation_name', 'params': {'prediction_prob': Decimal('0.5')}}])
+    self.assertIs(transform.payload_plan(dict(element)), transform.payload_plan(element))
+
+  def test_to_log_format_reuses_serialized_payload(self):
+    element = ({'client_id': 'client-a', 'events': [{'name': 'e', 'params': {'value': Decimal('1.5')}}]}, 204, b'')
+
+    reused = next(ToLogFormat('run-key').process(element + (b'{"serialized":true}',)))
+    serialized = next(ToLogFormat('run-key').process(element))
+
+    self.assertEqual(reused['payload'], '{"serialized":true}')
+    self.assertEqual(json.loads(serialized['payload']), {'client_id': 'client-a', 'events': [{'name': 'e', 'params': {'value': 1.5}}]})
+
+  def test_to_log_format_omits_success_payloads(self):
+    sent = ({'client_id': 'client-a', 'events': [{'name': 'e'}]}, 204, b'', b'{"client_id":"client-a"}')
+    failed = ({'client_id': 'client-b', 'events': [{'name': 'e'}]}, 400, b'', b'{"client_id":"client-b"}')
+
+    self.assertIsNone(next(ToLogFormat('run-key', log_success_payloads=False).process(sent))['payload'])
+    self.assertEqual(next(ToLogFormat('run-key', log_success_payloads=False).process(failed))['payload'], '{"client_id":"client-b"}')
+    self.assertEqual(next(ToLogFormat('run-key', log_success_payloads=True).process(sent))['payload'], '{"client_id":"client-a"}')
+
+  @patch('main.google_bigquery.Client')
+  def test_ensure_activation_log_table_updates_existing_table(self, mock_bigquery):
+    import main
+    existing = main.google_bigquery.Table('project.activation.activation_log', schema=[
+      main.google_bigquery.SchemaField(field['name'], field['type'], mode='REQUIRED') for field in main.ACTIVATION_LOG_SCHEMA['fields']
+    ])
+    mock_bigquery.return_value.create_table.return_value = existing
+
+    self.assertEqual(ensure_activation_log_table('project', 'activation'), 'project.activation.activation_log')
+
+    created = mock_bigquery.return_value.create_table.call_args[0][0]
+    self.assertEqual(created.clustering_fields, ['activation_id'])
+    self.assertEqual(created.time_partitioning.field, 'updated_at')
+    mock_bigquery.return_value.update_table.assert_called_once_with(existing, ['schema', 'clustering_fields'])
+    self.assertEqual(existing.clustering_fields, ['activation_id'])
+    self.assertEqual({field.name: field.mode for field in existing.schema}['payload'], 'NULLABLE')
+
+    mock_bigquery.return_value.update_table.reset_mock()
+    mock_bigquery.return_value.create_table.return_value = created
+    ensure_activation_log_table('project', 'activation')
+    mock_bigquery.return_value.update_table.assert_not_called()
+
+  def test_to_sent_ledger_format(self):
+    element = ({'client_id': 'client-a', 'timestamp_micros': 1677283200123456, 'events': [{'name': 'e'}]}, 204, b'')
+
+    row = next(ToSentLedgerFormat('cltv-180-30', 'run-key').process(element))
+
+    self.assertEqual(row['client_id'], 'client-a')
+    self.assertEqual(row['activation_type'], 'cltv-180-30')
+    self.assertEqual(row['inference_date'], '2023-02-25 00:00:00.123456+00:00')
+    self.assertEqual(row['activation_run_key'], 'run-key')
+
+  def test_date_to_micro_accepts_storage_read_api_values(self):
+    transform = TransformToPayload('test_activation_name')
+
+    self.assertEqual(transform.date_to_micro('2023-02-25'), 1677283200000000)
+    self.assertEqual(transform.date_to_micro('2023-02-25 00:00:00.123456 UTC'), 1677283200123456)
+    self.assertEqual(transform.date_to_micro(datetime.date(2023, 2, 25)), 1677283200000000)
+    self.assertEqual(transform.date_to_micro(datetime.datetime(2023, 2, 25, 0, 0, 0, 123456, tzinfo=datetime.timezone.utc)), 1677283200123456)
+
+  def test_call_measurement_protocol_api_encodes_storage_read_api_values(self):
+    sender = CallMeasurementProtocolAPI('G-TEST', 'secret', max_retries=0)
+    sender.setup()
+    sender.post = MagicMock(return_value=MagicMock(status_code=204, content=b''))
+    element = {'client_id': 'client-a', 'events': [{'name': 'e', 'params': {'value': Decimal('22.4'), 'date': datetime.date(2023, 2, 25)}}]}
+
+    result = next(sender.process(element))
+    sender.teardown()
+
+    self.assertEqual(result[1], 204)
+    self.assertEqual(json.loads(sender.post.call_args[0][0])['events'][0]['params'], {'value': 22.4, 'date': '2023-02-25'})
+
+  def test_read_from_source(self):
+    direct_read = read_from_source(data(project='test-project', read_method='DIRECT_READ', use_arrow_format=True), 'SELECT 1')
+    export = read_from_source(data(project='test-project', read_method='EXPORT', use_arrow_format=False), 'SELECT 1')
+
+    self.assertEqual(direct_read.method, beam.io.ReadFromBigQuery.Method.DIRECT_READ)
+    self.assertTrue(direct_read.use_native_datetime)
+    self.assertEqual(export.method, beam.io.ReadFromBigQuery.Method.EXPORT)
+    with self.assertRaises(ValueError):
+      read_from_source(data(project='test-project', read_method='EXPORT', use_arrow_format=True), 'SELECT 1')
+
+  @patch('main.google_bigquery.Client')
+  def test_query_source_table(self, mock_bigquery):
+    mock_bigquery.return_value.query.return_value.result.return_value = [{'client_id': 'client-a'}, {'client_id': 'client-b'}]
+    query_source_table = QuerySourceTable('test-project', {'cltv-180-30': 'SELECT * FROM `{{source_table}}`'})
+    query_source_table.setup()
+
+    rows = list(query_source_table.process(b'{"activation_type": "cltv-180-30", "source_table": "project.dataset.predictions"}'))
+    ignored = list(query_source_table.process(b'{"activation_type": "unknown", "source_table": "project.dataset.predictions"}'))
+    malformed = list(query_source_table.process(b'not json'))
+
+    mock_bigquery.return_value.query.assert_called_once_with('SELECT * FROM `project.dataset.predictions`')
+    self.assertEqual(rows, [('cltv-180-30', {'client_id': 'client-a'}), ('cltv-180-30', {'client_id': 'client-b'})])
+    self.assertEqual(ignored, [])
+    self.assertEqual(malformed, [])
+
+  def fake_configuration_bucket(self, mock_storage, mock_gcs_read_file, files):
+    def list_blobs(bucket_name, prefix=None, delimiter=None):
+      blobs = []
+      for path, content in files.items():
+        if path.startswith(f"gs://{bucket_name}/{prefix or ''}"):
+          blob = MagicMock(md5_hash=base64.b64encode(hashlib.md5(content.encode()).digest()).decode(), crc32c=None)
+          blob.name = path[len(f"gs://{bucket_name}/"):]
+          blobs.append(blob)
+      return blobs
+    mock_storage.return_value.list_blobs.side_effect = list_blobs
+    mock_storage.return_value.bucket.return_value.blob.return_value.download_as_text.side_effect = google_exceptions.NotFound('no cache entry')
+    mock_gcs_read_file.side_effect = lambda project, path: files[path]
+
+  @patch('main.CONFIGURATION_CACHE_DIR', tempfile.mkdtemp())
+  @patch('main._CONFIGURATION_CACHE', {})
+  @patch('main.gcs_read_file')
+  @patch('main.storage.Client')
+  def test_load_compiled_configuration(self, mock_storage, mock_gcs_read_file):
+    files = {
+      'gs://bucket/configuration/config.json': json.dumps({
+        'cltv-180-30': {'activation_event_name': 'maj_cltv_180_30', 'source_query_template': 'gs://bucket/configuration/cltv.sqlx'},
+        'cltv-180-90': {'activation_event_name': 'maj_cltv_180_90', 'source_query_template': 'gs://bucket/configuration/cltv.sqlx'},
+      }),
+      'gs://bucket/configuration/cltv.sqlx': 'SELECT *\nFROM `{{source_table}}`'
+    }
+    self.fake_configuration_bucket(mock_storage, mock_gcs_read_file, files)
+
+    entry, templates = load_compiled_configuration('test-project', 'gs://bucket/configuration/config.json')
+    self.assertEqual(templates['gs://bucket/configuration/cltv.sqlx'].render(source_table='dataset.predictions'), 'SELECT * FROM `dataset.predictions`')
+    self.assertEqual(mock_gcs_read_file.call_count, 2)
+
+    # An unchanged configuration is loaded from the local cache, without reading the files.
+    with patch('main._CONFIGURATION_CACHE', {}):
+      cached_entry, cached_templates = load_compiled_configuration('test-project', 'gs://bucket/configuration/config.json')
+    self.assertEqual(cached_entry, entry)
+    self.assertEqual(cached_templates['gs://bucket/configuration/cltv.sqlx'].render(source_table='dataset.predictions'), 'SELECT * FROM `dataset.predictions`')
+    self.assertEqual(mock_gcs_read_file.call_count, 2)
+
+    # A changed query template is compiled again.
+    files['gs://bucket/configuration/cltv.sqlx'] = 'SELECT client_id FROM `{{source_table}}`'
+    _, templates = load_compiled_configuration('test-project', 'gs://bucket/configuration/config.json')
+    self.assertEqual(templates['gs://bucket/configuration/cltv.sqlx'].render(source_table='dataset.predictions'), 'SELECT client_id FROM `dataset.predictions`')
+    self.assertEqual(mock_gcs_read_file.call_count, 4)
+
+  @patch('main.CONFIGURATION_CACHE_DIR', tempfile.mkdtemp())
+  @patch('main._CONFIGURATION_CACHE', {})
+  @patch('main.gcs_read_file')
+  @patch('main.storage.Client')
+  def test_load_compiled_configuration_of_an_activation_type(self, mock_storage, mock_gcs_read_file):
+    files = {
+      'gs://bucket/configuration/config.json': json.dumps({
+        'cltv-180-30': {'activation_event_name': 'maj_cltv_180_30', 'source_query_template': 'gs://bucket/configuration/cltv.sqlx'},
+        'purchase-propensity-30-15': {'activation_event_name': 'maj_purchase_propensity_30_15', 'source_query_template': 'gs://bucket/configuration/purchase.sqlx'},
+      }),
+      'gs://bucket/configuration/cltv.sqlx': 'SELECT * FROM `{{source_table}}`',
+      'gs://bucket/configuration/purchase.sqlx': 'SELECT client_id FROM `{{source_table}}`'
+    }
+    self.fake_configuration_bucket(mock_storage, mock_gcs_read_file, files)
+
+    # Only the configuration file and the query template of the activation type are read and compiled.
+    _, templates = load_compiled_configuration('test-project', 'gs://bucket/configuration/config.json', activation_type='cltv-180-30')
+    self.assertEqual(list(templates), ['gs://bucket/configuration/cltv.sqlx'])
+    self.assertEqual([c.args[1] for c in mock_gcs_read_file.call_args_list], ['gs://bucket/configuration/config.json', 'gs://bucket/configuration/cltv.sqlx'])
+
+    # Templates compiled by another Jinja version are compiled again.
+    with patch('main._CONFIGURATION_CACHE', {}), patch('main.jinja2.__version__', '0.0.0'):
+      load_compiled_configuration('test-project', 'gs://bucket/configuration/config.json', activation_type='cltv-180-30')
+    self.assertEqual(mock_gcs_read_file.call_count, 4)
+
+  @patch('main.CONFIGURATION_CACHE_DIR', tempfile.mkdtemp())
+  @patch('main._CONFIGURATION_CACHE', {})
+  @patch('main.gcs_read_file')
+  @patch('main.storage.Client')
+  def test_load_activation_types_query_templates(self, mock_storage, mock_gcs_read_file):
+    files = {
+      'gs://bucket/config.json': json.dumps({
+        'cltv-180-30': {'activation_event_name': 'maj_cltv_180_30', 'source_query_template': 'gs://bucket/cltv.sqlx'},
+        'cltv-180-90': {'activation_event_name': 'maj_cltv_180_90', 'source_query_template': 'gs://bucket/cltv.sqlx'},
+      }),
+      'gs://bucket/cltv.sqlx': 'SELECT *\nFROM `{{source_table}}`'
+    }
+    self.fake_configuration_bucket(mock_storage, mock_gcs_read_file, files)
+
+    configuration = load_activation_types_query_templates(data(project='test-project', activation_type_configuration='gs://bucket/config.json', cache_configuration_in_gcs=False))
+
+    self.assertEqual(configuration, {
+      'cltv-180-30': {'activation_event_name': 'maj_cltv_180_30', 'source_query_template': 'SELECT * FROM `{{source_table}}`'},
+      'cltv-180-90': {'activation_event_name': 'maj_cltv_180_90', 'source_query_template': 'SELECT * FROM `{{source_table}}`'},
+    })
+    self.assertEqual(mock_gcs_read_file.call_count, 2)
+
   @patch('google.cloud.storage.Client')
   def test_gcs_read_file(self, mock_storage):
     mock_client = MagicMock()
@@ -108,5 +675,124 @@ class CountTest(unittest.TestCase):
     mock_client.bucket.assert_called_with('test-bucket')
     mock_bucket.blob.assert_called_with('test-file')
 
+  def test_ga4_properties(self):
+    options = data(ga4_measurement_id='G-DEFAULT', ga4_api_secret='default-secret', ga4_api_secrets='{"G-EU": "eu-secret"}')
+
+    self.assertEqual(ga4_properties(options, {}), {'G-DEFAULT': 'default-secret', 'G-EU': 'eu-secret'})
+    self.assertEqual(ga4_properties(options, {'ga4_measurement_id': 'G-EU'}), {'G-EU': 'eu-secret'})
+    self.assertEqual(ga4_properties(options, {'ga4_measurement_id': 'G-DEFAULT'}), {'G-DEFAULT': 'default-secret', 'G-EU': 'eu-secret'})
+
+    # The API secret of the job belongs to the Measurement ID of the job, not to the property of the activation type.
+    with self.assertRaises(ValueError):
+      ga4_properties(options, {'ga4_measurement_id': 'G-APP'})
+
+    options.ga4_api_secrets = '["eu-secret"]'
+    with self.assertRaises(ValueError):
+      ga4_properties(options, {})
+
+  def test_property_partition(self):
+    indexes = {'G-DEFAULT': 0, 'G-EU': 1}
+
+    self.assertEqual(property_partition({'property': 'G-EU'}, 3, 'property', indexes), 1)
+    self.assertEqual(property_partition({'property': None}, 3, 'property', indexes), 0)
+    self.assertEqual(property_partition({'property': 'G-US'}, 3, 'property', indexes), 2)
+    self.assertEqual(property_partition({'property': 'G-EU'}, 3, None, indexes), 0)
+
+  def test_send_to_properties(self):
+    options = data(ga4_measurement_id='G-DEFAULT', ga4_api_secret='default-secret', ga4_property_column='property',
+      use_api_validation=False, send_batch_size=10, use_async_http=False, max_concurrent_requests=10, http_pool_size=10,
+      http_connect_timeout=5, http_read_timeout=5, use_http2=False, max_requests_per_second=0, max_send_retries=0,
+      retry_backoff_seconds=0, deduplicate_payloads=False, measurement_protocol_endpoint='https://www.google-analytics.com')
+    rows = [
+      {'client_id': 'a', 'user_id': None, 'inference_date': '2024-01-01', 'property': 'G-EU'},
+      {'client_id': 'b', 'user_id': None, 'inference_date': '2024-01-01', 'property': 'G-US'},
+    ]
+    sent = []
+
+    def post(url, **kwargs):
+      sent.append(url)
+      return MagicMock(status_code=204, content=b'')
+
+    with patch('main.requests.Session') as mock_session:
+      mock_session.return_value.post.side_effect = post
+      with TestPipeline() as p:
+        responses = send_to_properties(p | beam.Create(rows), options, {'G-DEFAULT': 'default-secret', 'G-EU': 'eu-secret'}, 'event')
+        assert_that(responses | beam.Map(lambda response: (response[0]['client_id'], response[1])),
+          equal_to([('a', 204), ('b', UNKNOWN_PROPERTY_STATUS_CODE)]))
+
+    self.assertEqual(len(sent), 1)
+    self.assertIn('measurement_id=G-EU', sent[0])
+
+  def test_sample_users(self):
+    rows = [{'client_id': f"client-{i}"} for i in range(1000)]
+
+    sampled = [row for row in rows for _ in SampleUsers(0.1).process(row)]
+
+    self.assertGreater(len(sampled), 50)
+    self.assertLess(len(sampled), 150)
+    self.assertEqual(sampled, [row for row in rows for _ in SampleUsers(0.1).process(row)])
+    self.assertEqual(len([row for row in rows for _ in SampleUsers(1).process(row)]), 1000)
+
+  @patch('main.estimate_query_bytes', return_value=2 ** 40)
+  @patch('main.read_from_source')
+  def test_run_dry_run(self, mock_read_from_source, mock_estimate_query_bytes):
+    rows = [{'client_id': f"client-{i}", 'user_id': None, 'inference_date': '2024-01-01'} for i in range(200)]
+    mock_read_from_source.return_value = beam.Create(rows)
+
+    with FakeCollector() as collector, tempfile.TemporaryDirectory() as temp_location:
+      options = data(project='project', activation_type=None, ga4_measurement_id='G-TEST', ga4_api_secret='secret',
+        ga4_property_column=None, use_api_validation=False, send_batch_size=1, use_async_http=False, max_concurrent_requests=10,
+        http_pool_size=10, http_connect_timeout=5, http_read_timeout=5, use_http2=False, max_requests_per_second=0,
+        max_send_retries=0, retry_backoff_seconds=0, deduplicate_payloads=False, log_success_payloads=False,
+        dry_run_sample_fraction=0.5, measurement_protocol_endpoint=collector.endpoint)
+      report = run_dry_run(PipelineOptions(['--temp_location', temp_location]), options, 'cltv-180-30', 'SELECT 1', {'G-TEST': 'secret'}, 'event')
+      stored = json.loads(open(glob.glob(f"{temp_location}/dry_run/cltv-180-30-*.json")[0]).read())
+
+    self.assertEqual(report, stored)
+    self.assertEqual(report['rows'], 200)
+    self.assertEqual(report['sampled_requests'], collector.request_count)
+    self.assertEqual(report['sampled_events'], report['sampled_rows'])
+    self.assertEqual(report['projected_requests'], round(report['sampled_requests'] / 0.5))
+    self.assertEqual(report['projected_query_cost_usd'], 6.25)
+
+  def test_parse_activations(self):
+    options = data(activations=None, activation_type='cltv-180-30', source_table='dataset.predictions')
+    self.assertEqual(parse_activations(options), [('cltv-180-30', 'dataset.predictions')])
+
+    options.activations = json.dumps([
+      {'activation_type': 'cltv-180-30', 'source_table': 'dataset.cltv'},
+      {'activation_type': 'purchase-propensity-30-15', 'source_table': 'dataset.propensity'},
+      {'activation_type': 'cltv-180-30', 'source_table': 'dataset.cltv'},
+    ])
+    self.assertEqual(parse_activations(options), [('cltv-180-30', 'dataset.cltv'), ('purchase-propensity-30-15', 'dataset.propensity')])
+
+    for activations in ('[]', '{}', '[{"activation_type": "cltv-180-30"}]'):
+      options.activations = activations
+      with self.assertRaises(ValueError):
+        parse_activations(options)
+
+    options = data(activations=None, activation_type=None, source_table='dataset.predictions')
+    with self.assertRaises(ValueError):
+      parse_activations(options)
+
+  @patch('main.read_from_source')
+  def test_activate_several_activations(self, mock_read_from_source):
+    mock_read_from_source.side_effect = lambda args, query: beam.Create(
+      [{'client_id': f"{query}-{i}", 'user_id': None, 'inference_date': '2024-01-01'} for i in range(3)])
+
+    with FakeCollector() as collector:
+      options = data(ga4_measurement_id='G-TEST', ga4_api_secret='secret', ga4_property_column=None, use_api_validation=False,
+        send_batch_size=1, use_async_http=False, max_concurrent_requests=10, http_pool_size=10, http_connect_timeout=5,
+        http_read_timeout=5, use_http2=False, max_requests_per_second=0, max_send_retries=0, retry_backoff_seconds=0,
+        deduplicate_payloads=False, measurement_protocol_endpoint=collector.endpoint)
+      with TestPipeline() as p:
+        responses = [
+          p | f"Activate {query}" >> Activate(options, {'query': query, 'properties': {'G-TEST': 'secret'}, 'event_name': query})
+          for query in ('cltv', 'propensity')]
+        assert_that((responses | beam.Flatten()) | beam.Map(lambda response: (response[0]['events'][0]['name'], response[1])),
+          equal_to([('cltv', 204)] * 3 + [('propensity', 204)] * 3))
+
+    self.assertEqual(collector.request_count, 6)
+
 if __name__ == '__main__':
   unittest.main()
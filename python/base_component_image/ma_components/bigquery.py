@@ -0,0 +1,318 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import functools
+import logging
+import re
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import google.auth
+from google.api_core import exceptions
+from google.api_core.gapic_v1.client_info import ClientInfo
+from google.auth.transport.requests import AuthorizedSession
+from google.cloud import bigquery
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Maximum number of pooled keep-alive connections to the BigQuery API.
+BIGQUERY_CONNECTION_POOL_SIZE = 10
+
+# Number of times a request failing to connect to the BigQuery API is retried by the HTTP session.
+BIGQUERY_CONNECT_RETRIES = 3
+
+# Number of seconds a request to the BigQuery API may wait for a response when the caller sets no timeout.
+BIGQUERY_REQUEST_TIMEOUT_SECONDS = 120
+
+# Schema of the table collecting the statistics of the BigQuery jobs of the pipelines.
+PIPELINE_JOB_STATS_SCHEMA = [
+    bigquery.SchemaField("run_date", "DATE", mode="REQUIRED"),
+    bigquery.SchemaField("pipeline", "STRING"),
+    bigquery.SchemaField("pipeline_job_name", "STRING"),
+    bigquery.SchemaField("step", "STRING"),
+    bigquery.SchemaField("job_id", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("parent_job_id", "STRING"),
+    bigquery.SchemaField("statement_type", "STRING"),
+    bigquery.SchemaField("created", "TIMESTAMP"),
+    bigquery.SchemaField("duration_ms", "INT64"),
+    bigquery.SchemaField("total_bytes_processed", "INT64"),
+    bigquery.SchemaField("total_bytes_billed", "INT64"),
+    bigquery.SchemaField("total_slot_ms", "INT64"),
+    bigquery.SchemaField("cache_hit", "BOOL"),
+]
+
+
+@functools.lru_cache(maxsize=None)
+def get_credentials():
+    """Returns the default credentials of the component, shared by all the clients.
+
+    The credentials are looked up once, so that the clients share the same access token
+    and refresh it once instead of once per client.
+
+    Returns:
+        A tuple containing the credentials and the project ID of the environment.
+    """
+    return google.auth.default(scopes=bigquery.Client.SCOPE)
+
+
+class TimeoutAuthorizedSession(AuthorizedSession):
+    """An authorized session applying a default timeout to the requests sent without a timeout.
+
+    The BigQuery client sends its requests without a timeout unless the caller sets one. A request stalled on a
+    dead connection then fails with a timeout, which the default retry of the client methods retries,
+    instead of blocking the pipeline step until the step itself times out.
+    """
+
+    def request(self, method, url, data=None, headers=None, timeout=None, **kwargs):
+        return super().request(
+            method, url, data=data, headers=headers, timeout=timeout or BIGQUERY_REQUEST_TIMEOUT_SECONDS, **kwargs)
+
+
+@functools.lru_cache(maxsize=None)
+def get_http_session() -> AuthorizedSession:
+    """Returns the authorized HTTP session shared by all the BigQuery clients.
+
+    The session keeps a pool of keep-alive connections, so that the requests of the clients
+    reuse the TLS connections instead of opening a new connection per client. It is also the
+    one place defining the retry policy of the connection errors and the default timeout of the requests of all the clients.
+
+    Returns:
+        The authorized HTTP session.
+    """
+    credentials, _ = get_credentials()
+    session = TimeoutAuthorizedSession(credentials)
+    adapter = HTTPAdapter(
+        pool_connections=BIGQUERY_CONNECTION_POOL_SIZE,
+        pool_maxsize=BIGQUERY_CONNECTION_POOL_SIZE,
+        max_retries=Retry(connect=BIGQUERY_CONNECT_RETRIES, read=0, status=0, backoff_factor=0.5)
+    )
+    session.mount("https://", adapter)
+    return session
+
+
+@functools.lru_cache(maxsize=None)
+def get_bigquery_client(
+        project: str,
+        location: Optional[str] = None,
+        user_agent: Optional[str] = None) -> bigquery.Client:
+    """Returns the BigQuery client of a project, location and user agent.
+
+    The clients are cached, so that the calls with the same arguments return the same client.
+    All the clients share the credentials and the HTTP session of the component, so that their requests
+    inherit its connection retries and default timeout. The client methods retry the failed requests,
+    including the timed out ones, with `bigquery.DEFAULT_RETRY`.
+
+    Args:
+        project: The Google Cloud project ID of the client.
+        location: The default location of the jobs and datasets of the client.
+        user_agent: The user agent of the requests of the client.
+
+    Returns:
+        The BigQuery client.
+    """
+    credentials, _ = get_credentials()
+    return bigquery.Client(
+        project=project,
+        location=location,
+        credentials=credentials,
+        client_info=ClientInfo(user_agent=user_agent) if user_agent else None,
+        _http=get_http_session()
+    )
+
+
+def dry_run_query(
+        client: bigquery.Client,
+        query: str,
+        job_config: Optional[bigquery.QueryJobConfig] = None,
+        location: Optional[str] = None,
+        maximum_bytes_billed: int = 0,
+        metrics=None) -> Optional[int]:
+    """Validates a query with a dry run before running it and records its estimated cost.
+
+    The dry run is free, it reports the bytes the query would process and the tables it references
+    without running the query. The dry run of a script or of a stored procedure call only validates it:
+    the bytes processed by its statements are unknown until they run, so it is not estimated, records no
+    metrics and is not checked against the maximum bytes billed.
+
+    Args:
+        client: The BigQuery client running the query.
+        query: The query to estimate.
+        job_config: The configuration of the query job, copied for the dry run.
+        location: The location of the query job.
+        maximum_bytes_billed: The maximum number of bytes the query may process. 0 for no limit.
+        metrics: The KFP Metrics artifact recording the estimation, if set.
+
+    Returns:
+        The number of bytes the query would process, or None if the query is not estimated.
+
+    Raises:
+        ValueError: If the query would process more bytes than the maximum bytes billed.
+    """
+    dry_run_config = bigquery.QueryJobConfig.from_api_repr(job_config.to_api_repr()) if job_config else bigquery.QueryJobConfig()
+    dry_run_config.dry_run = True
+    dry_run_config.use_query_cache = False
+    try:
+        dry_run_job = client.query(query=query, job_config=dry_run_config, location=location)
+    except exceptions.BadRequest as e:
+        logging.warning(f"The query cannot be estimated by a dry run: {e}")
+        return None
+
+    if dry_run_job.statement_type == "SCRIPT" or re.match(r"\s*CALL\b", query, re.IGNORECASE):
+        logging.info("The query is a script or a stored procedure call, its cost is not estimated by a dry run")
+        return None
+
+    bytes_processed = dry_run_job.total_bytes_processed or 0
+    referenced_tables = sorted(f"{t.project}.{t.dataset_id}.{t.table_id}" for t in dry_run_job.referenced_tables)
+    logging.info(f"The query would process {bytes_processed} bytes of the tables {referenced_tables}")
+    if metrics is not None:
+        metrics.log_metric("dry_run_bytes_processed", bytes_processed)
+        metrics.log_metric("dry_run_referenced_tables", len(referenced_tables))
+        metrics.metadata["dry_run_referenced_tables"] = referenced_tables
+
+    if maximum_bytes_billed and bytes_processed > maximum_bytes_billed:
+        raise ValueError(
+            f"The query would process {bytes_processed} bytes, more than the maximum bytes billed of {maximum_bytes_billed}")
+    return bytes_processed
+
+
+def pipeline_from_job_name(pipeline_job_name: Optional[str]) -> Optional[str]:
+    """Returns the name of the pipeline of a pipeline job, without the timestamp suffix of the job name.
+
+    Args:
+        pipeline_job_name: The name of the pipeline job, such as `dsl.PIPELINE_JOB_NAME_PLACEHOLDER`.
+
+    Returns:
+        The name of the pipeline.
+    """
+    if not pipeline_job_name:
+        return None
+    return re.sub(r"-\d{14}$", "", pipeline_job_name)
+
+
+def called_procedure(query: str) -> Optional[str]:
+    """Returns the stored procedure called by a query.
+
+    Args:
+        query: The query.
+
+    Returns:
+        The dataset and name of the first stored procedure called by the query, or None if the query calls no procedure.
+    """
+    matches = re.search(r"CALL\s+`?([\w\-.]+)`?", query or "", re.IGNORECASE)
+    if not matches:
+        return None
+    return ".".join(matches.group(1).split(".")[-2:])
+
+
+def job_labels(pipeline_job_name: Optional[str], step_name: Optional[str]) -> Dict[str, str]:
+    """Builds the labels of a BigQuery job, so that the billing export can be broken down by pipeline and step.
+
+    Args:
+        pipeline_job_name: The name of the pipeline job.
+        step_name: The name of the pipeline step.
+
+    Returns:
+        A dictionary of the labels, with the values sanitized to the BigQuery label format.
+    """
+    labels = {"pipeline": pipeline_from_job_name(pipeline_job_name), "step": step_name}
+    return {
+        key: re.sub(r"[^a-z0-9_-]", "_", value.lower())[:63]
+        for key, value in labels.items() if value
+    }
+
+
+def _job_statistics(query_job, parent_job_id: Optional[str] = None) -> Dict:
+    duration_ms = None
+    if query_job.started and query_job.ended:
+        duration_ms = int((query_job.ended - query_job.started).total_seconds() * 1000)
+    return {
+        "job_id": query_job.job_id,
+        "parent_job_id": parent_job_id,
+        "statement_type": query_job.statement_type,
+        "created": query_job.created.isoformat() if query_job.created else None,
+        "duration_ms": duration_ms,
+        "total_bytes_processed": query_job.total_bytes_processed or 0,
+        "total_bytes_billed": query_job.total_bytes_billed or 0,
+        "total_slot_ms": query_job.slot_millis or 0,
+        "cache_hit": bool(query_job.cache_hit),
+    }
+
+
+def record_job_statistics(
+        client: bigquery.Client,
+        query_job: bigquery.QueryJob,
+        metrics=None,
+        job_stats_table: Optional[str] = None,
+        pipeline_job_name: Optional[str] = None,
+        step_name: Optional[str] = None) -> List[Dict]:
+    """Records the statistics of a completed query job and of its child jobs.
+
+    The child jobs are the statements of a script or of a stored procedure, so that the cost of every statement is recorded.
+    The totals of the job are logged as KFP metrics and every job is appended to the job statistics table.
+    Failing to write the table is logged without failing the pipeline step.
+
+    Args:
+        client: The BigQuery client which ran the job.
+        query_job: The completed query job.
+        metrics: The KFP Metrics artifact recording the totals of the job, if set.
+        job_stats_table: The BigQuery table collecting the statistics of the jobs, in the format "project.dataset.table".
+            It is created if it does not exist. If not set, the statistics are not written to BigQuery.
+        pipeline_job_name: The name of the pipeline job, such as `dsl.PIPELINE_JOB_NAME_PLACEHOLDER`.
+        step_name: The name of the pipeline step.
+
+    Returns:
+        The list of the statistics of the job, followed by its child jobs.
+    """
+    statistics = [_job_statistics(query_job)]
+    if query_job.num_child_jobs:
+        statistics += [
+            _job_statistics(child_job, query_job.job_id)
+            for child_job in client.list_jobs(parent_job=query_job)
+            if isinstance(child_job, bigquery.QueryJob)
+        ]
+    job = statistics[0]
+    logging.info(
+        f"Job {job['job_id']} processed {job['total_bytes_processed']} bytes, billed {job['total_bytes_billed']} bytes "
+        f"and used {job['total_slot_ms']} slot ms in {len(statistics) - 1} child jobs")
+
+    if metrics is not None:
+        metrics.log_metric("total_bytes_processed", job["total_bytes_processed"])
+        metrics.log_metric("total_bytes_billed", job["total_bytes_billed"])
+        metrics.log_metric("total_slot_ms", job["total_slot_ms"])
+        metrics.log_metric("cache_hit", int(job["cache_hit"]))
+        metrics.log_metric("child_jobs", len(statistics) - 1)
+        metrics.metadata["child_job_stats"] = statistics[1:]
+
+    if job_stats_table:
+        run_date = datetime.now(timezone.utc).date().isoformat()
+        rows = [
+            dict(s, run_date=run_date, pipeline=pipeline_from_job_name(pipeline_job_name),
+                 pipeline_job_name=pipeline_job_name, step=step_name)
+            for s in statistics
+        ]
+        try:
+            table = bigquery.Table(job_stats_table, schema=PIPELINE_JOB_STATS_SCHEMA)
+            table.time_partitioning = bigquery.TimePartitioning(field="run_date")
+            table.clustering_fields = ["pipeline", "step"]
+            client.create_table(table, exists_ok=True)
+            client.load_table_from_json(
+                rows,
+                job_stats_table,
+                job_config=bigquery.LoadJobConfig(
+                    schema=PIPELINE_JOB_STATS_SCHEMA,
+                    write_disposition=bigquery.WriteDisposition.WRITE_APPEND)
+            ).result()
+        except exceptions.GoogleAPICallError as e:
+            logging.warning(f"Failed to record the job statistics in {job_stats_table}: {e}")
+    return statistics
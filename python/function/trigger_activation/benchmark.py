@@ -0,0 +1,198 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Local benchmark of the per-invocation overhead of the activation trigger function.
+
+The Dataflow Flex Templates gRPC transport is stubbed, so that the benchmark measures the client, channel and
+configuration setup of every invocation without launching Dataflow jobs.
+
+Usage:
+  python benchmark.py --invocations 200
+"""
+import argparse
+import base64
+import json
+import os
+import statistics
+import sys
+import time
+
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import dataflow_v1beta3
+from google.cloud import storage
+from google.cloud.dataflow_v1beta3.services.flex_templates_service.transports import FlexTemplatesServiceGrpcTransport
+
+try:
+  import functions_framework
+except ImportError:
+  # The benchmark calls the function directly, so the Functions Framework is stubbed when it is not installed.
+  sys.modules['functions_framework'] = SimpleNamespace(cloud_event=lambda function: function)
+
+import main
+
+# The function module shares the client classes with the benchmark, so the real classes are kept before they are patched.
+FlexTemplatesServiceClient = dataflow_v1beta3.FlexTemplatesServiceClient
+StorageClient = storage.Client
+
+ENVIRONMENT = {
+  'ACTIVATION_PROJECT': 'benchmark-project',
+  'ACTIVATION_REGION': 'us-central1',
+  'TEMPLATE_FILE_GCS_LOCATION': 'gs://benchmark-bucket/dataflow_template.json',
+  'GA4_MEASUREMENT_ID': 'G-BENCHMARK',
+  'GA4_MEASUREMENT_SECRET': 'secret',
+  'ACTIVATION_TYPE_CONFIGURATION': 'gs://benchmark-bucket/activation_type_configuration.json',
+  'PIPELINE_TEMP_LOCATION': 'gs://benchmark-bucket/tmp',
+  'LOG_DATA_SET': 'activation',
+  'PIPELINE_WORKER_EMAIL': 'activation@benchmark-project.iam.gserviceaccount.com',
+}
+
+
+class StubFlexTemplatesTransport(FlexTemplatesServiceGrpcTransport):
+  """
+  A gRPC transport that opens a real channel but answers the launch requests locally.
+  """
+
+  @property
+  def launch_flex_template(self):
+    # The client looks the wrapped method up by the callable, so the same callable is returned every time.
+    return launch_flex_template_locally
+
+
+def launch_flex_template_locally(request, **kwargs):
+  """
+  Answers a launch request without calling Dataflow.
+
+  Args:
+    request: The launch request.
+
+  Returns:
+    The launch response.
+  """
+  return dataflow_v1beta3.LaunchFlexTemplateResponse(job=dataflow_v1beta3.Job(id='benchmark'))
+
+
+def stub_flex_templates_client(client_info=None):
+  """
+  Creates a Flex Templates client with anonymous credentials and the stubbed transport.
+
+  Args:
+    client_info: The client info of the client.
+
+  Returns:
+    The Flex Templates client.
+  """
+  return FlexTemplatesServiceClient(
+    transport=StubFlexTemplatesTransport(credentials=AnonymousCredentials(), client_info=client_info),
+    client_info=client_info)
+
+
+def stub_storage_client(project=None, client_info=None):
+  """
+  Creates a Cloud Storage client with anonymous credentials.
+
+  Args:
+    project: The Google Cloud project ID.
+    client_info: The client info of the client.
+
+  Returns:
+    The Cloud Storage client.
+  """
+  return StorageClient(project=project, credentials=AnonymousCredentials(), client_info=client_info)
+
+
+class ActivationEvent(SimpleNamespace):
+  """
+  A CloudEvent stand-in exposing the data and the ID of the event.
+  """
+
+  def __init__(self, data, id):
+    super().__init__(data=data, id=id)
+
+  def __getitem__(self, attribute):
+    return getattr(self, attribute)
+
+
+def activation_event(activation_type):
+  """
+  Builds the CloudEvent of an activation message.
+
+  Args:
+    activation_type: The activation type of the message.
+
+  Returns:
+    An object with the data of the CloudEvent.
+  """
+  message = json.dumps({'activation_type': activation_type, 'source_table': 'benchmark.predictions'})
+  return ActivationEvent({'message': {'data': base64.b64encode(message.encode()).decode()}}, 'benchmark-message')
+
+
+def time_invocations(invocations, reuse_instance_state):
+  """
+  Times the invocations of the function.
+
+  Args:
+    invocations: The number of invocations.
+    reuse_instance_state: A boolean flag indicating whether the invocations reuse the clients and the configuration
+      of the function instance, like warm invocations do, or set them up again, like before they were cached.
+
+  Returns:
+    The list of the invocation times, in milliseconds.
+  """
+  cloud_event = activation_event('purchase-propensity-30-15')
+
+  timings = []
+  with patch.dict(os.environ, ENVIRONMENT), \
+       patch.object(main.dataflow_v1beta3, 'FlexTemplatesServiceClient', side_effect=stub_flex_templates_client), \
+       patch.object(main.storage, 'Client', side_effect=stub_storage_client), \
+       patch('builtins.print'):
+    for cache in (main.get_configuration, main.get_flex_templates_client, main.get_storage_client):
+      cache.cache_clear()
+    for _ in range(invocations):
+      if not reuse_instance_state:
+        for cache in (main.get_configuration, main.get_flex_templates_client, main.get_storage_client):
+          cache.cache_clear()
+      start = time.perf_counter()
+      main.subscribe(cloud_event)
+      timings.append((time.perf_counter() - start) * 1000)
+  return timings
+
+
+def report(label, timings):
+  """
+  Prints the invocation times.
+
+  Args:
+    label: The label of the measured mode.
+    timings: The invocation times, in milliseconds.
+  """
+  ordered = sorted(timings)
+  print(f"{label:>28}: first {timings[0]:8.2f} ms, "
+        f"median {statistics.median(timings):6.2f} ms, "
+        f"p99 {ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]:6.2f} ms")
+
+
+def main_benchmark():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--invocations', type=int, default=200)
+  args = parser.parse_args()
+
+  report('new clients per invocation', time_invocations(args.invocations, reuse_instance_state=False))
+  report('reused instance clients', time_invocations(args.invocations, reuse_instance_state=True))
+
+
+if __name__ == '__main__':
+  main_benchmark()
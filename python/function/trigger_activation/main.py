@@ -13,17 +13,395 @@
 # limitations under the License.
 
 import base64
+import dataclasses
 import functions_framework 
+import functools
+import hashlib
 import json
+import logging
 import os
+import re
+import threading
+import time
 
-from datetime import datetime
+from google.api_core import exceptions
 from google.cloud import dataflow_v1beta3
+from google.cloud import storage
 
 from google.api_core.gapic_v1.client_info import ClientInfo
 
 USER_AGENT_ACTIVATION = 'cloud-solutions/marketing-analytics-jumpstart-activation-v1'
 
+# Key of the pending activation messages and of the coalescing window lease in the state store.
+PENDING_ACTIVATIONS_PREFIX = 'pending/'
+COALESCING_WINDOW_LEASE = 'window.lease'
+# Number of seconds after the end of a coalescing window after which its lease is considered abandoned by a crashed instance.
+COALESCING_LEASE_GRACE_SECONDS = 120
+# Number of characters of the launch key appended to the job names, so that the redeliveries of a message share the job name.
+JOB_NAME_KEY_LENGTH = 12
+# States of the launch lease of an activation message.
+LAUNCH_CLAIMED = 'claimed'
+LAUNCH_LAUNCHED = 'launched'
+
+
+@dataclasses.dataclass(frozen=True)
+class FunctionConfiguration:
+  """
+  The configuration of the function, read once per function instance from the environment variables.
+
+  Attributes:
+      project_id: The Google Cloud project ID.
+      region: The Google Cloud region where the Dataflow Flex Template will be launched.
+      template_file_gcs_location: The Google Cloud Storage location of the Dataflow Flex Template file.
+      ga4_measurement_id: The Google Analytics 4 measurement ID.
+      ga4_measurement_secret: The Google Analytics 4 measurement secret.
+      activation_type_configuration: The path to a JSON file containing the configuration for the activation type.
+      temp_location: The Google Cloud Storage location for temporary files used by the Dataflow Flex Template.
+      log_db_dataset: The BigQuery dataset where the logs of the Dataflow Flex Template will be stored.
+      service_account_email: The service account email used by the Dataflow Flex Template workers.
+      coalescing_window_seconds: The number of seconds the activation messages are buffered before launching a single job for all of them.
+        0 launches a job per message.
+      coalescing_location: The GCS path of the folder holding the buffered activation messages.
+      launch_lease_location: The GCS path of the folder holding the leases of the launched activation messages.
+        When not set, every delivery of a message is launched.
+      timeout_seconds: The timeout of the function. A launch still claimed after the timeout was abandoned by a killed
+        function instance, and is claimed again by the next delivery of the message.
+  """
+  project_id: str
+  region: str
+  template_file_gcs_location: str
+  ga4_measurement_id: str
+  ga4_measurement_secret: str
+  activation_type_configuration: str
+  temp_location: str
+  log_db_dataset: str
+  service_account_email: str
+  coalescing_window_seconds: float = 0
+  coalescing_location: str = None
+  launch_lease_location: str = None
+  timeout_seconds: float = 60
+
+  @classmethod
+  def from_environment(cls):
+    """
+    Reads the configuration from the environment variables of the function.
+
+    Returns:
+        The configuration of the function.
+    """
+    return cls(
+      project_id=os.environ.get('ACTIVATION_PROJECT'),
+      region=os.environ.get('ACTIVATION_REGION'),
+      template_file_gcs_location=os.environ.get('TEMPLATE_FILE_GCS_LOCATION'),
+      ga4_measurement_id=os.environ.get('GA4_MEASUREMENT_ID'),
+      ga4_measurement_secret=os.environ.get('GA4_MEASUREMENT_SECRET'),
+      activation_type_configuration=os.environ.get('ACTIVATION_TYPE_CONFIGURATION'),
+      temp_location=os.environ.get('PIPELINE_TEMP_LOCATION'),
+      log_db_dataset=os.environ.get('LOG_DATA_SET'),
+      service_account_email=os.environ.get('PIPELINE_WORKER_EMAIL'),
+      coalescing_window_seconds=float(os.environ.get('ACTIVATION_COALESCING_WINDOW_SECONDS') or 0),
+      coalescing_location=os.environ.get('ACTIVATION_COALESCING_LOCATION'),
+      launch_lease_location=os.environ.get('ACTIVATION_LAUNCH_LEASE_LOCATION'),
+      timeout_seconds=float(os.environ.get('ACTIVATION_FUNCTION_TIMEOUT_SECONDS') or 60),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_configuration():
+  """
+  Returns the configuration of the function, read from the environment variables on the first invocation of the instance.
+
+  Returns:
+      The configuration of the function.
+  """
+  return FunctionConfiguration.from_environment()
+
+
+@functools.lru_cache(maxsize=None)
+def get_flex_templates_client():
+  """
+  Returns the Dataflow Flex Templates client of the function instance.
+
+  The client is created on the first invocation and reused by the following ones,
+  so that warm invocations skip the gRPC channel setup and the credentials lookup.
+
+  Returns:
+      The Dataflow Flex Templates client.
+  """
+  return dataflow_v1beta3.FlexTemplatesServiceClient(client_info=ClientInfo(user_agent=USER_AGENT_ACTIVATION))
+
+
+@functools.lru_cache(maxsize=None)
+def get_storage_client(project_id):
+  """
+  Returns the Cloud Storage client of the function instance for a project.
+
+  Args:
+      project_id: The Google Cloud project ID.
+
+  Returns:
+      The Cloud Storage client.
+  """
+  return storage.Client(project=project_id, client_info=ClientInfo(user_agent=USER_AGENT_ACTIVATION))
+
+
+class GcsStateStore:
+  """
+  A small key-value store shared by the function instances, holding JSON values in a Cloud Storage folder.
+
+  The generation preconditions of Cloud Storage make the creation of a key atomic, so that a key can be used as a lease.
+  """
+
+  def __init__(self, client, gcs_path):
+    """
+    Initializes the state store.
+
+    Args:
+        client: The Cloud Storage client.
+        gcs_path: The GCS path of the folder holding the values, in the format "gs://bucket_name/folder".
+
+    Raises:
+        ValueError: If the GCS path is invalid.
+    """
+    matches = re.match("gs://(.*?)/(.*)", gcs_path or '')
+    if not matches:
+      raise ValueError("Invalid GCS path: {}".format(gcs_path))
+    bucket_name, folder = matches.groups()
+    self._bucket = client.bucket(bucket_name)
+    self._folder = f"{folder.rstrip('/')}/" if folder else ''
+
+  def put(self, key, value):
+    """
+    Stores a value, replacing the current value of the key.
+
+    Args:
+        key: The key of the value.
+        value: The JSON serializable value.
+    """
+    self._bucket.blob(self._folder + key).upload_from_string(json.dumps(value), content_type='application/json')
+
+  def create(self, key, value):
+    """
+    Stores a value only if the key does not exist yet.
+
+    Args:
+        key: The key of the value.
+        value: The JSON serializable value.
+
+    Returns:
+        True if the value was stored, False if the key already exists.
+    """
+    try:
+      self._bucket.blob(self._folder + key).upload_from_string(json.dumps(value), content_type='application/json', if_generation_match=0)
+      return True
+    except exceptions.PreconditionFailed:
+      return False
+
+  def get(self, key):
+    """
+    Reads a value.
+
+    Args:
+        key: The key of the value.
+
+    Returns:
+        A tuple containing the value and its generation, or None if the key does not exist.
+    """
+    blob = self._bucket.get_blob(self._folder + key)
+    if blob is None:
+      return None
+    return json.loads(blob.download_as_text()), blob.generation
+
+  def list(self, prefix):
+    """
+    Reads the values of all the keys starting with a prefix.
+
+    Args:
+        prefix: The prefix of the keys.
+
+    Returns:
+        A dictionary mapping every key to its value.
+    """
+    return {
+      blob.name[len(self._folder):]: json.loads(blob.download_as_text())
+      for blob in self._bucket.list_blobs(prefix=self._folder + prefix)
+    }
+
+  def delete(self, key, generation=None):
+    """
+    Deletes a key, if it still exists.
+
+    Args:
+        key: The key to delete.
+        generation: If set, the key is only deleted if its value was not replaced since this generation.
+    """
+    try:
+      self._bucket.blob(self._folder + key).delete(if_generation_match=generation)
+    except (exceptions.NotFound, exceptions.PreconditionFailed):
+      pass
+
+
+class InMemoryStateStore:
+  """
+  A local stand-in for the GcsStateStore, holding the values in memory, for tests and local runs.
+  """
+
+  def __init__(self):
+    """
+    Initializes the state store.
+    """
+    self._values = {}
+    self._generation = 0
+    self._lock = threading.Lock()
+
+  def put(self, key, value):
+    with self._lock:
+      self._generation += 1
+      self._values[key] = (json.loads(json.dumps(value)), self._generation)
+
+  def create(self, key, value):
+    with self._lock:
+      if key in self._values:
+        return False
+      self._generation += 1
+      self._values[key] = (json.loads(json.dumps(value)), self._generation)
+      return True
+
+  def get(self, key):
+    with self._lock:
+      return self._values.get(key)
+
+  def list(self, prefix):
+    with self._lock:
+      return {key: value for key, (value, _) in self._values.items() if key.startswith(prefix)}
+
+  def delete(self, key, generation=None):
+    with self._lock:
+      if key in self._values and generation in (None, self._values[key][1]):
+        del self._values[key]
+
+
+def acquire_coalescing_window(store, window_seconds, now):
+  """
+  Acquires the lease of the coalescing window, breaking the lease left behind by a crashed function instance.
+
+  Args:
+      store: The state store.
+      window_seconds: The number of seconds of the coalescing window.
+      now: The current time, in seconds since the epoch.
+
+  Returns:
+      True if the lease was acquired, False if another function instance holds it.
+  """
+  if store.create(COALESCING_WINDOW_LEASE, {'acquired_at': now}):
+    return True
+  lease = store.get(COALESCING_WINDOW_LEASE)
+  if lease is not None and now - lease[0]['acquired_at'] > window_seconds + COALESCING_LEASE_GRACE_SECONDS:
+    logging.warning(f"Breaking the coalescing window lease acquired at {lease[0]['acquired_at']}")
+    store.delete(COALESCING_WINDOW_LEASE, generation=lease[1])
+    return store.create(COALESCING_WINDOW_LEASE, {'acquired_at': now})
+  return False
+
+
+def launch_key(activation, message_id):
+  """
+  Computes the idempotency key of the launch of an activation message.
+
+  Args:
+      activation: A dictionary containing the activation_type and source_table of the message.
+      message_id: The ID of the Pub/Sub message, shared by the redeliveries of the same message.
+
+  Returns:
+      The hexadecimal SHA-256 digest of the activation type, the source table and the message ID.
+  """
+  key = json.dumps([activation['activation_type'], activation['source_table'], message_id])
+  return hashlib.sha256(key.encode()).hexdigest()
+
+
+def claim_launch(store, activation, message_id, now, timeout_seconds):
+  """
+  Claims the launch of an activation message, so that its redeliveries are acknowledged without launching another job.
+
+  The claim is stored in the claimed state until the launch succeeds. A claim still in the claimed state after the timeout
+  of the function was left behind by a function instance killed before the end of the launch, and is broken, so that
+  the redelivery of the message launches it.
+
+  Args:
+      store: The state store holding the launch leases.
+      activation: A dictionary containing the activation_type and source_table of the message.
+      message_id: The ID of the Pub/Sub message.
+      now: The current time, in seconds since the epoch.
+      timeout_seconds: The timeout of the function, in seconds.
+
+  Returns:
+      True if the launch was claimed, False if the message was already launched or is being launched.
+  """
+  key = launch_key(activation, message_id)
+  claim = dict(activation, message_id=message_id, state=LAUNCH_CLAIMED, claimed_at=now)
+  if store.create(key, claim):
+    return True
+  lease = store.get(key)
+  if lease is not None and lease[0].get('state') == LAUNCH_CLAIMED and now - lease[0]['claimed_at'] > timeout_seconds:
+    logging.warning(f"Breaking the launch claim of activation message {message_id} claimed at {lease[0]['claimed_at']}")
+    store.delete(key, generation=lease[1])
+    return store.create(key, claim)
+  return False
+
+
+def complete_launch(store, activation, message_id, now):
+  """
+  Records the successful launch of an activation message, so that its claim is never broken.
+
+  Args:
+      store: The state store holding the launch leases.
+      activation: A dictionary containing the activation_type and source_table of the message.
+      message_id: The ID of the Pub/Sub message.
+      now: The current time, in seconds since the epoch.
+  """
+  store.put(launch_key(activation, message_id), dict(activation, message_id=message_id, state=LAUNCH_LAUNCHED, launched_at=now))
+
+
+def coalesce_activation(store, window_seconds, message_id, activation, launch, clock=time.time, sleep=time.sleep):
+  """
+  Buffers an activation message and launches a single job for all the messages received during the coalescing window.
+
+  Every message is stored in the state store. The first function instance acquiring the lease of the window waits
+  for the end of the window and launches one job for all the buffered messages, the other instances return
+  right away. Each invocation holds the window once, so that it ends within the function timeout. The messages
+  buffered while the job is launched stay in the state store and are launched by the window of the next message.
+
+  Args:
+      store: The state store, a GcsStateStore or an InMemoryStateStore.
+      window_seconds: The number of seconds the messages are buffered.
+      message_id: The ID of the Pub/Sub message, which keeps redeliveries of the same message buffered once.
+      activation: A dictionary containing the activation_type and source_table of the message.
+      launch: The function launching a job for a list of activations and the idempotency key of the launch.
+      clock: The function returning the current time, in seconds since the epoch.
+      sleep: The function waiting for a number of seconds.
+
+  Returns:
+      The lists of activations launched by this function instance.
+  """
+  store.put(f"{PENDING_ACTIVATIONS_PREFIX}{message_id}", activation)
+
+  launched = []
+  if not acquire_coalescing_window(store, window_seconds, clock()):
+    return launched
+  try:
+    sleep(window_seconds)
+    pending = store.list(PENDING_ACTIVATIONS_PREFIX)
+    activations = list({(a['activation_type'], a['source_table']): a for a in pending.values()}.values())
+    if activations:
+      logging.info(f"Launching a single job for the {len(pending)} activation messages of the coalescing window")
+      launch(activations, hashlib.sha256(json.dumps(sorted(pending)).encode()).hexdigest())
+      launched.append(activations)
+    for key in pending:
+      store.delete(key)
+  finally:
+    store.delete(COALESCING_WINDOW_LEASE)
+  return launched
+
+
 @functions_framework.cloud_event
 def subscribe(cloud_event):
   """
@@ -39,24 +417,8 @@ def subscribe(cloud_event):
       None.
   """
 
-  # ACTIVATION_PROJECT: The Google Cloud project ID.
-  project_id = os.environ.get('ACTIVATION_PROJECT')
-  # ACTIVATION_REGION: The Google Cloud region where the Dataflow Flex Template will be launched.
-  region = os.environ.get('ACTIVATION_REGION')
-  # TEMPLATE_FILE_GCS_LOCATION: The Google Cloud Storage location of the Dataflow Flex Template file.
-  template_file_gcs_location = os.environ.get('TEMPLATE_FILE_GCS_LOCATION')
-  # GA4_MEASUREMENT_ID: The Google Analytics 4 measurement ID.
-  ga4_measurement_id = os.environ.get('GA4_MEASUREMENT_ID')
-  # GA4_MEASUREMENT_SECRET: The Google Analytics 4 measurement secret.
-  ga4_measurement_secret = os.environ.get('GA4_MEASUREMENT_SECRET')
-  # ACTIVATION_TYPE_CONFIGURATION: The path to a JSON file containing the configuration for the activation type.
-  activation_type_configuration = os.environ.get('ACTIVATION_TYPE_CONFIGURATION')
-  # PIPELINE_TEMP_LOCATION: The Google Cloud Storage location for temporary files used by the Dataflow Flex Template.
-  temp_location = os.environ.get('PIPELINE_TEMP_LOCATION')
-  # LOG_DATA_SET: The BigQuery dataset where the logs of the Dataflow Flex Template will be stored.
-  log_db_dataset = os.environ.get('LOG_DATA_SET')
-  # PIPELINE_WORKER_EMAIL: The service account email used by the Dataflow Flex Template workers.
-  service_account_email = os.environ.get('PIPELINE_WORKER_EMAIL')
+  # The configuration is read from the environment variables on the first invocation of the function instance.
+  configuration = get_configuration()
 
   # Decodes the base64 encoded data in the message and parses it as JSON.
   # It then extracts the activation_type and source_table values from the JSON object.
@@ -66,37 +428,93 @@ def subscribe(cloud_event):
   activation_type = message_obj['activation_type']
   source_table = message_obj['source_table']
 
+  activation = {'activation_type': activation_type, 'source_table': source_table}
+  # The CloudEvent ID is the Pub/Sub message ID, shared by the redeliveries of the same message.
+  message_id = cloud_event['id']
+
+  # Pub/Sub delivers the messages at least once, the redeliveries of a message already launched are acknowledged
+  # without launching a duplicate job sending the events again.
+  leases = None
+  if configuration.launch_lease_location:
+    leases = GcsStateStore(get_storage_client(configuration.project_id), configuration.launch_lease_location)
+    if not claim_launch(leases, activation, message_id, time.time(), configuration.timeout_seconds):
+      logging.warning(f"Activation message {message_id} of {source_table} was already launched, the redelivery is skipped")
+      return
+
+  try:
+    if configuration.coalescing_window_seconds > 0:
+      # Buffer the message and launch a single job for all the messages received during the coalescing window.
+      store = GcsStateStore(get_storage_client(configuration.project_id), configuration.coalescing_location)
+      coalesce_activation(store, configuration.coalescing_window_seconds, message_id, activation,
+                          lambda activations, key: launch_activations(configuration, activations, key))
+    else:
+      launch_activations(configuration, [activation], launch_key(activation, message_id))
+    # The buffered message is launched by a coalescing window, so the launch is complete once the message is buffered.
+    if leases is not None:
+      complete_launch(leases, activation, message_id, time.time())
+  except Exception:
+    # Release the lease, so that the redelivery of the message retries the launch.
+    if leases is not None:
+      leases.delete(launch_key(activation, message_id))
+    raise
+
+
+def launch_activations(configuration, activations, key):
+  """
+  Launches the activation Dataflow Flex Template for one or several activations.
+
+  Args:
+      configuration: The configuration of the function.
+      activations: A list of dictionaries containing the activation_type and source_table of every activation.
+        Several activations are processed by a single multi-activation job.
+      key: The idempotency key of the launch, appended to the job name. Dataflow rejects the launch of a job
+        named like an active job, so that concurrent launches of the same messages start a single job.
+
+  Returns:
+      The response of the launch request, or None if a job of the same launch is already active.
+  """
   # Creates a FlexTemplateRuntimeEnvironment object with the service account email.
-  environment_param = dataflow_v1beta3.FlexTemplateRuntimeEnvironment(service_account_email=service_account_email)
+  environment_param = dataflow_v1beta3.FlexTemplateRuntimeEnvironment(service_account_email=configuration.service_account_email)
 
   # It then creates a dictionary of parameters for the Dataflow Flex Template, including the project ID, activation type, 
   # activation type configuration, source table, temporary location, GA4 measurement ID, GA4 measurement secret, and log dataset.
+  # Several activations are passed together in the activations parameter instead of the activation type and source table.
   # Finally, it creates a LaunchFlexTemplateParameter object with the job name, container spec GCS path, environment, and parameters.
   parameters = {
-    'project': project_id,
-    'activation_type': activation_type,
-    'activation_type_configuration': activation_type_configuration,
-    'source_table': source_table,
-    'temp_location': temp_location,
-    'ga4_measurement_id': ga4_measurement_id,
-    'ga4_api_secret': ga4_measurement_secret,
-    'log_db_dataset': log_db_dataset
+    'project': configuration.project_id,
+    'activation_type_configuration': configuration.activation_type_configuration,
+    'temp_location': configuration.temp_location,
+    'ga4_measurement_id': configuration.ga4_measurement_id,
+    'ga4_api_secret': configuration.ga4_measurement_secret,
+    'log_db_dataset': configuration.log_db_dataset
   }
+  if len(activations) == 1:
+    activation_type = activations[0]['activation_type']
+    parameters['activation_type'] = activation_type
+    parameters['source_table'] = activations[0]['source_table']
+    job_name = f"activation-pipeline-{activation_type.replace('_','-')}-{key[:JOB_NAME_KEY_LENGTH]}"
+  else:
+    parameters['activations'] = json.dumps(activations)
+    job_name = f"activation-pipeline-multi-{len(activations)}-{key[:JOB_NAME_KEY_LENGTH]}"
   flex_template_param = dataflow_v1beta3.LaunchFlexTemplateParameter(
-    job_name=f"activation-pipeline-{activation_type.replace('_','-')}-{datetime.now().strftime('%Y%m%d-%H%M%S')}",
-    container_spec_gcs_path=template_file_gcs_location,
+    job_name=job_name,
+    container_spec_gcs_path=configuration.template_file_gcs_location,
     environment=environment_param,
     parameters=parameters
   )
 
   # Creates a LaunchFlexTemplateRequest object with the project ID, region, and launch parameter.
-  # It then uses the FlexTemplatesServiceClient to launch the Dataflow Flex Template.
+  # It then uses the FlexTemplatesServiceClient of the function instance to launch the Dataflow Flex Template.
   request = dataflow_v1beta3.LaunchFlexTemplateRequest(
-    project_id=project_id,
-    location=region,
+    project_id=configuration.project_id,
+    location=configuration.region,
     launch_parameter=flex_template_param
   )
-  client = dataflow_v1beta3.FlexTemplatesServiceClient(client_info=ClientInfo(user_agent=USER_AGENT_ACTIVATION))
-  response = client.launch_flex_template(request=request)
+  try:
+    response = get_flex_templates_client().launch_flex_template(request=request)
+  except exceptions.AlreadyExists:
+    logging.warning(f"Dataflow job {job_name} is already running, the duplicate launch is skipped")
+    return None
 
   print(response)
+  return response
@@ -0,0 +1,266 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import json
+import unittest
+from unittest.mock import patch
+
+from cloudevents.http import CloudEvent
+from google.api_core import exceptions
+
+import main
+from main import FunctionConfiguration, InMemoryStateStore, claim_launch, complete_launch, coalesce_activation, launch_activations, launch_key, COALESCING_WINDOW_LEASE, PENDING_ACTIVATIONS_PREFIX
+
+
+def activation(source_table):
+  return {'activation_type': 'audience-segmentation-15', 'source_table': source_table}
+
+
+class FakeClock:
+  """
+  A clock advanced by the injected sleep, so that the coalescing window passes without waiting.
+  """
+
+  def __init__(self, now=1000.0):
+    self.now = now
+    self.on_sleep = None
+
+  def __call__(self):
+    return self.now
+
+  def sleep(self, seconds):
+    self.now += seconds
+    if self.on_sleep is not None:
+      on_sleep, self.on_sleep = self.on_sleep, None
+      on_sleep()
+
+
+class CoalesceActivationTest(unittest.TestCase):
+
+  def setUp(self):
+    self.store = InMemoryStateStore()
+    self.clock = FakeClock()
+    self.launches = []
+
+  def launch(self, activations, key):
+    self.launches.append((activations, key))
+
+  def coalesce(self, message_id, source_table, launch=None):
+    return coalesce_activation(self.store, 10, message_id, activation(source_table), launch or self.launch,
+                               clock=self.clock, sleep=self.clock.sleep)
+
+  def test_messages_buffered_in_one_window_are_launched_once(self):
+    # Messages buffered by the instances which did not acquire the window.
+    self.store.put(f'{PENDING_ACTIVATIONS_PREFIX}message-1', activation('table_1'))
+    self.store.put(f'{PENDING_ACTIVATIONS_PREFIX}message-2', activation('table_2'))
+
+    launched = self.coalesce('message-3', 'table_3')
+
+    self.assertEqual(len(self.launches), 1)
+    self.assertEqual(sorted(a['source_table'] for a in self.launches[0][0]), ['table_1', 'table_2', 'table_3'])
+    self.assertEqual(launched, [self.launches[0][0]])
+    self.assertEqual(self.store.list(PENDING_ACTIVATIONS_PREFIX), {})
+    self.assertIsNone(self.store.get(COALESCING_WINDOW_LEASE))
+
+  def test_redeliveries_are_buffered_once(self):
+    self.store.put(f'{PENDING_ACTIVATIONS_PREFIX}message-1', activation('table_1'))
+
+    self.coalesce('message-1', 'table_1')
+
+    self.assertEqual(len(self.launches), 1)
+    self.assertEqual(self.launches[0][0], [activation('table_1')])
+
+  def test_instance_not_holding_the_window_only_buffers(self):
+    self.store.create(COALESCING_WINDOW_LEASE, {'acquired_at': self.clock.now})
+
+    launched = self.coalesce('message-1', 'table_1')
+
+    self.assertEqual(launched, [])
+    self.assertEqual(self.launches, [])
+    self.assertEqual(self.store.list(PENDING_ACTIVATIONS_PREFIX), {f'{PENDING_ACTIVATIONS_PREFIX}message-1': activation('table_1')})
+
+  def test_message_arriving_during_a_launch_is_launched_by_the_next_window(self):
+    def launch(activations, key):
+      self.launch(activations, key)
+      if len(self.launches) == 1:
+        # Buffered by another instance after the pending messages of the window were read.
+        self.store.put(f'{PENDING_ACTIVATIONS_PREFIX}message-2', activation('table_2'))
+
+    launched = self.coalesce('message-1', 'table_1', launch=launch)
+
+    # The invocation holds a single window, the leftover waits for the window of the next message.
+    self.assertEqual(launched, [[activation('table_1')]])
+    self.assertEqual(self.store.list(PENDING_ACTIVATIONS_PREFIX), {f'{PENDING_ACTIVATIONS_PREFIX}message-2': activation('table_2')})
+    self.assertIsNone(self.store.get(COALESCING_WINDOW_LEASE))
+
+    self.coalesce('message-3', 'table_3', launch=launch)
+
+    self.assertEqual(sorted(a['source_table'] for a in self.launches[1][0]), ['table_2', 'table_3'])
+    self.assertNotEqual(self.launches[0][1], self.launches[1][1])
+    self.assertEqual(self.store.list(PENDING_ACTIVATIONS_PREFIX), {})
+
+  def test_message_arriving_during_the_window_is_launched_with_it(self):
+    self.clock.on_sleep = lambda: self.store.put(f'{PENDING_ACTIVATIONS_PREFIX}message-2', activation('table_2'))
+
+    self.coalesce('message-1', 'table_1')
+
+    self.assertEqual(len(self.launches), 1)
+    self.assertEqual(sorted(a['source_table'] for a in self.launches[0][0]), ['table_1', 'table_2'])
+
+  def test_stale_lease_is_broken(self):
+    # Lease left behind by an instance which crashed long before the end of its window.
+    self.store.create(COALESCING_WINDOW_LEASE, {'acquired_at': self.clock.now - 3600})
+
+    self.coalesce('message-1', 'table_1')
+
+    self.assertEqual(len(self.launches), 1)
+    self.assertIsNone(self.store.get(COALESCING_WINDOW_LEASE))
+
+  def test_recent_lease_is_not_broken(self):
+    self.store.create(COALESCING_WINDOW_LEASE, {'acquired_at': self.clock.now - 60})
+
+    self.coalesce('message-1', 'table_1')
+
+    self.assertEqual(self.launches, [])
+    self.assertEqual(self.store.get(COALESCING_WINDOW_LEASE)[0], {'acquired_at': self.clock.now - 60})
+
+  def test_failed_launch_keeps_the_pending_activations(self):
+    def launch(activations, key):
+      raise RuntimeError('launch failed')
+
+    with self.assertRaises(RuntimeError):
+      self.coalesce('message-1', 'table_1', launch=launch)
+
+    self.assertEqual(self.store.list(PENDING_ACTIVATIONS_PREFIX), {f'{PENDING_ACTIVATIONS_PREFIX}message-1': activation('table_1')})
+    self.assertIsNone(self.store.get(COALESCING_WINDOW_LEASE))
+
+    # The next window launches the activations kept by the failed launch.
+    self.coalesce('message-2', 'table_2')
+
+    self.assertEqual(len(self.launches), 1)
+    self.assertEqual(sorted(a['source_table'] for a in self.launches[0][0]), ['table_1', 'table_2'])
+
+
+def configuration(**kwargs):
+  return FunctionConfiguration(
+    project_id='project',
+    region='us-central1',
+    template_file_gcs_location='gs://bucket/activation.json',
+    ga4_measurement_id='G-0000000000',
+    ga4_measurement_secret='secret',
+    activation_type_configuration='gs://bucket/activation_type_configuration.json',
+    temp_location='gs://bucket/tmp',
+    log_db_dataset='activation',
+    service_account_email='worker@project.iam.gserviceaccount.com',
+    **kwargs)
+
+
+def activation_event(message_id, source_table):
+  data = base64.b64encode(json.dumps(activation(source_table)).encode())
+  return CloudEvent({'type': 'google.cloud.pubsub.topic.v1.messagePublished', 'source': 'activation', 'id': message_id},
+                    {'message': {'data': data}})
+
+
+class LaunchIdempotencyTest(unittest.TestCase):
+
+  def test_claim_launch_rejects_a_repeated_message(self):
+    store = InMemoryStateStore()
+
+    self.assertTrue(claim_launch(store, activation('table_1'), 'message-1', 1000, 60))
+    self.assertFalse(claim_launch(store, activation('table_1'), 'message-1', 1001, 60))
+    self.assertTrue(claim_launch(store, activation('table_1'), 'message-2', 1002, 60))
+
+  def test_abandoned_claim_is_broken_after_the_timeout(self):
+    store = InMemoryStateStore()
+    self.assertTrue(claim_launch(store, activation('table_1'), 'message-1', 1000, 60))
+
+    self.assertFalse(claim_launch(store, activation('table_1'), 'message-1', 1060, 60))
+    self.assertTrue(claim_launch(store, activation('table_1'), 'message-1', 1061, 60))
+
+  def test_completed_launch_is_never_claimed_again(self):
+    store = InMemoryStateStore()
+    self.assertTrue(claim_launch(store, activation('table_1'), 'message-1', 1000, 60))
+    complete_launch(store, activation('table_1'), 'message-1', 1010)
+
+    self.assertFalse(claim_launch(store, activation('table_1'), 'message-1', 100000, 60))
+
+  def test_launch_key_is_stable(self):
+    self.assertEqual(launch_key(activation('table_1'), 'message-1'), launch_key(activation('table_1'), 'message-1'))
+    self.assertNotEqual(launch_key(activation('table_1'), 'message-1'), launch_key(activation('table_1'), 'message-2'))
+    self.assertNotEqual(launch_key(activation('table_1'), 'message-1'), launch_key(activation('table_2'), 'message-1'))
+
+  @patch('main.get_flex_templates_client')
+  def test_job_name_is_the_same_for_the_same_key(self, get_flex_templates_client):
+    client = get_flex_templates_client.return_value
+    key = launch_key(activation('table_1'), 'message-1')
+
+    launch_activations(configuration(), [activation('table_1')], key)
+    launch_activations(configuration(), [activation('table_1')], key)
+    launch_activations(configuration(), [activation('table_1'), activation('table_2')], key)
+
+    job_names = [c.kwargs['request'].launch_parameter.job_name for c in client.launch_flex_template.call_args_list]
+    self.assertEqual(job_names[0], job_names[1])
+    self.assertEqual(job_names[0], f'activation-pipeline-audience-segmentation-15-{key[:12]}')
+    self.assertEqual(job_names[2], f'activation-pipeline-multi-2-{key[:12]}')
+
+  @patch('main.get_flex_templates_client')
+  def test_already_running_job_counts_as_launched(self, get_flex_templates_client):
+    get_flex_templates_client.return_value.launch_flex_template.side_effect = exceptions.AlreadyExists('job exists')
+
+    response = launch_activations(configuration(), [activation('table_1')], launch_key(activation('table_1'), 'message-1'))
+
+    self.assertIsNone(response)
+
+  @patch('main.get_storage_client')
+  @patch('main.get_configuration', return_value=configuration(launch_lease_location='gs://bucket/leases'))
+  def test_lease_is_released_when_the_launch_fails(self, *_):
+    leases = InMemoryStateStore()
+    with patch('main.GcsStateStore', return_value=leases), \
+         patch('main.launch_activations', side_effect=[RuntimeError('launch failed'), None, None]) as launch:
+      with self.assertRaises(RuntimeError):
+        main.subscribe(activation_event('message-1', 'table_1'))
+      self.assertIsNone(leases.get(launch_key(activation('table_1'), 'message-1')))
+
+      # The redelivery retries the launch, the following redeliveries are skipped.
+      main.subscribe(activation_event('message-1', 'table_1'))
+      main.subscribe(activation_event('message-1', 'table_1'))
+
+    self.assertEqual(launch.call_count, 2)
+    self.assertIsNotNone(leases.get(launch_key(activation('table_1'), 'message-1')))
+
+  @patch('main.get_storage_client')
+  @patch('main.get_configuration', return_value=configuration(launch_lease_location='gs://bucket/leases', timeout_seconds=60))
+  def test_redelivery_launches_a_message_abandoned_by_a_killed_instance(self, *_):
+    leases = InMemoryStateStore()
+    # An instance claimed the launch and was killed before launching the job.
+    claim_launch(leases, activation('table_1'), 'message-1', 1000, 60)
+
+    with patch('main.GcsStateStore', return_value=leases), \
+         patch('main.launch_activations') as launch, \
+         patch('main.time.time', return_value=1030):
+      main.subscribe(activation_event('message-1', 'table_1'))
+    launch.assert_not_called()
+
+    with patch('main.GcsStateStore', return_value=leases), \
+         patch('main.launch_activations') as launch, \
+         patch('main.time.time', return_value=1100):
+      main.subscribe(activation_event('message-1', 'table_1'))
+      main.subscribe(activation_event('message-1', 'table_1'))
+    launch.assert_called_once()
+    self.assertEqual(leases.get(launch_key(activation('table_1'), 'message-1'))[0]['state'], 'launched')
+
+
+if __name__ == '__main__':
+  unittest.main()
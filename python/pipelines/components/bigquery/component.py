@@ -38,8 +38,13 @@ def bq_stored_procedure_exec(
     project: str,
     location: str,
     query: str,
+    job_metrics: Output[Metrics],
     query_parameters: Optional[list] = [],
-    timeout: Optional[float] = 1800
+    timeout: Optional[float] = 1800,
+    dry_run_preflight: bool = False,
+    maximum_bytes_billed: int = 0,
+    job_stats_table: Optional[str] = None,
+    pipeline_job_name: Optional[str] = None
 ) -> None:    
     """Executes a BigQuery stored procedure.
 
@@ -49,9 +54,17 @@ def bq_stored_procedure_exec(
         query: The query to execute.
         query_parameters: The query parameters to pass to the stored procedure.
         timeout: The timeout for the query, in seconds.
+        job_metrics: The output artifact recording the metrics of the BigQuery jobs.
+        dry_run_preflight: Whether to estimate the query with a dry run before running it,
+            recording the bytes processed and the referenced tables in `job_metrics`.
+        maximum_bytes_billed: The maximum number of bytes the query may bill. 0 for no limit.
+        job_stats_table: The BigQuery table collecting the statistics of the jobs of the pipelines, in the format
+            "project.dataset.table". If not set, the statistics are only recorded in `job_metrics`.
+        pipeline_job_name: The name of the pipeline job labelling the jobs, such as `dsl.PIPELINE_JOB_NAME_PLACEHOLDER`.
     """
 
     from google.cloud import bigquery
+    from ma_components.bigquery import get_bigquery_client, dry_run_query, job_labels, record_job_statistics, called_procedure
     import logging
 
     from google.api_core.gapic_v1.client_info import ClientInfo
@@ -66,10 +79,10 @@ def bq_stored_procedure_exec(
     USER_AGENT_VBB_TRAINING = 'cloud-solutions/marketing-analytics-jumpstart-vbb-training-v1'
     USER_AGENT_VBB_EXPLANATION = 'cloud-solutions/marketing-analytics-jumpstart-vbb-explanation-v1'
 
-    client = bigquery.Client(
+    client = get_bigquery_client(
         project=project,
         location=location,
-        client_info=ClientInfo(user_agent=USER_AGENT_FEATURES)
+        user_agent=USER_AGENT_FEATURES
     )
 
     params = []
@@ -78,16 +91,25 @@ def bq_stored_procedure_exec(
         i['value'] = None if i['value'] == "None" else i['value']
         params.append(bigquery.ScalarQueryParameter(i['name'], i['type'], i['value']))
 
+    # The jobs are labelled with the called stored procedure, to break down the cost of the feature engineering by procedure.
+    step_name = called_procedure(query) or 'bq_stored_procedure_exec'
     job_config = bigquery.QueryJobConfig(
-        query_parameters=params
+        query_parameters=params,
+        maximum_bytes_billed=maximum_bytes_billed or None,
+        labels=job_labels(pipeline_job_name, step_name)
     )
 
+    if dry_run_preflight:
+        dry_run_query(client, query, job_config, location, maximum_bytes_billed, job_metrics)
+
     query_job = client.query(
         query=query,
         location=location,
         job_config=job_config)
 
     query_job.result(timeout=timeout)
+
+    record_job_statistics(client, query_job, job_metrics, job_stats_table, pipeline_job_name, step_name)
     
 
 # This component creates and train a BQML KMEANS model
@@ -101,6 +123,7 @@ def bq_clustering_exec(
     vertex_model_name: str,
     training_data_bq_table: str,
     exclude_features: list,
+    job_metrics: Output[Metrics],
     model_parameters: Optional[Input[Dataset]] = None,
     km_num_clusters: int = 4,
     km_init_method: str = "KMEANS++",
@@ -111,7 +134,11 @@ def bq_clustering_exec(
     km_min_rel_progress: float = 0.01,
     km_warm_start: str = "FALSE",
     use_split_column: Optional[str] = "FALSE",
-    use_hparams_tuning: Optional[str] = "FALSE"
+    use_hparams_tuning: Optional[str] = "FALSE",
+    dry_run_preflight: bool = False,
+    maximum_bytes_billed: int = 0,
+    job_stats_table: Optional[str] = None,
+    pipeline_job_name: Optional[str] = None
 ) -> None:
 
     """Creates and trains a BigQuery ML KMEANS model.
@@ -133,9 +160,17 @@ def bq_clustering_exec(
         km_early_stop: Whether to use early stopping.
         km_min_rel_progress: The minimum relative progress to stop early.
         km_warm_start: Whether to use warm start.
+        job_metrics: The output artifact recording the metrics of the BigQuery jobs.
+        dry_run_preflight: Whether to estimate the query with a dry run before running it,
+            recording the bytes processed and the referenced tables in `job_metrics`.
+        maximum_bytes_billed: The maximum number of bytes the query may bill. 0 for no limit.
+        job_stats_table: The BigQuery table collecting the statistics of the jobs of the pipelines, in the format
+            "project.dataset.table". If not set, the statistics are only recorded in `job_metrics`.
+        pipeline_job_name: The name of the pipeline job labelling the jobs, such as `dsl.PIPELINE_JOB_NAME_PLACEHOLDER`.
     """
 
     from google.cloud import bigquery
+    from ma_components.bigquery import get_bigquery_client, dry_run_query, job_labels, record_job_statistics
     import logging
     from datetime import datetime
     
@@ -209,20 +244,27 @@ def bq_clustering_exec(
             SELECT DISTINCT * {exclude_sql} FROM `{training_data_bq_table}` WHERE {filter_clause}
         )"""
 
-    client = bigquery.Client(
+    client = get_bigquery_client(
         project=project_id,
         location=location,
-        client_info=ClientInfo(user_agent=USER_AGENT_SEGMENTATION_TRAINING)
+        user_agent=USER_AGENT_SEGMENTATION_TRAINING
     )
     
     logging.info(f"BQML Model Training Query: {query}")
+    job_config = bigquery.QueryJobConfig(maximum_bytes_billed=maximum_bytes_billed or None, labels=job_labels(pipeline_job_name, 'bq_clustering_exec'))
+    if dry_run_preflight:
+        dry_run_query(client, query, job_config, location, maximum_bytes_billed, job_metrics)
+
     query_job = client.query(
         query=query,
-        location=location
+        location=location,
+        job_config=job_config
     )
 
     r = query_job.result()
 
+    record_job_statistics(client, query_job, job_metrics, job_stats_table, pipeline_job_name, 'bq_clustering_exec')
+
     project, dataset  = project_id, model_dataset_id
     model.metadata = {"projectId": project, "datasetId": dataset,
                       "modelId": model_bq_name, 'vertex_model_name': vertex_model_name}
@@ -237,7 +279,9 @@ def bq_evaluate(
     model: Input[Artifact],
     project: str,
     location: str,
-    metrics: Output[Metrics]
+    metrics: Output[Metrics],
+    job_stats_table: Optional[str] = None,
+    pipeline_job_name: Optional[str] = None
 ):
     
     """Submits a BigQuery ML Model Evaluate and logs the results into Metrics.
@@ -246,10 +290,14 @@ def bq_evaluate(
         model: Input artifact for the trained model.
         project: The project containing the model.
         location: The location of the model.
-        metrics: Output artifact for the evaluation metrics.
+        metrics: Output artifact for the evaluation metrics, also recording the metrics of the BigQuery job.
+        job_stats_table: The BigQuery table collecting the statistics of the jobs of the pipelines, in the format
+            "project.dataset.table". If not set, the statistics are only recorded in `metrics`.
+        pipeline_job_name: The name of the pipeline job labelling the jobs, such as `dsl.PIPELINE_JOB_NAME_PLACEHOLDER`.
     """
 
     from google.cloud import bigquery
+    from ma_components.bigquery import get_bigquery_client, job_labels, record_job_statistics
     import json, google.auth, logging
     
     from google.api_core.gapic_v1.client_info import ClientInfo
@@ -267,14 +315,15 @@ def bq_evaluate(
 
     query = f"""SELECT * FROM ML.EVALUATE(MODEL `{model.metadata["projectId"]}.{model.metadata["datasetId"]}.{model.metadata["modelId"]}`)"""
     
-    client = bigquery.Client(
+    client = get_bigquery_client(
         project=project,
         location=location
     )
     
     query_job = client.query(
         query=query,
-        location=location
+        location=location,
+        job_config=bigquery.QueryJobConfig(labels=job_labels(pipeline_job_name, 'bq_evaluate'))
     )
 
     r = query_job.result()
@@ -283,6 +332,8 @@ def bq_evaluate(
     for i in r:
         for k,v in i.items():
             metrics.log_metric(k, v)
+
+    record_job_statistics(client, query_job, metrics, job_stats_table, pipeline_job_name, 'bq_evaluate')
     
     
 ## NOT USED
@@ -306,7 +357,10 @@ def bq_select_best_kmeans_model(
         metric_threshold: float,
         number_of_models_considered: int,
         metrics_logger: Output[Metrics],
-        elected_model: Output[Artifact]) -> None:
+        elected_model: Output[Artifact],
+        evaluation_cache_table: Optional[str] = None,
+        job_stats_table: Optional[str] = None,
+        pipeline_job_name: Optional[str] = None) -> None:
     
     """Selects the best KMeans model from a set of models based on a given metric.
 
@@ -320,10 +374,20 @@ def bq_select_best_kmeans_model(
         number_of_models_considered: The number of models to consider.
         metrics_logger: The output artifact to log the metrics of the selected model.
         elected_model: The output artifact to store the metadata of the selected model.
+        evaluation_cache_table: The BigQuery table caching the evaluation metrics of the models, in the format
+            "project.dataset.table". It is created if it does not exist. The evaluation of a trained model never changes,
+            so only the models missing from the table are evaluated. If not set, all the models are evaluated.
+        job_stats_table: The BigQuery table collecting the statistics of the jobs of the pipelines, in the format
+            "project.dataset.table". If not set, the totals of the evaluation jobs are only recorded in `metrics_logger`.
+        pipeline_job_name: The name of the pipeline job labelling the jobs, such as `dsl.PIPELINE_JOB_NAME_PLACEHOLDER`.
     """
 
     from google.cloud import bigquery
+    from ma_components.bigquery import get_bigquery_client, job_labels, record_job_statistics
+    import heapq
+    import json
     import logging
+    from datetime import datetime, timezone
     from enum import Enum
 
     from google.api_core.gapic_v1.client_info import ClientInfo
@@ -351,10 +415,10 @@ def bq_select_best_kmeans_model(
             return list(map(lambda c: c.value, cls))
 
     # Construct a BigQuery client object.
-    client = bigquery.Client(
+    client = get_bigquery_client(
         project=project_id,
         location=location,
-        client_info=ClientInfo(user_agent=USER_AGENT_SEGMENTATION_PREDICTION)
+        user_agent=USER_AGENT_SEGMENTATION_PREDICTION
     )
 
     # TODO(developer): Set dataset_id to the ID of the dataset that contains
@@ -364,42 +428,78 @@ def bq_select_best_kmeans_model(
     logging.info(f"Getting models from: {project_id}.{dataset_id}")
     models = client.list_models(f"{dataset_id}")  # Make an API request.
 
-    models_to_compare = []
-    counter = 0
-    for model in models:
-        if model.model_id.startswith(model_prefix):
-            # logging.info(f"{model.model_id} - {model.created}")
-            if (counter < number_of_models_considered):
-                models_to_compare.append(model)
-                counter += 1
-            else:
-                canditate = model
-                for idx, m in enumerate(models_to_compare):
-                    # checks if current canditate is newer than one already in list
-                    if canditate.created.timestamp() > m.created.timestamp():
-                        tmp = m
-                        models_to_compare[idx] = canditate
-                        canditate = tmp
-
-            # logging.info(f"{counter} {models_to_compare}")
+    # Keeps the newest models matching the prefix, without sorting the whole list of models.
+    models_to_compare = heapq.nlargest(
+        number_of_models_considered,
+        (model for model in models if model.model_id.startswith(model_prefix)),
+        key=lambda model: model.created
+    )
 
     if len(models_to_compare) == 0:
         raise Exception(f"No models in vertex model registry match '{model_prefix}'")
 
-    best_model = dict()
-    best_eval_metrics = dict()
+    # Reads the cached evaluation metrics of the models, keyed by the full model ID and the creation time of the model,
+    # so that a model replaced by a new model of the same name is evaluated again.
+    cached_evaluations = dict()
+    if evaluation_cache_table:
+        client.create_table(bigquery.Table(evaluation_cache_table, schema=[
+            bigquery.SchemaField("model_id", "STRING", mode="REQUIRED"),
+            bigquery.SchemaField("model_created", "TIMESTAMP", mode="REQUIRED"),
+            bigquery.SchemaField("evaluated_at", "TIMESTAMP", mode="REQUIRED"),
+            bigquery.SchemaField("metrics", "STRING", mode="REQUIRED"),
+        ]), exists_ok=True)
+        query_job = client.query(
+            query=f"""
+                SELECT model_id, model_created, ANY_VALUE(metrics) AS metrics
+                FROM `{evaluation_cache_table}`
+                WHERE model_id IN UNNEST(@model_ids)
+                GROUP BY model_id, model_created
+            """,
+            job_config=bigquery.QueryJobConfig(query_parameters=[
+                bigquery.ArrayQueryParameter("model_ids", "STRING", [f"{i.project}.{i.dataset_id}.{i.model_id}" for i in models_to_compare])
+            ]),
+            location=location
+        )
+        for row in query_job.result():
+            cached_evaluations[(row.model_id, row.model_created)] = json.loads(row.metrics)
+        logging.info(f"Found the cached evaluation of {len(cached_evaluations)} models in {evaluation_cache_table}")
+
+    # Submits the evaluation of all the models before waiting for the results,
+    # so that the evaluation queries run concurrently instead of one after the other.
+    evaluation_jobs = []
     for i in models_to_compare:
         logging.info(i.path)
         model_bq_name = f"{i.project}.{i.dataset_id}.{i.model_id}"
+        if (model_bq_name, i.created) in cached_evaluations:
+            evaluation_jobs.append((i, model_bq_name, None))
+            continue
         query = f"""
             SELECT * FROM ML.EVALUATE(MODEL `{model_bq_name}`)
         """
         query_job = client.query(
             query=query,
-            location=location
+            location=location,
+            job_config=bigquery.QueryJobConfig(labels=job_labels(pipeline_job_name, 'bq_select_best_kmeans_model'))
         )
+        evaluation_jobs.append((i, model_bq_name, query_job))
 
-        r = list(query_job.result())[0]
+    best_model = dict()
+    best_eval_metrics = dict()
+    new_evaluations = []
+    evaluation_job_statistics = []
+    for i, model_bq_name, query_job in evaluation_jobs:
+        if query_job is None:
+            r = cached_evaluations[(model_bq_name, i.created)]
+        else:
+            r = dict(list(query_job.result())[0].items())
+            evaluation_job_statistics.append(record_job_statistics(
+                client, query_job, None, job_stats_table, pipeline_job_name, 'bq_select_best_kmeans_model')[0])
+            new_evaluations.append({
+                "model_id": model_bq_name,
+                "model_created": i.created.isoformat(),
+                "evaluated_at": datetime.now(timezone.utc).isoformat(),
+                "metrics": json.dumps(r),
+            })
 
         logging.info(f"keys {r.keys()}")
         logging.info(f"{metric_name} {r.get(metric_name)}")
@@ -415,6 +515,17 @@ def bq_select_best_kmeans_model(
             logging.info(
                 f"New Model/Version elected | name: {model_bq_name} | metric name: {metric_name} | metric value: {best_model[metric_name]} ")
 
+    # Caches the evaluation metrics of the models evaluated by this run with a load job,
+    # so that the metrics can be read right away by the next run.
+    if evaluation_cache_table and new_evaluations:
+        client.load_table_from_json(
+            new_evaluations,
+            evaluation_cache_table,
+            job_config=bigquery.LoadJobConfig(write_disposition=bigquery.WriteDisposition.WRITE_APPEND),
+            location=location
+        ).result()
+        logging.info(f"Cached the evaluation of {len(new_evaluations)} models in {evaluation_cache_table}")
+
     if MetricsEnum(metric_name).is_new_metric_better(metric_threshold, best_model[metric_name]):
         raise ValueError(
             f"Model evaluation metric {metric_name} of value {best_model[metric_name]} does not meet minumum criteria of threshold{metric_threshold}")
@@ -423,6 +534,11 @@ def bq_select_best_kmeans_model(
         if k in MetricsEnum.list():
             metrics_logger.log_metric(k, v)
 
+    # Logs the totals of the evaluation jobs of this run, the models with a cached evaluation run no job.
+    metrics_logger.log_metric("evaluation_jobs", len(evaluation_job_statistics))
+    for k in ["total_bytes_processed", "total_bytes_billed", "total_slot_ms"]:
+        metrics_logger.log_metric(k, sum(s[k] for s in evaluation_job_statistics))
+
     # elected_model.uri = f"bq://{best_model['uri']}"
     elected_model.metadata = best_model
     pId, dId, mId = best_model['uri'].split('.')
@@ -440,7 +556,10 @@ def bq_clustering_predictions(
     location: str,
     bigquery_source: str,
     bigquery_destination_prefix: str,
-    destination_table: Output[Dataset]
+    destination_table: Output[Dataset],
+    job_metrics: Output[Metrics],
+    job_stats_table: Optional[str] = None,
+    pipeline_job_name: Optional[str] = None
 ) -> None:
 
     """Generates predictions for a BigQuery ML KMeans model.
@@ -452,10 +571,15 @@ def bq_clustering_predictions(
         bigquery_source: The BigQuery table containing the data to predict.
         bigquery_destination_prefix: The prefix of the destination table name.
         destination_table: Output artifact for the predictions.
+        job_metrics: The output artifact recording the metrics of the BigQuery jobs.
+        job_stats_table: The BigQuery table collecting the statistics of the jobs of the pipelines, in the format
+            "project.dataset.table". If not set, the statistics are only recorded in `job_metrics`.
+        pipeline_job_name: The name of the pipeline job labelling the jobs, such as `dsl.PIPELINE_JOB_NAME_PLACEHOLDER`.
     """
 
     from datetime import datetime
     from google.cloud import bigquery
+    from ma_components.bigquery import get_bigquery_client, job_labels, record_job_statistics
     import logging
 
     from google.api_core.gapic_v1.client_info import ClientInfo
@@ -475,10 +599,10 @@ def bq_clustering_predictions(
     destination_table.metadata["table_id"] = f"{bigquery_destination_prefix}_{timestamp}"
     model_uri = f"{model.metadata['projectId']}.{model.metadata['datasetId']}.{model.metadata['modelId']}"
 
-    client = bigquery.Client(
-        project=project_id, 
+    client = get_bigquery_client(
+        project=project_id,
         location=location,
-        client_info=ClientInfo(user_agent=USER_AGENT_SEGMENTATION_PREDICTION)
+        user_agent=USER_AGENT_SEGMENTATION_PREDICTION
     )
 
     query = f"""
@@ -490,13 +614,16 @@ def bq_clustering_predictions(
         query=query,
         location=location,
         job_config=bigquery.QueryJobConfig(
-            destination=destination_table.metadata["table_id"])
+            destination=destination_table.metadata["table_id"],
+            labels=job_labels(pipeline_job_name, 'bq_clustering_predictions'))
     )
 
     r = query_job.result()
     if (query_job.done()):
         logging.info(f"Job Completed: {query_job.state}")
 
+    record_job_statistics(client, query_job, job_metrics, job_stats_table, pipeline_job_name, 'bq_clustering_predictions')
+
     destination_table.metadata["predictions_column_prefix"] = "CENTROID_ID"
 
 
@@ -508,8 +635,13 @@ def bq_flatten_tabular_binary_prediction_table(
     source_table: str,
     predictions_table: Input[Dataset],
     bq_unique_key: str,
+    job_metrics: Output[Metrics],
     threashold: float = 0.5,
-    positive_label: str = 'true'
+    positive_label: str = 'true',
+    dry_run_preflight: bool = False,
+    maximum_bytes_billed: int = 0,
+    job_stats_table: Optional[str] = None,
+    pipeline_job_name: Optional[str] = None
 ):
     
     """Flattens a BigQuery table containing binary prediction results from a tabular model.
@@ -523,9 +655,17 @@ def bq_flatten_tabular_binary_prediction_table(
         bq_unique_key: The unique key column in the source table.
         threashold: The threshold for determining the predicted class.
         positive_label: The label to assign to predictions above the threshold.
+        job_metrics: The output artifact recording the metrics of the BigQuery jobs.
+        dry_run_preflight: Whether to estimate the query with a dry run before running it,
+            recording the bytes processed and the referenced tables in `job_metrics`.
+        maximum_bytes_billed: The maximum number of bytes the query may bill. 0 for no limit.
+        job_stats_table: The BigQuery table collecting the statistics of the jobs of the pipelines, in the format
+            "project.dataset.table". If not set, the statistics are only recorded in `job_metrics`.
+        pipeline_job_name: The name of the pipeline job labelling the jobs, such as `dsl.PIPELINE_JOB_NAME_PLACEHOLDER`.
     """
 
     from google.cloud import bigquery
+    from ma_components.bigquery import get_bigquery_client, dry_run_query, job_labels, record_job_statistics
     import logging
 
     from google.api_core.gapic_v1.client_info import ClientInfo
@@ -542,10 +682,10 @@ def bq_flatten_tabular_binary_prediction_table(
 
 
     # Construct a BigQuery client object.
-    client = bigquery.Client(
+    client = get_bigquery_client(
         project=project_id,
         location=location,
-        client_info=ClientInfo(user_agent=USER_AGENT_PROPENSITY_PREDICTION)
+        user_agent=USER_AGENT_PROPENSITY_PREDICTION
     )
 
     # Inspect the metadata set on destination_table and predictions_table
@@ -611,22 +751,27 @@ def bq_flatten_tabular_binary_prediction_table(
     """
   
   
-    job_config = bigquery.QueryJobConfig()
-    job_config.write_disposition = 'WRITE_TRUNCATE'
+    job_config = bigquery.QueryJobConfig(maximum_bytes_billed=maximum_bytes_billed or None, labels=job_labels(pipeline_job_name, 'bq_flatten_tabular_binary_prediction_table'))
     
-    # Reconstruct a BigQuery client object.
-    client = bigquery.Client(
+    # Gets the shared BigQuery client of the location of the table, reusing the credentials and connections of the first client.
+    client = get_bigquery_client(
         project=project_id,
         location=bq_table.location,
-        client_info=ClientInfo(user_agent=USER_AGENT_PROPENSITY_PREDICTION)
+        user_agent=USER_AGENT_PROPENSITY_PREDICTION
     )
+    if dry_run_preflight:
+        dry_run_query(client, query, job_config, bq_table.location, maximum_bytes_billed, job_metrics)
+
     query_job = client.query(
         query=query,
-        location=bq_table.location
+        location=bq_table.location,
+        job_config=job_config
     )
 
     results = query_job.result()
 
+    record_job_statistics(client, query_job, job_metrics, job_stats_table, pipeline_job_name, 'bq_flatten_tabular_binary_prediction_table')
+
     logging.info(query)
 
     for row in results:
@@ -640,7 +785,12 @@ def bq_flatten_tabular_regression_table(
     source_table: str,
     predictions_table: Input[Dataset],
     bq_unique_key: str,
-    destination_table: Output[Dataset]
+    destination_table: Output[Dataset],
+    job_metrics: Output[Metrics],
+    dry_run_preflight: bool = False,
+    maximum_bytes_billed: int = 0,
+    job_stats_table: Optional[str] = None,
+    pipeline_job_name: Optional[str] = None
 ):
     
     """Flattens a BigQuery table containing regression prediction results from a tabular model.
@@ -652,9 +802,17 @@ def bq_flatten_tabular_regression_table(
         predictions_table: Input artifact for the predictions table.
         bq_unique_key: The unique key column in the source table.
         destination_table: Output artifact for the flattened table.
+        job_metrics: The output artifact recording the metrics of the BigQuery jobs.
+        dry_run_preflight: Whether to estimate the query with a dry run before running it,
+            recording the bytes processed and the referenced tables in `job_metrics`.
+        maximum_bytes_billed: The maximum number of bytes the query may bill. 0 for no limit.
+        job_stats_table: The BigQuery table collecting the statistics of the jobs of the pipelines, in the format
+            "project.dataset.table". If not set, the statistics are only recorded in `job_metrics`.
+        pipeline_job_name: The name of the pipeline job labelling the jobs, such as `dsl.PIPELINE_JOB_NAME_PLACEHOLDER`.
     """
 
     from google.cloud import bigquery
+    from ma_components.bigquery import get_bigquery_client, dry_run_query, job_labels, record_job_statistics
     import logging
 
     from google.api_core.gapic_v1.client_info import ClientInfo
@@ -671,10 +829,10 @@ def bq_flatten_tabular_regression_table(
 
 
     # Construct a BigQuery client object.
-    client = bigquery.Client(
+    client = get_bigquery_client(
         project=project_id,
         location=location,
-        client_info=ClientInfo(user_agent=USER_AGENT_REGRESSION_PREDICTION)
+        user_agent=USER_AGENT_REGRESSION_PREDICTION
     )
 
     # Inspect the metadata set on destination_table and predictions_table
@@ -708,22 +866,27 @@ def bq_flatten_tabular_regression_table(
             INNER JOIN `{source_table}` as b on a.{bq_unique_key}=b.{bq_unique_key} 
             )
     """
-    job_config = bigquery.QueryJobConfig()
-    job_config.write_disposition = 'WRITE_TRUNCATE'
+    job_config = bigquery.QueryJobConfig(maximum_bytes_billed=maximum_bytes_billed or None, labels=job_labels(pipeline_job_name, 'bq_flatten_tabular_regression_table'))
     
-    # Reconstruct a BigQuery client object.
-    client = bigquery.Client(
+    # Gets the shared BigQuery client of the location of the table, reusing the credentials and connections of the first client.
+    client = get_bigquery_client(
         project=project_id,
         location=bq_table.location,
-        client_info=ClientInfo(user_agent=USER_AGENT_REGRESSION_PREDICTION)
+        user_agent=USER_AGENT_REGRESSION_PREDICTION
     )
+    if dry_run_preflight:
+        dry_run_query(client, query, job_config, bq_table.location, maximum_bytes_billed, job_metrics)
+
     query_job = client.query(
         query=query,
         location=bq_table.location,
+        job_config=job_config
     )
 
     results = query_job.result()
 
+    record_job_statistics(client, query_job, job_metrics, job_stats_table, pipeline_job_name, 'bq_flatten_tabular_regression_table')
+
     logging.info(query)
 
     for row in results:
@@ -737,7 +900,12 @@ def bq_flatten_kmeans_prediction_table(
     project_id: str,
     location: str,
     source_table: Input[Dataset],
-    destination_table: Output[Dataset]
+    destination_table: Output[Dataset],
+    job_metrics: Output[Metrics],
+    dry_run_preflight: bool = False,
+    maximum_bytes_billed: int = 0,
+    job_stats_table: Optional[str] = None,
+    pipeline_job_name: Optional[str] = None
 ):
     """Flattens a BigQuery table containing KMeans prediction results.
 
@@ -746,9 +914,17 @@ def bq_flatten_kmeans_prediction_table(
         location: The location of the predictions table.
         source_table: Input artifact for the predictions table.
         destination_table: Output artifact for the flattened table.
+        job_metrics: The output artifact recording the metrics of the BigQuery jobs.
+        dry_run_preflight: Whether to estimate the query with a dry run before running it,
+            recording the bytes processed and the referenced tables in `job_metrics`.
+        maximum_bytes_billed: The maximum number of bytes the query may bill. 0 for no limit.
+        job_stats_table: The BigQuery table collecting the statistics of the jobs of the pipelines, in the format
+            "project.dataset.table". If not set, the statistics are only recorded in `job_metrics`.
+        pipeline_job_name: The name of the pipeline job labelling the jobs, such as `dsl.PIPELINE_JOB_NAME_PLACEHOLDER`.
     """
 
     from google.cloud import bigquery
+    from ma_components.bigquery import get_bigquery_client, dry_run_query, job_labels, record_job_statistics
     import logging
 
     from google.api_core.gapic_v1.client_info import ClientInfo
@@ -765,10 +941,10 @@ def bq_flatten_kmeans_prediction_table(
 
 
     # Construct a BigQuery client object.
-    client = bigquery.Client(
+    client = get_bigquery_client(
         project=project_id,
         location=location,
-        client_info=ClientInfo(user_agent=USER_AGENT_SEGMENTATION_PREDICTION)
+        user_agent=USER_AGENT_SEGMENTATION_PREDICTION
     )
 
     # Make an API request.
@@ -798,8 +974,7 @@ def bq_flatten_kmeans_prediction_table(
             , * EXCEPT({predictions_column})
             FROM `{source_table.metadata['table_id']}`)
     """
-    job_config = bigquery.QueryJobConfig()
-    job_config.write_disposition = 'WRITE_TRUNCATE'
+    job_config = bigquery.QueryJobConfig(maximum_bytes_billed=maximum_bytes_billed or None, labels=job_labels(pipeline_job_name, 'bq_flatten_kmeans_prediction_table'))
     """
     # Make an API request to create the view.
     view = bigquery.Table(f"{table.metadata['table_id']}_view")
@@ -807,13 +982,19 @@ def bq_flatten_kmeans_prediction_table(
     view = client.create_table(table = view)
     logging.info(f"Created {view.table_type}: {str(view.reference)}")
     """
+    if dry_run_preflight:
+        dry_run_query(client, query, job_config, location, maximum_bytes_billed, job_metrics)
+
     query_job = client.query(
         query=query,
-        location=location
+        location=location,
+        job_config=job_config
     )
 
     results = query_job.result()
 
+    record_job_statistics(client, query_job, job_metrics, job_stats_table, pipeline_job_name, 'bq_flatten_kmeans_prediction_table')
+
     for row in results:
         logging.info("row info: {}".format(row))
 
@@ -830,7 +1011,12 @@ def bq_dynamic_query_exec_output(
     date_end: str,
     reg_expression: str,
     destination_table: Output[Dataset],
+    job_metrics: Output[Metrics],
     perc_keep: int = 35,
+    dry_run_preflight: bool = False,
+    maximum_bytes_billed: int = 0,
+    job_stats_table: Optional[str] = None,
+    pipeline_job_name: Optional[str] = None
 ) -> None:
     
     """Executes a dynamic BigQuery query and stores the results in a BigQuery table.
@@ -847,9 +1033,17 @@ def bq_dynamic_query_exec_output(
         reg_expression: The regular expression to use to extract features from the page_path column.
         destination_table: Output artifact for the BigQuery table.
         perc_keep: The percentage of features to keep in the output table.
+        job_metrics: The output artifact recording the metrics of the BigQuery jobs.
+        dry_run_preflight: Whether to estimate the query with a dry run before running it,
+            recording the bytes processed and the referenced tables in `job_metrics`.
+        maximum_bytes_billed: The maximum number of bytes the query may bill. 0 for no limit.
+        job_stats_table: The BigQuery table collecting the statistics of the jobs of the pipelines, in the format
+            "project.dataset.table". If not set, the statistics are only recorded in `job_metrics`.
+        pipeline_job_name: The name of the pipeline job labelling the jobs, such as `dsl.PIPELINE_JOB_NAME_PLACEHOLDER`.
     """
     
     from google.cloud import bigquery
+    from ma_components.bigquery import get_bigquery_client, dry_run_query, job_labels, record_job_statistics
     import logging
     import numpy as np
     import pandas as pd
@@ -870,10 +1064,10 @@ def bq_dynamic_query_exec_output(
 
 
     # Construct a BigQuery client object.
-    client = bigquery.Client(
+    client = get_bigquery_client(
         project=project_id,
         location=location,
-        client_info=ClientInfo(user_agent=USER_AGENT_SEGMENTATION_TRAINING)
+        user_agent=USER_AGENT_SEGMENTATION_TRAINING
     )
 
     # Construct query template
@@ -923,20 +1117,27 @@ def bq_dynamic_query_exec_output(
 
     logging.info(f"{sql}")
 
+    job_config = bigquery.QueryJobConfig(maximum_bytes_billed=maximum_bytes_billed or None, labels=job_labels(pipeline_job_name, 'bq_dynamic_query_exec_output'))
+    if dry_run_preflight:
+        dry_run_query(client, sql, job_config, location, maximum_bytes_billed, job_metrics)
+
     # Run the BQ query
     query_job = client.query(
         query=sql,
-        location=location
+        location=location,
+        job_config=job_config
     )
     results = query_job.result()
 
+    record_job_statistics(client, query_job, job_metrics, job_stats_table, pipeline_job_name, 'bq_dynamic_query_exec_output')
+
     for row in results:
         logging.info("row info: {}".format(row))
 
 
     # Extract rows values
     sql = f"""SELECT feature FROM `{project_id}.{dataset}.{create_table}`"""
-    query_df = client.query(query=sql).to_dataframe()
+    query_df = client.query(query=sql, job_config=job_config).to_dataframe()
 
     # Prepare component output
     destination_table.metadata["table_id"] = f"{project_id}.{dataset}.{create_table}"
@@ -957,7 +1158,10 @@ def bq_dynamic_stored_procedure_exec_output_full_dataset_preparation(
     reg_expression: str,
     stored_procedure_name: str,
     full_dataset_table: str,
-    timeout: Optional[float] = 1800
+    job_metrics: Output[Metrics],
+    timeout: Optional[float] = 1800,
+    job_stats_table: Optional[str] = None,
+    pipeline_job_name: Optional[str] = None
 ) -> None:
     
     """Executes a dynamic BigQuery stored procedure to create a full dataset preparation table.
@@ -973,10 +1177,15 @@ def bq_dynamic_stored_procedure_exec_output_full_dataset_preparation(
         reg_expression: The regular expression to use to extract features from the page_path column.
         stored_procedure_name: The name of the stored procedure to execute.
         full_dataset_table: The name of the full dataset preparation table to create.
+        job_metrics: The output artifact recording the metrics of the BigQuery jobs.
         timeout: The timeout for the query, in seconds.
+        job_stats_table: The BigQuery table collecting the statistics of the jobs of the pipelines, in the format
+            "project.dataset.table". If not set, the statistics are only recorded in `job_metrics`.
+        pipeline_job_name: The name of the pipeline job labelling the jobs, such as `dsl.PIPELINE_JOB_NAME_PLACEHOLDER`.
     """
 
     from google.cloud import bigquery
+    from ma_components.bigquery import get_bigquery_client, job_labels, record_job_statistics
     import logging
 
     from google.api_core.gapic_v1.client_info import ClientInfo
@@ -993,10 +1202,10 @@ def bq_dynamic_stored_procedure_exec_output_full_dataset_preparation(
 
 
     # Construct a BigQuery client object.
-    client = bigquery.Client(
+    client = get_bigquery_client(
         project=project_id,
         location=location,
-        client_info=ClientInfo(user_agent=USER_AGENT_SEGMENTATION_TRAINING)
+        user_agent=USER_AGENT_SEGMENTATION_TRAINING
     )
 
     def _create_auto_audience_segmentation_full_dataset_preparation_procedure(
@@ -1098,10 +1307,15 @@ def bq_dynamic_stored_procedure_exec_output_full_dataset_preparation(
     # Run the BQ query
     query_job = client.query(
         query=sql,
-        location=location
+        location=location,
+        job_config=bigquery.QueryJobConfig(
+            labels=job_labels(pipeline_job_name, 'bq_dynamic_stored_procedure_exec_output_full_dataset_preparation'))
     )
     results = query_job.result()
 
+    record_job_statistics(client, query_job, job_metrics, job_stats_table, pipeline_job_name,
+                          'bq_dynamic_stored_procedure_exec_output_full_dataset_preparation')
+
     for row in results:
         logging.info("row info: {}".format(row))
     
@@ -1122,7 +1336,10 @@ def bq_union_predictions_tables(
     table_propensity_bq_unique_key: str,
     table_regression_bq_unique_key: str,
     destination_table: Output[Dataset],
-    threashold: float
+    threashold: float,
+    job_metrics: Output[Metrics],
+    job_stats_table: Optional[str] = None,
+    pipeline_job_name: Optional[str] = None
 ):
     
     """Unions the predictions from two BigQuery tables into a single table.
@@ -1136,9 +1353,14 @@ def bq_union_predictions_tables(
         table_regression_bq_unique_key: The unique key column in the regression predictions table.
         destination_table: Output artifact for the unioned predictions table.
         threashold: The threshold for determining the predicted class for the propensity predictions.
+        job_metrics: The output artifact recording the metrics of the BigQuery jobs.
+        job_stats_table: The BigQuery table collecting the statistics of the jobs of the pipelines, in the format
+            "project.dataset.table". If not set, the statistics are only recorded in `job_metrics`.
+        pipeline_job_name: The name of the pipeline job labelling the jobs, such as `dsl.PIPELINE_JOB_NAME_PLACEHOLDER`.
     """
 
     from google.cloud import bigquery
+    from ma_components.bigquery import get_bigquery_client, job_labels, record_job_statistics
     import logging
 
     from google.api_core.gapic_v1.client_info import ClientInfo
@@ -1155,10 +1377,10 @@ def bq_union_predictions_tables(
 
 
     # Construct a BigQuery client object.
-    client = bigquery.Client(
+    client = get_bigquery_client(
         project=project_id,
         location=location,
-        client_info=ClientInfo(user_agent=USER_AGENT_REGRESSION_PREDICTION)
+        user_agent=USER_AGENT_REGRESSION_PREDICTION
     )
 
     # Inspect the metadata set on destination_table and predictions_table
@@ -1278,18 +1500,22 @@ def bq_union_predictions_tables(
     job_config = bigquery.QueryJobConfig()
     job_config.write_disposition = 'WRITE_TRUNCATE'
     
-    # Reconstruct a BigQuery client object.
-    client = bigquery.Client(
+    # Gets the shared BigQuery client of the location of the table, reusing the credentials and connections of the first client.
+    client = get_bigquery_client(
         project=project_id,
         location=bq_table_regression.location,
-        client_info=ClientInfo(user_agent=USER_AGENT_REGRESSION_PREDICTION)
+        user_agent=USER_AGENT_REGRESSION_PREDICTION
     )
     query_job = client.query(
         query=query,
         location=bq_table_regression.location,
+        job_config=bigquery.QueryJobConfig(labels=job_labels(pipeline_job_name, 'bq_union_predictions_tables'))
     )
     results = query_job.result()
 
+    # The query is a script, the statistics of its statements are recorded as child jobs.
+    record_job_statistics(client, query_job, job_metrics, job_stats_table, pipeline_job_name, 'bq_union_predictions_tables')
+
     for row in results:
         logging.info("row info: {}".format(row))
 
@@ -1303,6 +1529,9 @@ def write_tabular_model_explanation_to_bigquery(
     data_location: str,
     destination_table: str,
     model_explanation: Input[Dataset],
+    job_metrics: Output[Metrics],
+    job_stats_table: Optional[str] = None,
+    pipeline_job_name: Optional[str] = None
 ):
     """Writess tabular model explanation values to a BigQuery table.
 
@@ -1312,10 +1541,15 @@ def write_tabular_model_explanation_to_bigquery(
         data_location: location of the BigQuery tables and datasets
         destination_table: table to be written to
         model_explanation: Input artifact to be provided for extracting the model explanation values.
+        job_metrics: The output artifact recording the metrics of the BigQuery job inserting the values.
+        job_stats_table: The BigQuery table collecting the statistics of the jobs of the pipelines, in the format
+            "project.dataset.table". If not set, the statistics are only recorded in `job_metrics`.
+        pipeline_job_name: The name of the pipeline job labelling the jobs, such as `dsl.PIPELINE_JOB_NAME_PLACEHOLDER`.
     """
 
     import logging
     from google.cloud import bigquery
+    from ma_components.bigquery import get_bigquery_client, job_labels, record_job_statistics
     from google.cloud.exceptions import NotFound
     from google.api_core.retry import Retry
     from google.api_core import exceptions
@@ -1334,10 +1568,10 @@ def write_tabular_model_explanation_to_bigquery(
     USER_AGENT_VBB_EXPLANATION = 'cloud-solutions/marketing-analytics-jumpstart-vbb-explanation-v1'
 
 
-    client = bigquery.Client(
-        project=project, 
+    client = get_bigquery_client(
+        project=project,
         location=data_location,
-        client_info=ClientInfo(user_agent=USER_AGENT_VBB_EXPLANATION)
+        user_agent=USER_AGENT_VBB_EXPLANATION
     )
     
     feature_names = model_explanation.metadata['feature_names']
@@ -1359,11 +1593,15 @@ def write_tabular_model_explanation_to_bigquery(
     description = "A table with feature names and numerical values"
     );
     """
+    step_name = 'write_tabular_model_explanation_to_bigquery'
+    job_config = bigquery.QueryJobConfig(labels=job_labels(pipeline_job_name, step_name))
+
     # Execute the query as a job
     try:
-        query_job = client.query(query)
+        query_job = client.query(query, job_config=job_config)
         # Wait for the query job to complete
         query_job.result()  # Waits for job to finish
+        record_job_statistics(client, query_job, None, job_stats_table, pipeline_job_name, step_name)
         # Get query results and convert to pandas DataFrame
         df = query_job.to_dataframe()
         logging.info(df)
@@ -1402,7 +1640,7 @@ def write_tabular_model_explanation_to_bigquery(
 
     def execute_query_with_retries(query):
         """Executes the query with retries."""
-        query_job = client.query(query, retry=retry_predicate)
+        query_job = client.query(query, job_config=job_config, retry=retry_predicate)
 
         while not query_job.done():  # Check if the query job is complete
             print("Query running...")
@@ -1412,7 +1650,9 @@ def write_tabular_model_explanation_to_bigquery(
         if query_job.errors:
             raise RuntimeError(f"Query errors: {query_job.errors}")
 
-        return query_job.result()  # Return the results
+        results = query_job.result()  # Return the results
+        record_job_statistics(client, query_job, job_metrics, job_stats_table, pipeline_job_name, step_name)
+        return results
 
     # Execute the query
     try:
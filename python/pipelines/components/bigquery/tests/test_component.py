@@ -146,7 +146,11 @@ def test_bq_clustering_predictions(variables, prediction_model_id):
         location= my_pipeline_vars['pipeline_parameters']['location'],
         bigquery_source= my_pipeline_vars['pipeline_parameters']['bigquery_source'],
         bigquery_destination_prefix= my_pipeline_vars['pipeline_parameters']['bigquery_destination_prefix'],
-        destination_table=destination_table
+        destination_table=destination_table,
+        job_metrics=mock.Mock(spec=Metrics,
+            uri=os.path.join(artifacts_path,"metrics"),
+            path=os.path.join(artifacts_path,"metrics"),
+            metadata={})
     )
 
 
@@ -182,6 +186,10 @@ def test_bq_flatten_tabular_binary_prediction_table(variables, prediction_table_
         source_table= my_pipeline_vars['pipeline_parameters']['bigquery_source'],
         destination_table= destination_table,
         bq_unique_key= my_pipeline_vars['pipeline_parameters']['bq_unique_key'],
+        job_metrics=mock.Mock(spec=Metrics,
+            uri=os.path.join(artifacts_path,"metrics"),
+            path=os.path.join(artifacts_path,"metrics"),
+            metadata={}),
         predictions_table=prediction_table
     )
 
@@ -245,6 +253,10 @@ def test_bq_flatten_tabular_regression_table(variables, prediction_table_id):
         source_table= my_pipeline_vars['pipeline_parameters']['bigquery_source'],
         destination_table= destination_table,
         bq_unique_key= my_pipeline_vars['pipeline_parameters']['bq_unique_key'],
+        job_metrics=mock.Mock(spec=Metrics,
+            uri=os.path.join(artifacts_path,"metrics"),
+            path=os.path.join(artifacts_path,"metrics"),
+            metadata={}),
         predictions_table=prediction_table
     )
 
@@ -278,6 +290,10 @@ def test_bq_flatten_kmeans_prediction_table(variables, prediction_table_id):
         project_id= my_pipeline_vars['pipeline_parameters']['project_id'],
         location= my_pipeline_vars['pipeline_parameters']['location'],
         destination_table= destination_table,
+        job_metrics=mock.Mock(spec=Metrics,
+            uri=os.path.join(artifacts_path,"metrics"),
+            path=os.path.join(artifacts_path,"metrics"),
+            metadata={}),
         source_table=source_table
     )
 
@@ -325,4 +341,8 @@ def test_bq_union_predictions_tables(variables, prediction_table_propensity_id,
         table_propensity_bq_unique_key= my_pipeline_vars['pipeline_parameters']['purchase_bq_unique_key'],
         table_regression_bq_unique_key= my_pipeline_vars['pipeline_parameters']['clv_bq_unique_key'],
         destination_table= destination_table,
+        job_metrics=mock.Mock(spec=Metrics,
+            uri=os.path.join(artifacts_path,"metrics"),
+            path=os.path.join(artifacts_path,"metrics"),
+            metadata={})
     )
\ No newline at end of file
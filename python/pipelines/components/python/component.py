@@ -98,6 +98,7 @@ def train_scikit_cluster_model(
     
     import logging
     from google.cloud import bigquery
+    from ma_components.bigquery import get_bigquery_client
 
     from google.api_core.gapic_v1.client_info import ClientInfo
 
@@ -113,9 +114,9 @@ def train_scikit_cluster_model(
 
 
     # Construct a BigQuery client object.
-    client = bigquery.Client(
+    client = get_bigquery_client(
         project=project_id,
-        client_info=ClientInfo(user_agent=USER_AGENT_SEGMENTATION_TRAINING)
+        user_agent=USER_AGENT_SEGMENTATION_TRAINING
         #location=location
     )
 
@@ -324,6 +325,7 @@ def hyper_parameter_tuning_scikit_audience_model(
 
     import logging
     from google.cloud import bigquery
+    from ma_components.bigquery import get_bigquery_client
     
     from google.api_core.gapic_v1.client_info import ClientInfo
 
@@ -339,9 +341,9 @@ def hyper_parameter_tuning_scikit_audience_model(
 
 
     # Construct a BigQuery client object.
-    client = bigquery.Client(
+    client = get_bigquery_client(
         project=project_id,
-        client_info=ClientInfo(user_agent=USER_AGENT_SEGMENTATION_TRAINING)
+        user_agent=USER_AGENT_SEGMENTATION_TRAINING
         #location=location
     )
 
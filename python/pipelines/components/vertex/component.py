@@ -351,6 +351,7 @@ def batch_prediction(
     from datetime import datetime, timedelta, timezone
     import logging
     from google.cloud import bigquery
+    from ma_components.bigquery import get_bigquery_client
     from google.cloud.aiplatform import Model
     model = Model(f"{model.metadata['resourceName']}@{model.metadata['version']}")
     timestamp = str(int(datetime.now().timestamp()))
@@ -378,7 +379,7 @@ def batch_prediction(
     destination_table.metadata["predictions_prob_column"] = "prediction_prob"
 
     if dst_table_expiration_hours > 0:
-        client = bigquery.Client(project=model.project)
+        client = get_bigquery_client(project=model.project)
         table = client.get_table(destination_table.metadata["table_id"])
         expiration = datetime.now(timezone.utc) + timedelta(
             hours=dst_table_expiration_hours
@@ -37,7 +37,8 @@ def auto_audience_segmentation_feature_engineering_pipeline(
     query_auto_audience_segmentation_inference_preparation: str,
     query_auto_audience_segmentation_training_preparation: str,
     perc_keep: int = 35,
-    timeout: Optional[float] = 3600.0
+    timeout: Optional[float] = 3600.0,
+    job_stats_table: Optional[str] = None
 ):
     """
     This pipeline defines the steps for feature engineering for the auto audience segmentation model.
@@ -60,6 +61,7 @@ def auto_audience_segmentation_feature_engineering_pipeline(
         query_auto_audience_segmentation_training_preparation: The SQL query that will be used to prepare the training data.
         perc_keep: The percentage of pages to be included in the analysis.
         timeout: The timeout for the pipeline in seconds.
+        job_stats_table: The BigQuery table collecting the statistics of the BigQuery jobs of the pipeline steps.
 
     Returns:
         None
@@ -75,7 +77,9 @@ def auto_audience_segmentation_feature_engineering_pipeline(
         date_start=date_start,
         date_end=date_end,
         perc_keep=perc_keep,
-        reg_expression=reg_expression
+        reg_expression=reg_expression,
+        job_stats_table=job_stats_table,
+        pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER
     )
 
     full_dataset_table_preparation = bq_dynamic_stored_procedure_exec_output_full_dataset_preparation(
@@ -87,7 +91,9 @@ def auto_audience_segmentation_feature_engineering_pipeline(
         dynamic_table_input=feature_table_preparation.outputs['destination_table'],
         stored_procedure_name=stored_procedure_name,
         full_dataset_table=full_dataset_table,
-        reg_expression=reg_expression
+        reg_expression=reg_expression,
+        job_stats_table=job_stats_table,
+        pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER
     ).after(*[feature_table_preparation])
 
     # Training data preparation
@@ -95,7 +101,9 @@ def auto_audience_segmentation_feature_engineering_pipeline(
         project=project_id,
         location=location,
         query=query_auto_audience_segmentation_training_preparation,
-        timeout=timeout).after(*[full_dataset_table_preparation]).set_display_name('auto_audience_segmentation_training_preparation')
+        timeout=timeout,
+        job_stats_table=job_stats_table,
+        pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER).after(*[full_dataset_table_preparation]).set_display_name('auto_audience_segmentation_training_preparation')
 
     
     # Inference data preparation
@@ -103,7 +111,9 @@ def auto_audience_segmentation_feature_engineering_pipeline(
         project=project_id,
         location=location,
         query=query_auto_audience_segmentation_inference_preparation,
-        timeout=timeout).after(*[auto_audience_segmentation_training_prep]).set_display_name('auto_audience_segmentation_inference_preparation')
+        timeout=timeout,
+        job_stats_table=job_stats_table,
+        pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER).after(*[auto_audience_segmentation_training_prep]).set_display_name('auto_audience_segmentation_inference_preparation')
 
 
 @dsl.pipeline()
@@ -112,7 +122,8 @@ def aggregated_value_based_bidding_feature_engineering_pipeline(
     location: Optional[str],
     query_aggregated_value_based_bidding_training_preparation: str,
     query_aggregated_value_based_bidding_explanation_preparation: str,
-    timeout: Optional[float] = 3600.0
+    timeout: Optional[float] = 3600.0,
+    job_stats_table: Optional[str] = None
 ):
     """
     This pipeline defines the steps for feature engineering for the aggregated value based bidding model.
@@ -123,6 +134,7 @@ def aggregated_value_based_bidding_feature_engineering_pipeline(
         query_aggregated_value_based_bidding_training_preparation: The SQL query that will be used to prepare the training data.
         query_aggregated_value_based_bidding_explanation_preparation: The SQL query that will be used to prepare the explanation data.
         timeout: The timeout for the pipeline in seconds.
+        job_stats_table: The BigQuery table collecting the statistics of the BigQuery jobs of the pipeline steps.
 
     Returns:
         None
@@ -133,14 +145,18 @@ def aggregated_value_based_bidding_feature_engineering_pipeline(
         project=project_id,
         location=location,
         query=query_aggregated_value_based_bidding_training_preparation,
-        timeout=timeout).set_display_name('aggregated_value_based_bidding_training_preparation')
+        timeout=timeout,
+        job_stats_table=job_stats_table,
+        pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER).set_display_name('aggregated_value_based_bidding_training_preparation')
     
     # Explanation data preparation
     explanation_table_preparation = sp(
         project=project_id,
         location=location,
         query=query_aggregated_value_based_bidding_explanation_preparation,
-        timeout=timeout).set_display_name('aggregated_value_based_bidding_explanation_preparation')
+        timeout=timeout,
+        job_stats_table=job_stats_table,
+        pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER).set_display_name('aggregated_value_based_bidding_explanation_preparation')
 
 
 @dsl.pipeline()
@@ -151,7 +167,8 @@ def audience_segmentation_feature_engineering_pipeline(
     query_user_segmentation_dimensions: str,
     query_audience_segmentation_inference_preparation: str,
     query_audience_segmentation_training_preparation: str,
-    timeout: Optional[float] = 3600.0
+    timeout: Optional[float] = 3600.0,
+    job_stats_table: Optional[str] = None
 ):
     """
     This pipeline defines the steps for feature engineering for the audience segmentation model.
@@ -164,6 +181,7 @@ def audience_segmentation_feature_engineering_pipeline(
         query_audience_segmentation_inference_preparation: The SQL query that will be used to prepare the inference data.
         query_audience_segmentation_training_preparation: The SQL query that will be used to prepare the training data.
         timeout: The timeout for the pipeline in seconds.
+        job_stats_table: The BigQuery table collecting the statistics of the BigQuery jobs of the pipeline steps.
 
     Returns:
         None
@@ -175,27 +193,35 @@ def audience_segmentation_feature_engineering_pipeline(
         project=project_id,
         location=location,
         query=query_user_lookback_metrics,
-        timeout=timeout).set_display_name('user_lookback_metrics')
+        timeout=timeout,
+        job_stats_table=job_stats_table,
+        pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER).set_display_name('user_lookback_metrics')
     )
     phase_1.append(
         sp(
             project=project_id,
             location=location,
             query=query_user_segmentation_dimensions,
-            timeout=timeout).set_display_name('user_segmentation_dimensions')
+            timeout=timeout,
+            job_stats_table=job_stats_table,
+            pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER).set_display_name('user_segmentation_dimensions')
     )
     # Training data preparation
     audience_segmentation_train_prep = sp(
         project=project_id,
         location=location,
         query=query_audience_segmentation_training_preparation,
-        timeout=timeout).set_display_name('audience_segmentation_training_preparation').after(*phase_1)
+        timeout=timeout,
+        job_stats_table=job_stats_table,
+        pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER).set_display_name('audience_segmentation_training_preparation').after(*phase_1)
     # Inference data preparation
     audience_segmentation_inf_prep = sp(
         project=project_id,
         location=location,
         query=query_audience_segmentation_inference_preparation,
-        timeout=timeout).set_display_name('audience_segmentation_inference_preparation').after(*phase_1)
+        timeout=timeout,
+        job_stats_table=job_stats_table,
+        pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER).set_display_name('audience_segmentation_inference_preparation').after(*phase_1)
 
 
 @dsl.pipeline()
@@ -207,7 +233,8 @@ def lead_score_propensity_feature_engineering_pipeline(
     query_user_rolling_window_metrics: str,
     query_lead_score_propensity_inference_preparation: str,
     query_lead_score_propensity_training_preparation: str,
-    timeout: Optional[float] = 3600.0
+    timeout: Optional[float] = 3600.0,
+    job_stats_table: Optional[str] = None
 ):
     """
     This pipeline defines the steps for feature engineering for the lead score propensity model.
@@ -221,6 +248,7 @@ def lead_score_propensity_feature_engineering_pipeline(
         query_lead_score_propensity_inference_preparation: The SQL query that will be used to prepare the inference data.
         query_lead_score_propensity_training_preparation: The SQL query that will be used to prepare the training data.
         timeout: The timeout for the pipeline in seconds.
+        job_stats_table: The BigQuery table collecting the statistics of the BigQuery jobs of the pipeline steps.
 
     Returns:
         None
@@ -233,34 +261,44 @@ def lead_score_propensity_feature_engineering_pipeline(
             project=project_id,
             location=location,
             query=query_lead_score_propensity_label,
-            timeout=timeout).set_display_name('lead_score_propensity_label')
+            timeout=timeout,
+            job_stats_table=job_stats_table,
+            pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER).set_display_name('lead_score_propensity_label')
     )
     phase_1.append(
         sp(
             project=project_id,
             location=location,
             query=query_user_dimensions,
-            timeout=timeout).set_display_name('user_dimensions')
+            timeout=timeout,
+            job_stats_table=job_stats_table,
+            pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER).set_display_name('user_dimensions')
     )
     phase_1.append(
         sp(
             project=project_id,
             location=location,
             query=query_user_rolling_window_metrics,
-            timeout=timeout).set_display_name('user_rolling_window_metrics')
+            timeout=timeout,
+            job_stats_table=job_stats_table,
+            pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER).set_display_name('user_rolling_window_metrics')
     )
     # Training data preparation
     purchase_propensity_train_prep = sp(
         project=project_id,
         location=location,
         query=query_lead_score_propensity_training_preparation,
-        timeout=timeout).set_display_name('lead_score_propensity_training_preparation').after(*phase_1)
+        timeout=timeout,
+        job_stats_table=job_stats_table,
+        pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER).set_display_name('lead_score_propensity_training_preparation').after(*phase_1)
     # Inference data preparation
     purchase_propensity_inf_prep = sp(
         project=project_id,
         location=location,
         query=query_lead_score_propensity_inference_preparation,
-        timeout=timeout).set_display_name('lead_score_propensity_inference_preparation').after(*phase_1)
+        timeout=timeout,
+        job_stats_table=job_stats_table,
+        pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER).set_display_name('lead_score_propensity_inference_preparation').after(*phase_1)
 
 
 @dsl.pipeline()
@@ -272,7 +310,8 @@ def purchase_propensity_feature_engineering_pipeline(
     query_user_rolling_window_metrics: str,
     query_purchase_propensity_inference_preparation: str,
     query_purchase_propensity_training_preparation: str,
-    timeout: Optional[float] = 3600.0
+    timeout: Optional[float] = 3600.0,
+    job_stats_table: Optional[str] = None
 ):
     """
     This pipeline defines the steps for feature engineering for the purchase propensity model.
@@ -286,6 +325,7 @@ def purchase_propensity_feature_engineering_pipeline(
         query_purchase_propensity_inference_preparation: The SQL query that will be used to prepare the inference data.
         query_purchase_propensity_training_preparation: The SQL query that will be used to prepare the training data.
         timeout: The timeout for the pipeline in seconds.
+        job_stats_table: The BigQuery table collecting the statistics of the BigQuery jobs of the pipeline steps.
 
     Returns:
         None
@@ -298,34 +338,44 @@ def purchase_propensity_feature_engineering_pipeline(
             project=project_id,
             location=location,
             query=query_purchase_propensity_label,
-            timeout=timeout).set_display_name('purchase_propensity_label')
+            timeout=timeout,
+            job_stats_table=job_stats_table,
+            pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER).set_display_name('purchase_propensity_label')
     )
     phase_1.append(
         sp(
             project=project_id,
             location=location,
             query=query_user_dimensions,
-            timeout=timeout).set_display_name('user_dimensions')
+            timeout=timeout,
+            job_stats_table=job_stats_table,
+            pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER).set_display_name('user_dimensions')
     )
     phase_1.append(
         sp(
             project=project_id,
             location=location,
             query=query_user_rolling_window_metrics,
-            timeout=timeout).set_display_name('user_rolling_window_metrics')
+            timeout=timeout,
+            job_stats_table=job_stats_table,
+            pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER).set_display_name('user_rolling_window_metrics')
     )
     # Training data preparation
     purchase_propensity_train_prep = sp(
         project=project_id,
         location=location,
         query=query_purchase_propensity_training_preparation,
-        timeout=timeout).set_display_name('purchase_propensity_training_preparation').after(*phase_1)
+        timeout=timeout,
+        job_stats_table=job_stats_table,
+        pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER).set_display_name('purchase_propensity_training_preparation').after(*phase_1)
     # Inference data preparation
     purchase_propensity_inf_prep = sp(
         project=project_id,
         location=location,
         query=query_purchase_propensity_inference_preparation,
-        timeout=timeout).set_display_name('purchase_propensity_inference_preparation').after(*phase_1)
+        timeout=timeout,
+        job_stats_table=job_stats_table,
+        pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER).set_display_name('purchase_propensity_inference_preparation').after(*phase_1)
   
 
 @dsl.pipeline()
@@ -337,7 +387,8 @@ def churn_propensity_feature_engineering_pipeline(
     query_user_rolling_window_metrics: str,
     query_churn_propensity_inference_preparation: str,
     query_churn_propensity_training_preparation: str,
-    timeout: Optional[float] = 3600.0
+    timeout: Optional[float] = 3600.0,
+    job_stats_table: Optional[str] = None
 ):
     """
     This pipeline defines the steps for feature engineering for the churn propensity model.
@@ -351,6 +402,7 @@ def churn_propensity_feature_engineering_pipeline(
         query_churn_propensity_inference_preparation: The SQL query that will be used to prepare the inference data.
         query_churn_propensity_training_preparation: The SQL query that will be used to prepare the training data.
         timeout: The timeout for the pipeline in seconds.
+        job_stats_table: The BigQuery table collecting the statistics of the BigQuery jobs of the pipeline steps.
 
     Returns:
         None
@@ -363,34 +415,44 @@ def churn_propensity_feature_engineering_pipeline(
             project=project_id,
             location=location,
             query=query_churn_propensity_label,
-            timeout=timeout).set_display_name('churn_propensity_label')
+            timeout=timeout,
+            job_stats_table=job_stats_table,
+            pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER).set_display_name('churn_propensity_label')
     )
     phase_1.append(
         sp(
             project=project_id,
             location=location,
             query=query_user_dimensions,
-            timeout=timeout).set_display_name('user_dimensions')
+            timeout=timeout,
+            job_stats_table=job_stats_table,
+            pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER).set_display_name('user_dimensions')
     )
     phase_1.append(
         sp(
             project=project_id,
             location=location,
             query=query_user_rolling_window_metrics,
-            timeout=timeout).set_display_name('user_rolling_window_metrics')
+            timeout=timeout,
+            job_stats_table=job_stats_table,
+            pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER).set_display_name('user_rolling_window_metrics')
     )
     # Training data preparation
     churn_propensity_train_prep = sp(
         project=project_id,
         location=location,
         query=query_churn_propensity_training_preparation,
-        timeout=timeout).set_display_name('churn_propensity_training_preparation').after(*phase_1)
+        timeout=timeout,
+        job_stats_table=job_stats_table,
+        pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER).set_display_name('churn_propensity_training_preparation').after(*phase_1)
     # Inference data preparation
     churn_propensity_inf_prep = sp(
         project=project_id,
         location=location,
         query=query_churn_propensity_inference_preparation,
-        timeout=timeout).set_display_name('churn_propensity_inference_preparation').after(*phase_1)
+        timeout=timeout,
+        job_stats_table=job_stats_table,
+        pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER).set_display_name('churn_propensity_inference_preparation').after(*phase_1)
     
 
 @dsl.pipeline()
@@ -402,7 +464,8 @@ def customer_lifetime_value_feature_engineering_pipeline(
     query_user_rolling_window_lifetime_metrics: str,
     query_customer_lifetime_value_inference_preparation: str,
     query_customer_lifetime_value_training_preparation: str,
-    timeout: Optional[float] = 3600.0
+    timeout: Optional[float] = 3600.0,
+    job_stats_table: Optional[str] = None
 ):
     """
     This pipeline defines the steps for feature engineering for the customer lifetime value model.
@@ -416,6 +479,7 @@ def customer_lifetime_value_feature_engineering_pipeline(
         query_customer_lifetime_value_inference_preparation: The SQL query that will be used to prepare the inference data.
         query_customer_lifetime_value_training_preparation: The SQL query that will be used to prepare the training data.
         timeout: The timeout for the pipeline in seconds.
+        job_stats_table: The BigQuery table collecting the statistics of the BigQuery jobs of the pipeline steps.
 
     Returns:
         None
@@ -428,34 +492,44 @@ def customer_lifetime_value_feature_engineering_pipeline(
             project=project_id,
             location=location,
             query=query_customer_lifetime_value_label,
-            timeout=timeout).set_display_name('customer_lifetime_value_label')
+            timeout=timeout,
+            job_stats_table=job_stats_table,
+            pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER).set_display_name('customer_lifetime_value_label')
     )
     phase_1.append(
         sp(
             project=project_id,
             location=location,
             query=query_user_lifetime_dimensions,
-            timeout=timeout).set_display_name('user_lifetime_dimensions')
+            timeout=timeout,
+            job_stats_table=job_stats_table,
+            pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER).set_display_name('user_lifetime_dimensions')
     )
     phase_1.append(
         sp(
             project=project_id,
             location=location,
             query=query_user_rolling_window_lifetime_metrics,
-            timeout=timeout).set_display_name('user_rolling_window_lifetime_metrics')
+            timeout=timeout,
+            job_stats_table=job_stats_table,
+            pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER).set_display_name('user_rolling_window_lifetime_metrics')
     )
     # Training data preparation
     customer_lifetime_value_train_prep = sp(
         project=project_id,
         location=location,
         query=query_customer_lifetime_value_training_preparation,
-        timeout=timeout).set_display_name('customer_lifetime_value_training_preparation').after(*phase_1)
+        timeout=timeout,
+        job_stats_table=job_stats_table,
+        pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER).set_display_name('customer_lifetime_value_training_preparation').after(*phase_1)
     # Inference data preparation
     customer_lifetime_value_inf_prep = sp(
         project=project_id,
         location=location,
         query=query_customer_lifetime_value_inference_preparation,
-        timeout=timeout).set_display_name('customer_lifetime_value_inference_preparation').after(*phase_1)
+        timeout=timeout,
+        job_stats_table=job_stats_table,
+        pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER).set_display_name('customer_lifetime_value_inference_preparation').after(*phase_1)
 
 
 @dsl.pipeline()
@@ -463,7 +537,8 @@ def reporting_preparation_pl(
     project_id: str,
     location: Optional[str],
     query_aggregate_last_day_predictions: str,
-    timeout: Optional[float] = 3600.0
+    timeout: Optional[float] = 3600.0,
+    job_stats_table: Optional[str] = None
 ):
     """
     This pipeline defines the steps for preparing the reporting data.
@@ -473,6 +548,7 @@ def reporting_preparation_pl(
         location: The Google Cloud region where the pipeline will be run.
         query_aggregate_last_day_predictions: The SQL query that will be used to aggregate the last day predictions.
         timeout: The timeout for the pipeline in seconds.
+        job_stats_table: The BigQuery table collecting the statistics of the BigQuery jobs of the pipeline steps.
 
     Returns:
         None
@@ -483,7 +559,9 @@ def reporting_preparation_pl(
         project=project_id,
         location=location,
         query=query_aggregate_last_day_predictions,
-        query_parameters=[]
+        query_parameters=[],
+        job_stats_table=job_stats_table,
+        pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER
     ).set_display_name('aggregate_predictions')
 
 
@@ -493,7 +571,8 @@ def gemini_insights_pl(
     location: Optional[str],
     query_invoke_user_scoped_metrics: str,
     query_invoke_user_behaviour_revenue_insights: str,
-    timeout: Optional[float] = 3600.0
+    timeout: Optional[float] = 3600.0,
+    job_stats_table: Optional[str] = None
 ):
     """
     This pipeline defines the steps for invoking the user behaviour revenue insights query.
@@ -503,6 +582,7 @@ def gemini_insights_pl(
         location: The Google Cloud region where the pipeline will be run.
         query_invoke_user_behaviour_revenue_insights: The SQL query that will be used to invoke the user behaviour revenue gemini insights.
         timeout: The timeout for the pipeline in seconds.
+        job_stats_table: The BigQuery table collecting the statistics of the BigQuery jobs of the pipeline steps.
 
     Returns:
         None
@@ -513,7 +593,9 @@ def gemini_insights_pl(
         project=project_id,
         location=location,
         query=query_invoke_user_scoped_metrics,
-        query_parameters=[]
+        query_parameters=[],
+        job_stats_table=job_stats_table,
+        pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER
     ).set_display_name('user_scoped_metrics')
 
     # User behaviour revenue insights
@@ -521,5 +603,7 @@ def gemini_insights_pl(
         project=project_id,
         location=location,
         query=query_invoke_user_behaviour_revenue_insights,
-        query_parameters=[]
+        query_parameters=[],
+        job_stats_table=job_stats_table,
+        pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER
     ).after(*[user_scoped_metrics]).set_display_name('user_behaviour_revenue_insights')
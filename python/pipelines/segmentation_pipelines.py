@@ -105,7 +105,8 @@ def training_pl(
     evaluateModel = bq_evaluate(
         project=project_id, 
         location=location, 
-        model=bq_model.outputs["model"]).after(bq_model)
+        model=bq_model.outputs["model"],
+        pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER).after(bq_model)
     
 
 
@@ -124,7 +125,8 @@ def prediction_pl(
     bigquery_source: str,
     bigquery_destination_prefix: str,
     pubsub_activation_topic: str,
-    pubsub_activation_type: str
+    pubsub_activation_type: str,
+    model_evaluation_cache_table: Optional[str] = None
 ):
     """
     This function defines the Vertex AI Pipeline for Audience Segmentation Prediction.
@@ -141,6 +143,7 @@ def prediction_pl(
         bigquery_destination_prefix (str): The prefix for the BigQuery table where the predictions will be stored.
         pubsub_activation_topic (str): The Pub/Sub topic to send the activation message to.
         pubsub_activation_type (str): The type of activation message to send.
+        model_evaluation_cache_table (Optional[str]): The BigQuery table caching the evaluation metrics of the models, so that only new models are evaluated.
     """
 
     # Get the best candidate model according to the parameters.
@@ -152,6 +155,8 @@ def prediction_pl(
         metric_name= model_metric_name,
         metric_threshold= model_metric_threshold,
         number_of_models_considered= number_of_models_considered,
+        evaluation_cache_table= model_evaluation_cache_table,
+        pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER,
     ).set_display_name('elect_latest_model')
 
     # Submits a BigQuery job to generate the predictions using the `bigquery_source` and prediction dataset.
@@ -160,7 +165,8 @@ def prediction_pl(
         project_id = project_id,
         location = location,
         bigquery_source = bigquery_source,
-        bigquery_destination_prefix= bigquery_destination_prefix)
+        bigquery_destination_prefix= bigquery_destination_prefix,
+        pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER)
 
     # Flattens the prediction table
     flatten_predictions = bq_flatten_kmeans_prediction_table(
@@ -341,7 +341,8 @@ def prediction_binary_classification_regression_pl(
         predictions_table_regression=clv_flatten_predictions.outputs['destination_table'],
         table_propensity_bq_unique_key=purchase_bq_unique_key,
         table_regression_bq_unique_key=clv_bq_unique_key,
-        threashold=threashold
+        threashold=threashold,
+        pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER
     ).set_display_name('union_predictions')
 
     # Sends pubsub message for activation
@@ -405,4 +406,5 @@ def explanation_tabular_workflow_regression_pl(
         data_location = data_location,
         model_explanation=value_based_bidding_model_explanation.outputs['model_explanation'],
         destination_table=bigquery_destination_prefix,
+        pipeline_job_name=dsl.PIPELINE_JOB_NAME_PLACEHOLDER,
     ).set_display_name('write_vbb_model_explanation')
\ No newline at end of file